@@ -0,0 +1,117 @@
+import argparse
+import inspect
+import json
+import multiprocessing
+import os
+import posixpath as px
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+
+import stitch
+from stage_slots import set_stage_slots
+
+
+REQUIRED_REGION_KEYS = ('img_dirs', 'out_dir', 'best_focus_dir', 'submission_file_path')
+REGION_LOG_NAME = 'batch_region.log'
+
+
+def load_batch_file(batch_file_path: str) -> List[dict]:
+    """ {"defaults": {arguments of stitch.main}, "regions": [{img_dirs, out_dir, best_focus_dir, submission_file_path, ...}]}
+        Every region gets the defaults overridden by its own arguments.
+    """
+    with open(batch_file_path, 'r') as f:
+        batch = json.load(f)
+    defaults = batch.get('defaults', {})
+    known_keys = set(inspect.signature(stitch.main).parameters)
+    regions = []
+    for i, region_arguments in enumerate(batch['regions']):
+        region = dict(defaults, **region_arguments)
+        region.setdefault('cytokit_json_path', None)
+        region.setdefault('imagej_path', None)
+        missing = [key for key in REQUIRED_REGION_KEYS if key not in region]
+        unknown = sorted(set(region) - known_keys)
+        if missing or unknown:
+            raise ValueError('Region ' + str(i) + ' in ' + batch_file_path + ' has missing arguments ' + str(missing) +
+                             ' and unknown arguments ' + str(unknown))
+        regions.append(region)
+    out_dirs = [region['out_dir'] for region in regions]
+    if len(set(out_dirs)) != len(out_dirs):
+        raise ValueError('Every region needs its own out_dir')
+    return regions
+
+
+def run_region(region: dict) -> float:
+    """ Runs in a worker process, output of the region goes to a log file in its out_dir """
+    stitch.make_dir_if_not_exists(region['out_dir'])
+    start = time.perf_counter()
+    with open(px.join(region['out_dir'], REGION_LOG_NAME), 'a') as log, redirect_stdout(log):
+        stitch.main(**region)
+    return time.perf_counter() - start
+
+
+def run_batch(regions: List[dict], num_workers: int, workers_per_stage: int, max_fiji_jobs: int,
+              max_parallel_regions: int = None) -> List[dict]:
+    """ Regions run in parallel processes and interleave their stages:
+        at most num_workers // workers_per_stage cpu stages (projection, python registration and fusion, assembly)
+        and max_fiji_jobs Fiji jobs run at the same time over all regions, each cpu stage uses workers_per_stage workers.
+    """
+    cpu_slots = max(1, num_workers // workers_per_stage)
+    if max_parallel_regions is None:
+        # enough regions to keep cpu and Fiji slots busy at the same time
+        max_parallel_regions = cpu_slots + max_fiji_jobs
+    context = multiprocessing.get_context('spawn')
+    slots = dict(cpu=context.BoundedSemaphore(cpu_slots), fiji=context.BoundedSemaphore(max_fiji_jobs))
+    print('Stitching', len(regions), 'regions,', min(max_parallel_regions, len(regions)), 'at a time,',
+          cpu_slots, 'cpu stages with', workers_per_stage, 'workers each and', max_fiji_jobs, 'Fiji jobs at a time')
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_parallel_regions, mp_context=context,
+                             initializer=set_stage_slots, initargs=(slots,)) as executor:
+        futures = dict()
+        for region in regions:
+            region = dict(region, num_workers=workers_per_stage,
+                          max_fiji_jobs=min(region.get('max_fiji_jobs') or max_fiji_jobs, max_fiji_jobs))
+            futures[executor.submit(run_region, region)] = region
+        for future in as_completed(futures):
+            region = futures[future]
+            log_path = px.join(region['out_dir'], REGION_LOG_NAME)
+            try:
+                seconds = future.result()
+                results.append(dict(out_dir=region['out_dir'], status='ok', seconds=round(seconds, 1), log_path=log_path))
+                print('Finished', region['out_dir'], 'in', round(seconds, 1), 's')
+            except Exception as e:
+                results.append(dict(out_dir=region['out_dir'], status='failed', error=repr(e), log_path=log_path))
+                print('Failed', region['out_dir'], 'see', log_path)
+                traceback.print_exception(type(e), e, e.__traceback__)
+    failed = [result for result in results if result['status'] != 'ok']
+    print('\nStitched', len(results) - len(failed), 'of', len(results), 'regions in', round(time.perf_counter() - start, 1), 's')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stitch many regions with a shared budget of workers and Fiji jobs')
+    parser.add_argument('--batch_file', type=str,
+                        help='json file: {"defaults": {stitch.py arguments}, "regions": [{"img_dirs": [...], "out_dir": ..., ' +
+                             '"best_focus_dir": ..., "submission_file_path": ..., other stitch.py arguments}]}')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='number of workers shared by all regions, default number of cpus')
+    parser.add_argument('--workers_per_stage', type=int, default=4,
+                        help='workers of every projection, registration, fusion or assembly stage')
+    parser.add_argument('--max_fiji_jobs', type=int, default=2, help='max number of Fiji jobs running at the same time')
+    parser.add_argument('--max_parallel_regions', type=int, default=None,
+                        help='max number of regions in progress, default is enough to use all cpu and Fiji slots')
+    parser.add_argument('--results_path', type=str, default=None, help='save status of every region as json')
+    args = parser.parse_args()
+
+    batch_results = run_batch(load_batch_file(args.batch_file), args.num_workers, args.workers_per_stage, args.max_fiji_jobs,
+                              args.max_parallel_regions)
+    if args.results_path is not None:
+        with open(args.results_path, 'w') as f:
+            json.dump(batch_results, f, indent=4)
+    if any(result['status'] != 'ok' for result in batch_results):
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+
+def get_downsampling_factors(width: int, height: int, min_size: int = 256, max_levels: int = 5) -> List[Tuple[int, int, int]]:
+    """ (x, y, z) factors of every resolution level, halved in x and y until the smaller side is below min_size """
+    factors = [(1, 1, 1)]
+    while len(factors) < max_levels and min(width, height) // (factors[-1][0] * 2) >= min_size:
+        f = factors[-1][0] * 2
+        factors.append((f, f, 1))
+    return factors
+
+
+def downsample_2x_mean(img: np.ndarray) -> np.ndarray:
+    h = img.shape[0] // 2 * 2
+    w = img.shape[1] // 2 * 2
+    downsampled = img[:h, :w].astype(np.float32).reshape(h // 2, 2, w // 2, 2).mean(axis=(1, 3))
+    if np.issubdtype(img.dtype, np.integer):
+        np.rint(downsampled, out=downsampled)
+    return downsampled.astype(img.dtype)
+
+
+def to_bdv_dtype(img: np.ndarray) -> np.ndarray:
+    """ BigDataViewer stores uint16 as int16 with the same bits, and supports only 16 bit integers and float32 """
+    if img.dtype == np.uint16:
+        return img.view(np.int16)
+    if img.dtype in (np.int16, np.float32):
+        return img
+    if np.issubdtype(img.dtype, np.integer) and img.dtype.itemsize == 1:
+        return img.astype(np.uint16).view(np.int16)
+    raise ValueError('Data type ' + str(img.dtype) + ' can not be stored in BigDataViewer hdf5')
+
+
+class BdvHdf5Writer:
+    """ Writes 2D tiles as view setups of a BigDataViewer hdf5 file with one timepoint.
+        Every setup gets its own resolution pyramid, datasets are chunked so BigStitcher loads them lazily.
+        Thread-safe, h5py calls are serialized.
+    """
+    def __init__(self, h5_path: str, tile_size: Tuple[int, int], block_size: Tuple[int, int] = (128, 128),
+                 compression: str = None):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('Writing tiles to hdf5 requires h5py, install it with pip install h5py')
+        self.h5_path = h5_path
+        self.factors = get_downsampling_factors(*tile_size)
+        self.block_size = block_size
+        self.compression = compression
+        self._file = h5py.File(h5_path, 'w')
+        self._lock = threading.Lock()
+
+    def write_setup(self, setup_id: int, img: np.ndarray):
+        levels = [img]
+        for _ in self.factors[1:]:
+            levels.append(downsample_2x_mean(levels[-1]))
+        with self._lock:
+            setup_group = 's{s:02d}'.format(s=setup_id)
+            self._file.create_dataset(setup_group + '/resolutions', data=np.array(self.factors, dtype=np.float64))
+            self._file.create_dataset(setup_group + '/subdivisions',
+                                      data=np.array([(self.block_size[1], self.block_size[0], 1)] * len(self.factors), dtype=np.int32))
+            for level, level_img in enumerate(levels):
+                data = to_bdv_dtype(level_img)[np.newaxis, :, :]
+                chunks = (1, min(self.block_size[0], data.shape[1]), min(self.block_size[1], data.shape[2]))
+                self._file.create_dataset('t00000/{g}/{l}/cells'.format(g=setup_group, l=level), data=data,
+                                          chunks=chunks, compression=self.compression)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
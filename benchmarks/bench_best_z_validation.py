@@ -0,0 +1,110 @@
+import argparse
+import os.path as osp
+import sys
+import time
+from typing import List
+
+import numpy as np
+from scipy import interpolate
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from best_z_plane_selection_with_cytokit_info import validate_best_z, arrange_best_z_planes_per_tile
+
+
+def legacy_interpolate_nans(array):
+    x = np.arange(0, array.shape[1])
+    y = np.arange(0, array.shape[0])
+    array = np.ma.masked_invalid(array)
+    xx, yy = np.meshgrid(x, y)
+    x1 = xx[~array.mask]
+    y1 = yy[~array.mask]
+    newarr = array[~array.mask]
+    interpolated = interpolate.griddata((x1, y1), newarr.ravel(), (xx, yy), method='linear')
+    # tiles outside of the convex hull of valid tiles stay NaN
+    with np.errstate(invalid='ignore'):
+        return np.round(interpolated).astype(np.int32)
+
+
+def legacy_validate_best_z(array: np.ndarray):
+    """ Previous implementation: list membership test of outliers and griddata interpolation """
+    hor_diff = np.abs(np.diff(array, axis=1))
+    ver_diff = np.abs(np.diff(array, axis=0))
+    std = np.std(array)
+    hd = np.append(hor_diff, hor_diff[:, -1][:, np.newaxis], axis=1)
+    vd = np.append(ver_diff, ver_diff[-1, :][np.newaxis, :], axis=0)
+    hor_outliers = np.argwhere(hd > std).tolist()
+    ver_outliers = np.argwhere(vd > std).tolist()
+    true_outliers = []
+    for x in hor_outliers:
+        if x in ver_outliers:
+            true_outliers.append(tuple(x))
+    for out_coord in true_outliers:
+        array[out_coord] = np.nan
+    return legacy_interpolate_nans(array)
+
+
+def make_best_z_grid(size: int, outlier_fraction: float, missing_fraction: float, num_zplanes: int = 15) -> np.ndarray:
+    """ Smooth tilted focal surface with random outliers and missing tiles (NaN) """
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:size, 0:size]
+    grid = num_zplanes / 2 + 3 * np.sin(xx / size * np.pi) * np.cos(yy / size * np.pi)
+    grid = np.round(grid)
+    outliers = rng.random(grid.shape) < outlier_fraction
+    grid[outliers] = rng.integers(0, num_zplanes, outliers.sum())
+    grid[rng.random(grid.shape) < missing_fraction] = np.nan
+    return grid
+
+
+def measure(func, grid: np.ndarray, repeats: int):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(grid.copy())
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_plane_selection():
+    """ Selected planes exist when the sharpest plane is the first or the last one """
+    positions = [(0, 0), (0, 1), (1, 1), (1, 0)]
+    for best_z, expected in ((0, [1, 2]), (2, [2, 3]), (1, [1, 2, 3])):
+        selected = arrange_best_z_planes_per_tile([best_z] * 4, positions, [0, 1, 2, 3], [3] * 4)
+        assert all(sorted(planes) == expected for planes in selected.values()), (best_z, selected)
+    single_plane = arrange_best_z_planes_per_tile([0] * 4, positions, [0, 1, 2, 3], [1] * 4)
+    assert all(planes == [1] for planes in single_plane.values()), single_plane
+
+
+def check_missing_tiles():
+    """ Grids with missing tiles, the last row of a snake grid is incomplete """
+    for positions in ([(0, 0), (0, 1), (1, 0)], [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0), (2, 0)]):
+        selected = arrange_best_z_planes_per_tile([1] * len(positions), positions, list(range(len(positions))),
+                                                  [3] * len(positions))
+        assert sorted(selected) == list(range(1, len(positions) + 1)), selected
+
+
+def main(grid_sizes: List[int], outlier_fraction: float, missing_fraction: float, legacy_max_tiles: int, repeats: int):
+    check_plane_selection()
+    check_missing_tiles()
+    print('grid', 'tiles', 'vectorized_s', 'legacy_s', sep='\t')
+    for size in grid_sizes:
+        grid = make_best_z_grid(size, outlier_fraction, missing_fraction)
+        vectorized = measure(validate_best_z, grid, repeats)
+        legacy = '-'
+        if size * size <= legacy_max_tiles:
+            # legacy version does not support missing tiles
+            legacy = '{:.4f}'.format(measure(legacy_validate_best_z, np.nan_to_num(grid), repeats))
+        print('{0}x{0}'.format(size), size * size, '{:.4f}'.format(vectorized), legacy, sep='\t')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare best z-plane validation on growing tile grids')
+    parser.add_argument('--grid_sizes', type=int, nargs='+', default=[10, 50, 100, 200, 400])
+    parser.add_argument('--outlier_fraction', type=float, default=0.05)
+    parser.add_argument('--missing_fraction', type=float, default=0.02)
+    parser.add_argument('--legacy_max_tiles', type=int, default=40000,
+                        help='skip the previous implementation on larger grids')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.grid_sizes, args.outlier_fraction, args.missing_fraction, args.legacy_max_tiles, args.repeats)
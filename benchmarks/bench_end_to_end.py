@@ -0,0 +1,165 @@
+import argparse
+import json
+import multiprocessing
+import os
+import os.path as osp
+import posixpath as px
+import queue as queue_module
+import sys
+import tempfile
+import traceback
+from typing import List
+
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+import stitch
+from bigstitcher_xml import create_dataset, write_xml
+from native_fusion import get_tile_placements
+from phase_correlation_registration import get_tile_file_names, read_tile_size
+from tile_grid import get_snake_grid_positions, get_grid_translations
+from synthetic_dataset import get_default_dataset_options, generate_dataset
+
+
+REPORTED_STAGES = ('listing', 'best_z_selection', 'projection', 'registration', 'fusion', 'assembly')
+
+
+def make_stub_run_bigstitcher(submission_path: str):
+    """ Replacement of stitch.run_bigstitcher that does not start Fiji:
+        dataset.xml of the reference channel is written with tiles at their grid positions.
+        Fusion has to use the python backend, fused images are not produced.
+    """
+    info = stitch.get_values_from_submission_file(stitch.load_submission_file(submission_path))
+
+    def stub_run_bigstitcher(imagej_path: str, bigstitcher_macro_path: str, mem_mb: int = None, expected_outputs: List[str] = None):
+        for path in expected_outputs or []:
+            if not path.endswith('.xml'):
+                raise ValueError('Fiji stub can not produce ' + path)
+            img_dir = px.dirname(path)
+            tile_file_names = get_tile_file_names(info['num_tiles'])
+            tile_size = read_tile_size(px.join(img_dir, tile_file_names[0]))
+            positions = get_snake_grid_positions(info['num_tiles'], info['num_tiles_x'], info['num_tiles_y'])
+            translations = get_grid_translations(positions, tile_size[0], tile_size[1], info['overlap_x'], info['overlap_y'])
+            voxel_size = (info['pixel_distance_x'], info['pixel_distance_y'], info['pixel_distance_z'])
+            write_xml(create_dataset([tile_file_names], tile_size, voxel_size, translations), path)
+    return stub_run_bigstitcher
+
+
+def get_registration_error(dataset_xml_path: str, ground_truth_path: str) -> float:
+    """ Max distance in pixels between registered and true tile positions, both relative to the first tile """
+    with open(ground_truth_path, 'r') as f:
+        ground_truth = json.load(f)
+    placements = get_tile_placements(dataset_xml_path, px.dirname(dataset_xml_path))
+    registered = np.array([p['offset'] for p in placements], dtype=np.float64)
+    true_positions = np.array(ground_truth['grid_translations']) + np.array(ground_truth['true_offsets'])
+    errors = np.hypot(*((registered - registered[0]) - (true_positions - true_positions[0])).T)
+    return float(errors.max())
+
+
+def run_scale(dataset: dict, work_dir: str, registration: str, best_z: str, num_workers: int, parallel_mode: str) -> dict:
+    """ Runs in a fresh process so peak RSS of every scale is measured separately """
+    if registration == 'stub':
+        stitch.run_bigstitcher = make_stub_run_bigstitcher(dataset['submission_path'])
+    out_dir = px.join(work_dir, 'out')
+    cytokit_json_path = dataset['cytokit_json_path'] if best_z == 'cytokit' else None
+    stitch.main(None, dataset['img_dirs'], out_dir, px.join(work_dir, 'best_focus'), cytokit_json_path,
+                dataset['submission_path'], num_workers=num_workers, parallel_mode=parallel_mode,
+                registration_backend='python' if registration == 'python' else 'bigstitcher',
+                fusion_backend='python', assemble=True)
+    report_dir = px.join(out_dir, 'reports')
+    report_path = px.join(report_dir, sorted(os.listdir(report_dir))[-1])
+    with open(report_path, 'r') as f:
+        report = json.load(f)
+    report['registration_error_px'] = get_registration_error(px.join(work_dir, 'best_focus', 'CH001', 'dataset.xml'),
+                                                             dataset['ground_truth_path'])
+    return report
+
+
+def run_scale_in_process(queue, *args):
+    """ Errors are sent to the parent as a report with a traceback, so it does not wait for a report forever """
+    try:
+        queue.put(run_scale(*args))
+    except Exception:
+        queue.put(dict(error=traceback.format_exc()))
+
+
+def wait_for_report(queue, process) -> dict:
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                break
+    try:
+        return queue.get(timeout=1)
+    except queue_module.Empty:
+        raise RuntimeError('Benchmark process exited with code ' + str(process.exitcode) + ' without a report')
+
+
+def summarize(report: dict) -> dict:
+    stage_seconds = {name: 0.0 for name in REPORTED_STAGES}
+    for stage in report['stages']:
+        if stage['name'] in stage_seconds:
+            stage_seconds[stage['name']] += stage['wall_seconds']
+    return dict(stage_seconds=stage_seconds, total_seconds=report['wall_seconds'], peak_rss_mb=report['peak_rss_mb'],
+                registration_error_px=report['registration_error_px'])
+
+
+def parse_scale(scale: str) -> dict:
+    """ GRIDxTILE, e.g. 3x3x512 is a 3x3 grid of 512 px tiles """
+    num_tiles_x, num_tiles_y, tile_size = (int(v) for v in scale.split('x'))
+    return dict(num_tiles_x=num_tiles_x, num_tiles_y=num_tiles_y, tile_width=tile_size, tile_height=tile_size)
+
+
+def main(scales: List[str], num_cycles: int, num_channels: int, num_zplanes: int, registration: str, best_z: str,
+         num_workers: int, parallel_mode: str, results_path: str = None):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for scale in scales:
+        options = get_default_dataset_options()
+        options.update(parse_scale(scale), num_cycles=num_cycles, num_channels=num_channels, num_zplanes=num_zplanes)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = generate_dataset(px.join(tmp_dir, 'raw'), options, num_workers)
+            queue = context.Queue()
+            process = context.Process(target=run_scale_in_process,
+                                      args=(queue, dataset, tmp_dir, registration, best_z, num_workers, parallel_mode))
+            process.start()
+            report = wait_for_report(queue, process)
+            process.join()
+        if 'error' in report:
+            raise RuntimeError('Scale ' + scale + ' failed:\n' + report['error'])
+        results.append(dict(scale=scale, **summarize(report)))
+
+    print('\n{} cycles, {} channels, {} z-planes, registration {}, best z {}, {} workers, {}'.format(
+        num_cycles, num_channels, num_zplanes, registration, best_z, num_workers, parallel_mode))
+    header = ['scale'] + list(REPORTED_STAGES) + ['total, s', 'peak RSS, MB', 'reg. error, px']
+    print(''.join('{:>18}'.format(h) for h in header))
+    for result in results:
+        row = [result['scale']] + ['{:.3f}'.format(result['stage_seconds'][name]) for name in REPORTED_STAGES]
+        row += ['{:.3f}'.format(result['total_seconds']), result['peak_rss_mb'], '{:.1f}'.format(result['registration_error_px'])]
+        print(''.join('{:>18}'.format(str(v)) for v in row))
+    if results_path is not None:
+        with open(results_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and peak memory of all stages on synthetic datasets of growing size, ' +
+                                                 'runs without Fiji')
+    parser.add_argument('--scales', type=str, nargs='+', default=['2x2x512', '3x3x1024', '4x4x2048'],
+                        help='grid width x grid height x tile size')
+    parser.add_argument('--num_cycles', type=int, default=2)
+    parser.add_argument('--num_channels', type=int, default=4)
+    parser.add_argument('--num_zplanes', type=int, default=5)
+    parser.add_argument('--registration', type=str, default='stub', choices=['stub', 'python'],
+                        help='stub replaces Fiji with tiles at grid positions, python uses phase correlation')
+    parser.add_argument('--best_z', type=str, default='cytokit', choices=['cytokit', 'focus_scoring'],
+                        help='best z-planes from the generated data.json or from scoring focus of the images')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--parallel_mode', type=str, default='threads', choices=['threads', 'processes', 'pipeline'])
+    parser.add_argument('--results_path', type=str, default=None, help='save results as json')
+    args = parser.parse_args()
+
+    main(args.scales, args.num_cycles, args.num_channels, args.num_zplanes, args.registration, args.best_z,
+         args.num_workers, args.parallel_mode, args.results_path)
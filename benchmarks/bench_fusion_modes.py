@@ -0,0 +1,56 @@
+import argparse
+import os.path as osp
+import posixpath as px
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from stitch import make_dir_if_not_exists, copy_dataset_xml_to_other_channel_dirs, copy_fuse_macro_to_other_channel_dirs, \
+    run_bigstitcher_for_other_channels, fuse_channels_in_one_session
+
+
+def run_per_channel(imagej_path: str, dataset_xml_path: str, channel_dirs: List[str], stitched_dirs: List[str]):
+    reference_dir = px.dirname(dataset_xml_path)
+    copy_dataset_xml_to_other_channel_dirs(reference_dir, [d for d in channel_dirs if d != reference_dir])
+    macro_paths = copy_fuse_macro_to_other_channel_dirs(channel_dirs, stitched_dirs)
+    run_bigstitcher_for_other_channels(imagej_path, channel_dirs, stitched_dirs, macro_paths)
+
+
+def run_single_session(imagej_path: str, dataset_xml_path: str, channel_dirs: List[str], stitched_dirs: List[str], work_dir: str):
+    fuse_channels_in_one_session(imagej_path, dataset_xml_path, channel_dirs, stitched_dirs, work_dir)
+
+
+def main(imagej_path: str, dataset_xml_path: str, channel_dirs: List[str], out_dir: str):
+    """ Fuses the same channels with both modes, dataset.xml must already be registered """
+    results = []
+    for mode in ('per_channel', 'single_session'):
+        stitched_dirs = [px.join(out_dir, mode, osp.basename(osp.normpath(d))) for d in channel_dirs]
+        for dir_path in stitched_dirs:
+            make_dir_if_not_exists(dir_path)
+        start = time.perf_counter()
+        if mode == 'per_channel':
+            run_per_channel(imagej_path, dataset_xml_path, channel_dirs, stitched_dirs)
+        else:
+            run_single_session(imagej_path, dataset_xml_path, channel_dirs, stitched_dirs, px.join(out_dir, mode, 'multichannel'))
+        elapsed = time.perf_counter() - start
+        num_fused = sum(px.exists(px.join(d, 'fused_tp_0_ch_0.tif')) for d in stitched_dirs)
+        results.append((mode, elapsed, num_fused))
+
+    print('{} channels'.format(len(channel_dirs)))
+    print('{:<18}{:>12}{:>16}'.format('mode', 'time, s', 'fused channels'))
+    for mode, elapsed, num_fused in results:
+        print('{:<18}{:>12.1f}{:>16}'.format(mode, elapsed, num_fused))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imagej_path', type=str, help='path to imagej executable')
+    parser.add_argument('--dataset_xml_path', type=str, help='registered dataset.xml of the reference channel')
+    parser.add_argument('--channel_dirs', type=str, nargs='+', help='dirs with best focus tiles of channels to fuse')
+    parser.add_argument('--out_dir', type=str, help='dir to store fused images of both modes')
+
+    args = parser.parse_args()
+
+    main(args.imagej_path, args.dataset_xml_path, args.channel_dirs, args.out_dir)
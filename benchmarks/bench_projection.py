@@ -0,0 +1,82 @@
+import argparse
+import os
+import os.path as osp
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+import numpy as np
+import tifffile as tif
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from file_manipulation import convert
+from projection import project_planes, rescale_inplace, rescale_with_range_inplace
+
+
+def write_synthetic_stack(out_dir: str, num_planes: int, tile_size: int) -> List[str]:
+    rng = np.random.default_rng(0)
+    paths = []
+    for z in range(num_planes):
+        path = osp.join(out_dir, 'plane_{z:03d}.tif'.format(z=z))
+        tif.imwrite(path, rng.integers(0, 4096, (tile_size, tile_size), dtype=np.uint16))
+        paths.append(path)
+    return paths
+
+
+def stacked_projection(path_list: List[str]):
+    return convert(np.mean(np.stack(list(map(tif.imread, path_list)), axis=0), axis=0), 0, 65535, np.uint16)
+
+
+def streaming_projection(path_list: List[str], method: str):
+    weights = list(range(1, len(path_list) + 1))
+    return rescale_inplace(project_planes(path_list, method, weights), 0, 65535, np.uint16)
+
+
+def fixed_range_projection(path_list: List[str], method: str):
+    """ Rescaling with a precomputed channel range, as with --normalize_intensity channel or percentile """
+    weights = list(range(1, len(path_list) + 1))
+    return rescale_with_range_inplace(project_planes(path_list, method, weights), 100, 4000, 65535, np.uint16)
+
+
+def measure(func, *args, repeats: int = 3):
+    times = []
+    peaks = []
+    for _ in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), max(peaks)
+
+
+def main(tile_size: int, num_planes: int, repeats: int):
+    tile_bytes = tile_size * tile_size * 2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_synthetic_stack(tmp_dir, num_planes, tile_size)
+        cases = [('stack + np.mean (old)', stacked_projection, ()),
+                 ('streaming mean', streaming_projection, ('mean',)),
+                 ('streaming max', streaming_projection, ('max',)),
+                 ('streaming weighted', streaming_projection, ('weighted',)),
+                 ('mean, channel range', fixed_range_projection, ('mean',))]
+
+        print('tile {s}x{s} uint16, {z} z-planes'.format(s=tile_size, z=num_planes))
+        print('{:<24}{:>12}{:>16}{:>14}'.format('method', 'time, s', 'peak mem, MB', 'x tile size'))
+        for name, func, extra_args in cases:
+            t, peak = measure(func, paths, *extra_args, repeats=repeats)
+            print('{:<24}{:>12.3f}{:>16.1f}{:>14.1f}'.format(name, t, peak / 1024 ** 2, peak / tile_bytes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tile_size', type=int, default=2048, help='size of square synthetic tile in pixels')
+    parser.add_argument('--num_planes', type=int, default=3, help='number of z-planes to project')
+    parser.add_argument('--repeats', type=int, default=3, help='number of repeats per method')
+
+    args = parser.parse_args()
+
+    main(args.tile_size, args.num_planes, args.repeats)
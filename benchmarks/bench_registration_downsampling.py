@@ -0,0 +1,74 @@
+import argparse
+import os.path as osp
+import sys
+import time
+from typing import List
+
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from tile_grid import get_snake_grid_positions, get_grid_translations
+from phase_correlation_registration import compute_pairwise_shifts
+
+
+def make_synthetic_tiles(num_tiles_x: int, num_tiles_y: int, tile_size: int, overlap: float, max_jitter: int):
+    """ Tiles cut from one smooth random image at grid positions with random jitter.
+        Returns tiles, grid positions, grid translations and true (x, y) offset of every tile from its grid position.
+    """
+    rng = np.random.default_rng(0)
+    positions = get_snake_grid_positions(num_tiles_x * num_tiles_y, num_tiles_x, num_tiles_y)
+    translations = get_grid_translations(positions, tile_size, tile_size, overlap, overlap)
+    margin = max_jitter + 1
+    width = int(max(t[0] for t in translations)) + tile_size + 2 * margin
+    height = int(max(t[1] for t in translations)) + tile_size + 2 * margin
+    canvas = ndimage.gaussian_filter(rng.random((height, width), dtype=np.float32), 2) * 60000
+    jitter = rng.integers(-max_jitter, max_jitter + 1, (len(positions), 2))
+    tiles = []
+    true_offsets = []
+    for (x, y), (jx, jy) in zip(translations, jitter):
+        x0 = int(round(x)) + margin + jx
+        y0 = int(round(y)) + margin + jy
+        tiles.append(canvas[y0:y0 + tile_size, x0:x0 + tile_size].astype(np.uint16))
+        # tiles are cut at integer positions, grid translations are fractional
+        true_offsets.append((x0 - margin - x, y0 - margin - y))
+    return tiles, positions, translations, np.array(true_offsets)
+
+
+def get_shift_errors(results: List[dict], jitter: np.ndarray) -> np.ndarray:
+    """ Distance between measured and true relative shift of every pair, in full resolution pixels """
+    errors = []
+    for result in results:
+        true_shift = jitter[result['setup_b']] - jitter[result['setup_a']]
+        errors.append(np.hypot(result['shift'][0] - true_shift[0], result['shift'][1] - true_shift[1]))
+    return np.array(errors)
+
+
+def main(num_tiles_x: int, num_tiles_y: int, tile_size: int, overlap: float, max_jitter: int, factors: List[int],
+         num_workers: int):
+    tiles, positions, translations, jitter = make_synthetic_tiles(num_tiles_x, num_tiles_y, tile_size, overlap, max_jitter)
+    print('{}x{} tiles of {} px, {}% overlap, jitter up to {} px'.format(num_tiles_x, num_tiles_y, tile_size, overlap, max_jitter))
+    print('{:<12}{:<8}{:>10}{:>16}{:>16}'.format('downsample', 'refine', 'time, s', 'mean error, px', 'max error, px'))
+    for factor in factors:
+        for refine in ([False, True] if factor > 1 else [True]):
+            start = time.perf_counter()
+            results = compute_pairwise_shifts(list(range(len(tiles))), positions, translations, num_workers,
+                                              read_tile=lambda tile: tiles[tile], downsample=factor, refine=refine)
+            elapsed = time.perf_counter() - start
+            errors = get_shift_errors(results, jitter)
+            print('{:<12}{:<8}{:>10.3f}{:>16.2f}{:>16.2f}'.format(factor, str(refine), elapsed, errors.mean(), errors.max()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and accuracy of pairwise shifts computed on downsampled tiles')
+    parser.add_argument('--num_tiles_x', type=int, default=4)
+    parser.add_argument('--num_tiles_y', type=int, default=4)
+    parser.add_argument('--tile_size', type=int, default=2048)
+    parser.add_argument('--overlap', type=float, default=10, help='overlap in percent')
+    parser.add_argument('--max_jitter', type=int, default=20, help='max random stage error in pixels')
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--num_workers', type=int, default=1)
+    args = parser.parse_args()
+
+    main(args.num_tiles_x, args.num_tiles_y, args.tile_size, args.overlap, args.max_jitter, args.factors, args.num_workers)
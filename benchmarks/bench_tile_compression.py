@@ -0,0 +1,112 @@
+import argparse
+import os
+import os.path as osp
+import posixpath as px
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import tifffile as tif
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from tile_compression import TILE_COMPRESSIONS, FIJI_READABLE_TILE_COMPRESSIONS, is_codec_available, write_tile
+from fiji_scheduler import run_fiji_job
+from synthetic_dataset import SyntheticSample
+
+LOAD_TIME_PATTERN = re.compile(r'^TILE_LOAD_MS (\d+)', re.MULTILINE)
+LOAD_MACRO = """setBatchMode(true);
+paths = newArray({paths});
+start = getTime();
+for (i = 0; i < paths.length; i++) {{
+    run("Bio-Formats Windowless Importer", "open=[" + paths[i] + "]");
+    close();
+}}
+print("TILE_LOAD_MS " + d2s(getTime() - start, 0));
+run("Quit");
+eval("script", "System.exit(0);");
+"""
+
+
+def make_tiles(num_tiles: int, tile_size: int, noise: float) -> List[np.ndarray]:
+    """ Smooth structure with camera noise, noise-free synthetic tiles would compress unrealistically well """
+    rng = np.random.default_rng(0)
+    sample = SyntheticSample(tile_size * num_tiles, tile_size, feature_size=4, rng=rng)
+    tiles = []
+    for i in range(num_tiles):
+        img = sample.get_region(i * tile_size, 0, tile_size, tile_size) * 20000 + rng.normal(500, noise, (tile_size, tile_size))
+        tiles.append(np.clip(img, 0, 65535).astype(np.uint16))
+    return tiles
+
+
+def measure_fiji_load_seconds(imagej_path: str, paths: List[str], work_dir: str) -> float:
+    """ Time to open all tiles with Bio-Formats in one Fiji session, JVM startup is not included """
+    macro_path = px.join(work_dir, 'load_tiles.ijm')
+    with open(macro_path, 'w') as f:
+        f.write(LOAD_MACRO.format(paths=', '.join('"' + path + '"' for path in paths)))
+    log_path = px.join(work_dir, 'load_tiles.log')
+    if not run_fiji_job(imagej_path, dict(name='load_tiles', macro_path=macro_path, log_path=log_path)):
+        return float('nan')
+    with open(log_path, 'r', errors='replace') as f:
+        match = LOAD_TIME_PATTERN.search(f.read())
+    return int(match.group(1)) / 1000 if match else float('nan')
+
+
+def main(num_tiles: int, tile_size: int, noise: float, encode_workers: List[int], compressions: List[str],
+         imagej_path: str = None, out_dir: str = None):
+    tiles = make_tiles(num_tiles, tile_size, noise)
+    raw_bytes = sum(tile.nbytes for tile in tiles)
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    print('{n} tiles {s}x{s} uint16, {mb:.1f} MB uncompressed'.format(n=num_tiles, s=tile_size, mb=raw_bytes / 1024 ** 2))
+    print('{:<10}{:>9}{:>12}{:>8}{:>14}{:>13}{:>15}{:>8}'.format('codec', 'workers', 'MB written', 'ratio', 'encode, MB/s',
+                                                                 'py load, s', 'Fiji load, s', 'Fiji'))
+    try:
+        for compression in compressions:
+            if not is_codec_available(compression):
+                print('{:<10}  skipped, codec is not available (pip install imagecodecs)'.format(compression))
+                continue
+            for workers in encode_workers:
+                case_dir = px.join(tmp_dir, '{c}_{w}'.format(c=compression, w=workers))
+                os.makedirs(case_dir)
+                paths = [px.join(case_dir, 'tile_{i:03d}.tif'.format(i=i)) for i in range(num_tiles)]
+                start = time.perf_counter()
+                for path, tile in zip(paths, tiles):
+                    write_tile(path, tile, compression, workers)
+                encode_seconds = time.perf_counter() - start
+                written = sum(osp.getsize(path) for path in paths)
+
+                start = time.perf_counter()
+                for path, tile in zip(paths, tiles):
+                    assert np.array_equal(tif.imread(path), tile), 'compression is not lossless: ' + path
+                load_seconds = time.perf_counter() - start
+
+                readable = compression in FIJI_READABLE_TILE_COMPRESSIONS
+                fiji_seconds = float('nan')
+                if imagej_path is not None and readable:
+                    fiji_seconds = measure_fiji_load_seconds(imagej_path, paths, case_dir)
+                print('{:<10}{:>9}{:>12.1f}{:>8.2f}{:>14.1f}{:>13.3f}{:>15.3f}{:>8}'.format(
+                    compression, workers, written / 1024 ** 2, raw_bytes / written, raw_bytes / 1024 ** 2 / encode_seconds,
+                    load_seconds, fiji_seconds, 'yes' if readable else 'no'))
+                shutil.rmtree(case_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Size, encode and load time of projected tiles per compression')
+    parser.add_argument('--num_tiles', type=int, default=16)
+    parser.add_argument('--tile_size', type=int, default=2048, help='size of square synthetic tile in pixels')
+    parser.add_argument('--noise', type=float, default=30, help='standard deviation of camera noise')
+    parser.add_argument('--encode_workers', type=int, nargs='+', default=[1, 4], help='threads that encode one tile')
+    parser.add_argument('--compressions', type=str, nargs='+', default=list(TILE_COMPRESSIONS), choices=list(TILE_COMPRESSIONS))
+    parser.add_argument('--imagej_path', type=str, default=None,
+                        help='also measure time to open the tiles with Bio-Formats in Fiji')
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help='dir for the written tiles, put it on the storage used for best_focus_dir, default temp dir')
+    args = parser.parse_args()
+
+    main(args.num_tiles, args.tile_size, args.noise, args.encode_workers, args.compressions, args.imagej_path, args.out_dir)
@@ -0,0 +1,51 @@
+import argparse
+import json
+import re
+import sys
+import time
+
+
+STEP_PATTERN = re.compile(r'print\("STEP_TIMING (\w+) start')
+
+
+def run_job(job: dict, job_seconds: float, create_outputs: bool):
+    """ Writes STEP_TIMING lines of every step in the macro to the job log as Fiji would, optionally creates empty outputs """
+    with open(job['macro_path'], 'r') as f:
+        steps = STEP_PATTERN.findall(f.read())
+    with open(job['log_path'], 'a') as log:
+        for step in steps:
+            log.write('STEP_TIMING {s} start {t}\n'.format(s=step, t=int(time.time() * 1000)))
+            time.sleep(job_seconds / max(1, len(steps)))
+            log.write('STEP_TIMING {s} end {t}\n'.format(s=step, t=int(time.time() * 1000)))
+    if create_outputs:
+        for path in job.get('expected_outputs', []):
+            open(path, 'a').close()
+    return 'ok'
+
+
+def main(startup_seconds: float, job_seconds: float, create_outputs: bool):
+    """ Speaks the protocol of fiji_worker.groovy on stdin and stdout, so the Fiji pool can be run without Fiji """
+    time.sleep(startup_seconds)
+    print('FIJI_WORKER_READY', flush=True)
+    for line in sys.stdin:
+        parts = line.rstrip('\n').split('\t', 1)
+        if parts[0] == 'QUIT':
+            break
+        if parts[0] != 'RUN':
+            continue
+        try:
+            status = run_job(json.loads(parts[1]), job_seconds, create_outputs)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            status = 'error'
+        print('FIJI_WORKER_DONE\t' + status, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stands in for a Fiji worker of fiji_pool.py in tests and benchmarks')
+    parser.add_argument('--startup_seconds', type=float, default=0, help='simulated JVM startup time')
+    parser.add_argument('--job_seconds', type=float, default=0, help='simulated time of every job')
+    parser.add_argument('--create_outputs', action='store_true', help='create empty expected outputs of every job')
+    args = parser.parse_args()
+
+    main(args.startup_seconds, args.job_seconds, args.create_outputs)
@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import os.path as osp
+import posixpath as px
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+import tifffile as tif
+from scipy import ndimage
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from tile_grid import get_snake_grid_positions, get_grid_translations
+
+
+def get_default_dataset_options() -> dict:
+    """ Grid is arranged like BigStitcher's [Snake: Right & Down], overlap is in percent,
+        max_jitter is the max stage error in pixels added to every tile position
+    """
+    return dict(num_tiles_x=3, num_tiles_y=3, tile_width=512, tile_height=512, overlap=10,
+                num_cycles=2, num_channels=4, num_zplanes=5, max_jitter=10, feature_size=4, seed=0)
+
+
+def get_cycle_dir_name(cycle: int, region: int = 1) -> str:
+    return 'cyc{c:03d}_reg{r:03d}'.format(c=cycle, r=region)
+
+
+def get_channel_names(num_cycles: int, num_channels: int) -> List[str]:
+    """ DAPI is the first channel of every cycle, like in CODEX experiments """
+    names = []
+    for cycle in range(1, num_cycles + 1):
+        names.append('DAPI')
+        names.extend('Marker_{c}_{ch}'.format(c=cycle, ch=ch) for ch in range(2, num_channels + 1))
+    return names
+
+
+class SyntheticSample:
+    """ Smooth random structure defined at every pixel of the whole sample,
+        so overlapping tiles see exactly the same pixels.
+        Only a grid downsampled by feature_size is kept in memory.
+    """
+    def __init__(self, width: int, height: int, feature_size: int, rng: np.random.Generator):
+        self.feature_size = feature_size
+        coarse = rng.random((height // feature_size + 4, width // feature_size + 4)).astype(np.float32)
+        self.coefficients = ndimage.spline_filter(coarse, order=3)
+
+    def get_region(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        ys, xs = np.meshgrid((np.arange(y, y + height) + 0.5) / self.feature_size,
+                             (np.arange(x, x + width) + 0.5) / self.feature_size, indexing='ij')
+        return ndimage.map_coordinates(self.coefficients, [ys, xs], order=3, prefilter=False)
+
+
+def get_best_z_per_tile(positions: List[tuple], num_zplanes: int, rng: np.random.Generator) -> List[int]:
+    """ Zero based best z-plane of every tile, changes smoothly over the grid like a tilted sample """
+    if num_zplanes == 1:
+        return [0] * len(positions)
+    tilt_y, tilt_x = rng.uniform(-0.5, 0.5, 2)
+    center = (num_zplanes - 1) / 2
+    best_z = []
+    for row, col in positions:
+        z = center + tilt_y * row + tilt_x * col + rng.normal(0, 0.3)
+        best_z.append(int(np.clip(np.round(z), 0, num_zplanes - 1)))
+    return best_z
+
+
+def get_focus_scores(best_z: int, num_zplanes: int) -> List[float]:
+    return [float(np.exp(-0.5 * (z - best_z) ** 2)) for z in range(num_zplanes)]
+
+
+def write_tile(cycle_dir: str, tile: int, img: np.ndarray, best_z: int, options: dict, cycle: int):
+    """ All z-planes and channels of one tile, planes are more blurred the further they are from best_z """
+    for channel in range(1, options['num_channels'] + 1):
+        # channels differ by brightness and by the structure they highlight
+        gain = 20000 + 8000 * (channel - 1) + 2000 * (cycle - 1)
+        channel_img = img if channel % 2 == 1 else 1 - img
+        for z in range(options['num_zplanes']):
+            sigma = abs(z - best_z) * 1.5
+            plane = ndimage.gaussian_filter(channel_img, sigma) if sigma > 0 else channel_img
+            plane = np.clip(plane * gain, 0, 65535).astype(np.uint16)
+            file_name = '1_{t:05d}_Z{z:03d}_CH{c}.tif'.format(t=tile, z=z + 1, c=channel)
+            tif.imwrite(px.join(cycle_dir, file_name), plane)
+
+
+def make_submission(options: dict) -> dict:
+    """ Fields of Cytokit experiment.json used by the stitching scripts """
+    return dict(numCycles=options['num_cycles'],
+                numChannels=options['num_channels'],
+                numTiles=options['num_tiles_x'] * options['num_tiles_y'],
+                numZPlanes=options['num_zplanes'],
+                regionWidth=options['num_tiles_x'],
+                regionHeight=options['num_tiles_y'],
+                tileWidth=options['tile_width'],
+                tileHeight=options['tile_height'],
+                tileOverlapX=options['overlap'],
+                tileOverlapY=options['overlap'],
+                xyResolution=0.377,
+                zPitch=1.5,
+                bestFocusReferenceCycle=1,
+                bestFocusReferenceChannel=1,
+                channelNames=dict(channelNamesArray=get_channel_names(options['num_cycles'], options['num_channels'])))
+
+
+def generate_dataset(out_dir: str, options: dict = None, num_workers: int = 1) -> dict:
+    """ Writes a Cytokit-style dataset to out_dir:
+        cycle dirs with 1_{tile:05d}_Z{z:03d}_CH{c}.tif, submission.json, data.json with focal_plane_selector
+        and ground_truth.json with the true (x, y) offset of every tile from its grid position and its best z-plane.
+        Returns paths of the generated files.
+    """
+    if options is None:
+        options = get_default_dataset_options()
+    rng = np.random.default_rng(options['seed'])
+    num_tiles = options['num_tiles_x'] * options['num_tiles_y']
+    tile_width = options['tile_width']
+    tile_height = options['tile_height']
+    max_jitter = options['max_jitter']
+
+    positions = get_snake_grid_positions(num_tiles, options['num_tiles_x'], options['num_tiles_y'])
+    translations = get_grid_translations(positions, tile_width, tile_height, options['overlap'], options['overlap'])
+    jitter = rng.integers(-max_jitter, max_jitter + 1, (num_tiles, 2)) if max_jitter > 0 else np.zeros((num_tiles, 2), dtype=int)
+    best_z = get_best_z_per_tile(positions, options['num_zplanes'], rng)
+
+    margin = max_jitter + 1
+    width = int(max(t[0] for t in translations)) + tile_width + 2 * margin
+    height = int(max(t[1] for t in translations)) + tile_height + 2 * margin
+    sample = SyntheticSample(width, height, options['feature_size'], rng)
+
+    # tiles are cut at integer positions, grid translations can be fractional
+    tile_origins = [(int(round(x)) + margin + jx, int(round(y)) + margin + jy) for (x, y), (jx, jy) in zip(translations, jitter)]
+    true_offsets = [[x0 - margin - x, y0 - margin - y] for (x0, y0), (x, y) in zip(tile_origins, translations)]
+
+    img_dirs = []
+    for cycle in range(1, options['num_cycles'] + 1):
+        cycle_dir = px.join(out_dir, get_cycle_dir_name(cycle))
+        os.makedirs(cycle_dir, exist_ok=True)
+        img_dirs.append(cycle_dir)
+
+    def write_all_cycles(tile):
+        x0, y0 = tile_origins[tile]
+        img = sample.get_region(x0, y0, tile_width, tile_height)
+        for cycle, cycle_dir in enumerate(img_dirs, 1):
+            write_tile(cycle_dir, tile + 1, img, best_z[tile], options, cycle)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        list(executor.map(write_all_cycles, range(num_tiles)))
+
+    submission_path = px.join(out_dir, 'submission.json')
+    with open(submission_path, 'w') as f:
+        json.dump(make_submission(options), f, indent=4)
+
+    # tile_index and best_z are zero based as in Cytokit
+    focal_plane_selector = [dict(tile_index=tile, tile_x=col, tile_y=row, best_z=best_z[tile],
+                                 scores=get_focus_scores(best_z[tile], options['num_zplanes']))
+                            for tile, (row, col) in enumerate(positions)]
+    cytokit_json_path = px.join(out_dir, 'data.json')
+    with open(cytokit_json_path, 'w') as f:
+        json.dump(dict(focal_plane_selector=focal_plane_selector), f)
+
+    ground_truth_path = px.join(out_dir, 'ground_truth.json')
+    with open(ground_truth_path, 'w') as f:
+        json.dump(dict(options=options, grid_translations=translations, true_offsets=true_offsets, best_z=best_z), f, indent=4)
+
+    return dict(img_dirs=img_dirs, submission_path=submission_path, cytokit_json_path=cytokit_json_path,
+                ground_truth_path=ground_truth_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic Cytokit-style dataset with known tile offsets and best z-planes')
+    parser.add_argument('--out_dir', type=str, help='dir to write the dataset to')
+    defaults = get_default_dataset_options()
+    for key, value in defaults.items():
+        parser.add_argument('--' + key, type=type(value), default=value)
+    parser.add_argument('--num_workers', type=int, default=1)
+    args = parser.parse_args()
+
+    dataset_options = {key: getattr(args, key) for key in defaults}
+    paths = generate_dataset(args.out_dir, dataset_options, args.num_workers)
+    print(json.dumps(paths, indent=4))
@@ -6,72 +6,77 @@ import re
 import json
 
 import numpy as np
-from scipy import interpolate
 
 
-def interpolate_nans(array):
-    x = np.arange(0, array.shape[1])
-    y = np.arange(0, array.shape[0])
-    # mask invalid values
-    array = np.ma.masked_invalid(array)
-    xx, yy = np.meshgrid(x, y)
-    # get only the valid values
-    x1 = xx[~array.mask]
-    y1 = yy[~array.mask]
-    newarr = array[~array.mask]
-
-    interpolated = interpolate.griddata((x1, y1), newarr.ravel(),
-                                        (xx, yy), method='linear')
-
-    return np.round(interpolated).astype(np.int32)
+def get_neighbour_shifts(array: np.ndarray) -> np.ndarray:
+    """ Stack of the array shifted to each of its 8 neighbours, NaN outside of the grid """
+    padded = np.pad(array, 1, mode='constant', constant_values=np.nan)
+    h, w = array.shape
+    return np.stack([padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+                     for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dy, dx) != (0, 0)])
+
+
+def interpolate_nans(array: np.ndarray) -> np.ndarray:
+    """ Every NaN gets the median of valid tiles around it, repeated until all NaNs are filled,
+        so gaps larger than one tile are filled from their border inwards
+    """
+    array = array.astype(np.float64, copy=True)
+    if np.isnan(array).all():
+        raise ValueError('There are no valid best z-planes to interpolate from')
+    while True:
+        nan_mask = np.isnan(array)
+        if not nan_mask.any():
+            break
+        neighbours = get_neighbour_shifts(array)[:, nan_mask]
+        has_valid = ~np.isnan(neighbours).all(axis=0)
+        fill = np.full(neighbours.shape[1], np.nan)
+        fill[has_valid] = np.nanmedian(neighbours[:, has_valid], axis=0)
+        array[nan_mask] = fill
+    return np.round(array).astype(np.int32)
+
+
+def get_neighbour_diff(array: np.ndarray, axis: int) -> np.ndarray:
+    """ Absolute difference to the next tile along axis, to the previous one if there is no next tile.
+        NaN if there are no neighbours along axis.
+    """
+    if array.shape[axis] == 1:
+        return np.full(array.shape, np.nan)
+    diff = np.abs(np.diff(array, axis=axis))
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (0, 1)
+    forward = np.pad(diff, pad, mode='constant', constant_values=np.nan)
+    pad[axis] = (1, 0)
+    backward = np.pad(diff, pad, mode='constant', constant_values=np.nan)
+    return np.where(np.isnan(forward), backward, forward)
 
 
 def validate_best_z(array: np.ndarray):
-
-    hor_diff = np.abs(np.diff(array, axis=1))
-    ver_diff = np.abs(np.diff(array, axis=0))
-    std = np.std(array)
-    hd = np.append(hor_diff, hor_diff[:, -1][:, np.newaxis], axis=1)
-    vd = np.append(ver_diff, ver_diff[-1, :][np.newaxis, :], axis=0)
-
-    # coordinates of outliers
-    hor_outliers = np.argwhere(hd > std).tolist()
-    ver_outliers = np.argwhere(vd > std).tolist()
-
-    # true outlier if it is outlier in both x and y direction
-    true_outliers = []
-    for x in hor_outliers:
-        if x in ver_outliers:
-            true_outliers.append(tuple(x))
-
-    for out_coord in true_outliers:
-        array[out_coord] = np.nan
-
+    """ array has NaN for missing tiles. A tile is an outlier if it differs from its neighbours
+        by more than the std of the grid in both x and y, outliers and missing tiles are interpolated.
+    """
+    array = np.array(array, dtype=np.float64)
+    std = np.nanstd(array)
+    hd = get_neighbour_diff(array, axis=1)
+    vd = get_neighbour_diff(array, axis=0)
+
+    # in a single row or column only one direction can be checked
+    hor_outliers = hd > std if array.shape[1] > 1 else np.ones(array.shape, dtype=bool)
+    ver_outliers = vd > std if array.shape[0] > 1 else np.ones(array.shape, dtype=bool)
+    true_outliers = hor_outliers & ver_outliers
+    if array.size == 1 or true_outliers.sum() == (~np.isnan(array)).sum():
+        # without tiles that agree with their neighbours there is nothing to interpolate from
+        true_outliers[:] = False
+
+    array[true_outliers] = np.nan
     result = interpolate_nans(array)
     return result
 
 
 def pick_z_planes_below_and_above(best_z: int, max_z: int, above: int, below: int):
-    above_check = best_z + above - max_z
-    if above_check > 0:
-        above -= above_check
-
-    below_check = best_z - below
-    if below_check < 0:
-        below += below_check
-
-    if max_z == 1:
-        return [best_z]
-    elif best_z == max_z:
-        below_planes = [best_z - i for i in range(1, below + 1)]
-        above_planes = []
-    elif best_z == 0:
-        below_planes = []
-        above_planes = [best_z + i for i in range(1, above + 1)]
-    else:
-        below_planes = [best_z - i for i in range(1, below + 1)]
-        above_planes = [best_z + i for i in range(1, above + 1)]
-
+    """ Zero based best_z and up to below and above neighbouring planes, max_z is the index of the last plane """
+    best_z = int(min(max(best_z, 0), max_z))
+    below_planes = [best_z - i for i in range(1, below + 1) if best_z - i >= 0]
+    above_planes = [best_z + i for i in range(1, above + 1) if best_z + i <= max_z]
     return below_planes + [best_z] + above_planes
 
 
@@ -90,9 +95,14 @@ def get_info_about_best_focal_plane_per_tile(path_to_json: str):
         tile_ids.append(tile['tile_index'])
         num_zplanes_per_tile.append(len(tile['scores']))
 
-    max_position = max(tile_positions)
-    array_shape = (max_position[0] + 1, max_position[1] + 1)
-    best_z_per_tile_array = np.zeros(array_shape)
+    return arrange_best_z_planes_per_tile(best_z_planes, tile_positions, tile_ids, num_zplanes_per_tile)
+
+
+def arrange_best_z_planes_per_tile(best_z_planes: List[int], tile_positions: List[Tuple[int, int]], tile_ids: List[int],
+                                   num_zplanes_per_tile: List[int]) -> Dict[int, List[int]]:
+    """ best_z_planes and tile_ids start from 0, tile_positions are (row, col) in the grid """
+    array_shape = (max(row for row, col in tile_positions) + 1, max(col for row, col in tile_positions) + 1)
+    best_z_per_tile_array = np.full(array_shape, np.nan)
 
     for i, tile in enumerate(tile_positions):
         best_z_per_tile_array[tile] = best_z_planes[i]
@@ -102,13 +112,26 @@ def get_info_about_best_focal_plane_per_tile(path_to_json: str):
     best_z_planes_per_tile = dict()
     for i, tile_id in enumerate(tile_ids):
         best_z = valid_best_z_array[tile_positions[i]]
-        top_best_z = pick_z_planes_below_and_above(best_z, num_zplanes_per_tile[i], 1, 1)
+        top_best_z = pick_z_planes_below_and_above(best_z, num_zplanes_per_tile[i] - 1, 1, 1)
         top_best_z = [i + 1 for i in top_best_z]
         best_z_planes_per_tile[tile_id + 1] = top_best_z
 
     return best_z_planes_per_tile
 
 
+def get_focus_scores_per_tile(path_to_json: str) -> Dict[int, Dict[int, float]]:
+    with open(path_to_json, 'r') as stream:
+        json_file = json.load(stream)
+
+    # {tile_id: {z_plane_id: score}}, both start from 1
+    focus_scores_per_tile = dict()
+    for tile in json_file['focal_plane_selector']:
+        scores = {z + 1: score for z, score in enumerate(tile['scores'])}
+        focus_scores_per_tile[tile['tile_index'] + 1] = scores
+
+    return focus_scores_per_tile
+
+
 def change_image_file_name(original_name: str) -> str:
 
     sub_z = re.sub(r'Z\d{3}', 'Z001', original_name)
@@ -146,20 +169,25 @@ def select_best_z_planes(img_dir: str, out_dir: str, channel_names: List[str], c
     return best_z_plane_paths
 
 
-def select_best_z_planes_in_this_channel(channel_paths: dict, out_dir: str, best_z_plane_per_tile: dict):
+def select_best_z_planes_in_this_channel(tiles: np.ndarray, zplanes: np.ndarray, paths: np.ndarray, out_dir: str,
+                                         best_z_plane_per_tile: dict, focus_scores_per_tile: dict = None):
+    """ tiles, zplanes and tile x z-plane paths of one channel from DatasetIndex.get_zplane_table """
     best_z_plane_paths = list()
-    for tile in channel_paths:
-        this_tile_paths = channel_paths[tile]
+    column_per_zplane = {z: i for i, z in enumerate(zplanes.tolist())}
+    for tile, tile_paths in zip(tiles.tolist(), paths.tolist()):
         best_focal_plane_ids = best_z_plane_per_tile[tile]
-
-        full_input_paths = []
-        for _id in best_focal_plane_ids:
-            full_input_paths.append(this_tile_paths[_id])
+        full_input_paths = [tile_paths[column_per_zplane[_id]] if _id in column_per_zplane else '' for _id in best_focal_plane_ids]
+        if '' in full_input_paths:
+            raise ValueError('Tile ' + str(tile) + ' has no z-planes ' + str(best_focal_plane_ids) + ' for ' + out_dir)
         file_name = osp.basename(full_input_paths[0])
 
         output_file_name = change_image_file_name(file_name)
         full_output_path = px.join(out_dir, output_file_name)
 
-        best_z_plane_paths.append( (full_input_paths, full_output_path) )
+        weights = None
+        if focus_scores_per_tile is not None:
+            weights = [focus_scores_per_tile[tile][_id] for _id in best_focal_plane_ids]
+
+        best_z_plane_paths.append( (full_input_paths, full_output_path, weights) )
 
     return best_z_plane_paths
@@ -0,0 +1,292 @@
+import os.path as osp
+import copy
+from typing import List, Dict, Tuple
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+
+def affine_to_string(affine: np.ndarray) -> str:
+    return ' '.join(repr(float(v)) for v in np.asarray(affine, dtype=np.float64)[:3, :].ravel())
+
+
+def string_to_affine(text: str) -> np.ndarray:
+    values = [float(v) for v in text.split()]
+    affine = np.eye(4)
+    affine[:3, :] = np.array(values).reshape(3, 4)
+    return affine
+
+
+def translation_affine(x: float, y: float, z: float = 0.0) -> np.ndarray:
+    affine = np.eye(4)
+    affine[:3, 3] = (x, y, z)
+    return affine
+
+
+def scale_affine(x: float, y: float, z: float) -> np.ndarray:
+    return np.diag([x, y, z, 1.0])
+
+
+def add_text_element(parent: ET.Element, tag: str, text, **attrib) -> ET.Element:
+    el = ET.SubElement(parent, tag, **attrib)
+    el.text = str(text)
+    return el
+
+
+def get_setup_id(channel_index: int, tile: int, num_tiles: int) -> int:
+    return channel_index * num_tiles + tile
+
+
+def create_image_loader(sequence: ET.Element, tile_paths_per_channel: List[List[str]]):
+    loader = ET.SubElement(sequence, 'ImageLoader', format='spimreconstruction.filemap2')
+    add_text_element(loader, 'imglib2container', 'ArrayImgFactory')
+    add_text_element(loader, 'ZGrouped', 'false')
+    files = ET.SubElement(loader, 'files')
+    num_tiles = len(tile_paths_per_channel[0])
+    for c, tile_paths in enumerate(tile_paths_per_channel):
+        for tile, path in enumerate(tile_paths):
+            mapping = ET.SubElement(files, 'FileMapping', view_setup=str(get_setup_id(c, tile, num_tiles)),
+                                    timepoint='0', series='0', channel='0')
+            path_type = 'absolute' if osp.isabs(path) else 'relative'
+            add_text_element(mapping, 'file', path, type=path_type)
+
+
+def create_hdf5_image_loader(sequence: ET.Element, h5_path: str):
+    loader = ET.SubElement(sequence, 'ImageLoader', format='bdv.hdf5')
+    path_type = 'absolute' if osp.isabs(h5_path) else 'relative'
+    add_text_element(loader, 'hdf5', h5_path, type=path_type)
+
+
+def create_dataset(tile_paths_per_channel: List[List[str]], tile_size: Tuple[int, int],
+                   voxel_size: Tuple[float, float, float], grid_translations: List[Tuple[float, float]],
+                   unit: str = 'um', channel_names: List[str] = None, h5_path: str = None) -> ET.Element:
+    """ SpimData with one view setup per tile and channel, one timepoint, illumination and angle.
+        Tile paths are relative to the location of the xml file, or absolute.
+        If h5_path is given, images are loaded from BigDataViewer hdf5 instead of tile files.
+    """
+    num_tiles = len(tile_paths_per_channel[0])
+    num_channels = len(tile_paths_per_channel)
+    if channel_names is None:
+        channel_names = [str(c) for c in range(0, num_channels)]
+
+    root = ET.Element('SpimData', version='0.2')
+    add_text_element(root, 'BasePath', '.', type='relative')
+    sequence = ET.SubElement(root, 'SequenceDescription')
+    if h5_path is not None:
+        create_hdf5_image_loader(sequence, h5_path)
+    else:
+        create_image_loader(sequence, tile_paths_per_channel)
+
+    view_setups = ET.SubElement(sequence, 'ViewSetups')
+    width, height = tile_size
+    for c in range(0, num_channels):
+        for tile in range(0, num_tiles):
+            setup_id = get_setup_id(c, tile, num_tiles)
+            setup = ET.SubElement(view_setups, 'ViewSetup')
+            add_text_element(setup, 'id', setup_id)
+            add_text_element(setup, 'name', setup_id)
+            add_text_element(setup, 'size', '{w} {h} 1'.format(w=width, h=height))
+            voxel = ET.SubElement(setup, 'voxelSize')
+            add_text_element(voxel, 'unit', unit)
+            add_text_element(voxel, 'size', ' '.join(str(v) for v in voxel_size))
+            attributes = ET.SubElement(setup, 'attributes')
+            add_text_element(attributes, 'illumination', 0)
+            add_text_element(attributes, 'channel', c)
+            add_text_element(attributes, 'tile', tile)
+            add_text_element(attributes, 'angle', 0)
+
+    for attribute_name, tag, names in (('illumination', 'Illumination', ['0']),
+                                       ('channel', 'Channel', channel_names),
+                                       ('tile', 'Tile', [str(t + 1) for t in range(0, num_tiles)]),
+                                       ('angle', 'Angle', ['0'])):
+        attributes = ET.SubElement(view_setups, 'Attributes', name=attribute_name)
+        for i, name in enumerate(names):
+            el = ET.SubElement(attributes, tag)
+            add_text_element(el, 'id', i)
+            add_text_element(el, 'name', name)
+
+    timepoints = ET.SubElement(sequence, 'Timepoints', type='pattern')
+    add_text_element(timepoints, 'integerpattern', 0)
+    ET.SubElement(sequence, 'MissingViews')
+
+    registrations = ET.SubElement(root, 'ViewRegistrations')
+    min_voxel = min(voxel_size)
+    calibration = scale_affine(*[v / min_voxel for v in voxel_size])
+    for c in range(0, num_channels):
+        for tile in range(0, num_tiles):
+            registration = ET.SubElement(registrations, 'ViewRegistration', timepoint='0',
+                                         setup=str(get_setup_id(c, tile, num_tiles)))
+            x, y = grid_translations[tile]
+            for name, affine in (('Translation to Regular Grid', translation_affine(x, y)),
+                                 ('calibration', calibration)):
+                transform = ET.SubElement(registration, 'ViewTransform', type='affine')
+                add_text_element(transform, 'Name', name)
+                add_text_element(transform, 'affine', affine_to_string(affine))
+
+    ET.SubElement(root, 'ViewInterestPoints')
+    ET.SubElement(root, 'BoundingBoxes')
+    ET.SubElement(root, 'PointSpreadFunctions')
+    ET.SubElement(root, 'StitchingResults')
+    ET.SubElement(root, 'IntensityAdjustments')
+    return root
+
+
+def read_xml(path: str) -> ET.Element:
+    return ET.parse(path).getroot()
+
+
+def write_xml(root: ET.Element, path: str):
+    tree = ET.ElementTree(root)
+    if hasattr(ET, 'indent'):
+        ET.indent(tree, space='  ')
+    tree.write(path, encoding='UTF-8', xml_declaration=True)
+
+
+def get_view_setup_ids(root: ET.Element) -> List[int]:
+    return [int(setup.find('id').text) for setup in root.iter('ViewSetup')]
+
+
+def get_view_setup_sizes(root: ET.Element) -> Dict[int, Tuple[int, ...]]:
+    """ {setup: (x, y, z)} """
+    sizes = dict()
+    for setup in root.iter('ViewSetup'):
+        sizes[int(setup.find('id').text)] = tuple(int(v) for v in setup.find('size').text.split())
+    return sizes
+
+
+def get_view_setup_attributes(root: ET.Element) -> Dict[int, Dict[str, int]]:
+    attributes = dict()
+    for setup in root.iter('ViewSetup'):
+        setup_id = int(setup.find('id').text)
+        attributes[setup_id] = {el.tag: int(el.text) for el in setup.find('attributes')}
+    return attributes
+
+
+def get_file_mappings(root: ET.Element) -> Dict[int, str]:
+    """ {setup: file path} of Bio-Formats based datasets, relative paths are kept relative """
+    mappings = dict()
+    loader = root.find('SequenceDescription').find('ImageLoader')
+    for mapping in loader.iter('FileMapping'):
+        mappings[int(mapping.get('view_setup'))] = mapping.find('file').text
+    return mappings
+
+
+def get_voxel_size(root: ET.Element) -> Tuple[Tuple[float, ...], str]:
+    """ Voxel size and unit of the first view setup """
+    voxel = next(root.iter('ViewSetup')).find('voxelSize')
+    return tuple(float(v) for v in voxel.find('size').text.split()), voxel.find('unit').text
+
+
+def create_multichannel_dataset(reference_root: ET.Element, channel_dirs: List[str], xml_dir: str,
+                                channel_names: List[str] = None) -> ET.Element:
+    """ Same tiles and registration as the single channel reference dataset,
+        repeated for every channel dir. Tile paths are relative to xml_dir.
+    """
+    file_mappings = get_file_mappings(reference_root)
+    sizes = get_view_setup_sizes(reference_root)
+    setups = sorted(file_mappings)
+    file_names = [osp.basename(file_mappings[setup]) for setup in setups]
+    tile_size = sizes[setups[0]][:2]
+    voxel_size, unit = get_voxel_size(reference_root)
+
+    tile_paths_per_channel = [[osp.relpath(osp.join(channel_dir, file_name), xml_dir) for file_name in file_names]
+                              for channel_dir in channel_dirs]
+    root = create_dataset(tile_paths_per_channel, tile_size, voxel_size, [(0, 0)] * len(setups), unit, channel_names)
+    copy_reference_registrations(root, reference_root)
+    return root
+
+
+def copy_reference_registrations(root: ET.Element, reference_root: ET.Element):
+    """ Every channel of a tile gets the view transforms of the same tile of the single channel reference dataset """
+    reference_registrations = get_view_registrations(reference_root)
+    reference_setups = sorted(reference_registrations)
+    num_tiles = len(reference_setups)
+    for setup, registration in get_view_registrations(root).items():
+        for transform in registration.findall('ViewTransform'):
+            registration.remove(transform)
+        for transform in reference_registrations[reference_setups[setup % num_tiles]].findall('ViewTransform'):
+            registration.append(copy.deepcopy(transform))
+
+
+def get_view_registrations(root: ET.Element) -> Dict[int, ET.Element]:
+    return {int(registration.get('setup')): registration for registration in root.find('ViewRegistrations')}
+
+
+def get_view_transforms(root: ET.Element) -> Dict[int, np.ndarray]:
+    """ {setup: 4x4 affine} of all view transforms composed, the first listed transform is applied last """
+    transforms = dict()
+    for registration in root.find('ViewRegistrations'):
+        model = np.eye(4)
+        for transform in registration.findall('ViewTransform'):
+            model = model @ string_to_affine(transform.find('affine').text)
+        transforms[int(registration.get('setup'))] = model
+    return transforms
+
+
+def prepend_view_transform(registration: ET.Element, name: str, affine: np.ndarray):
+    """ New transform is applied after all existing ones """
+    transform = ET.Element('ViewTransform', type='affine')
+    add_text_element(transform, 'Name', name)
+    add_text_element(transform, 'affine', affine_to_string(affine))
+    registration.insert(0, transform)
+
+
+def remove_view_transforms(root: ET.Element, name: str):
+    for registration in root.find('ViewRegistrations'):
+        for transform in registration.findall('ViewTransform'):
+            if transform.find('Name').text == name:
+                registration.remove(transform)
+
+
+def set_bounding_boxes(root: ET.Element, boxes: List[Tuple[str, Tuple[int, ...], Tuple[int, ...]]]):
+    """ boxes: [(name, (min_x, min_y, min_z), (max_x, max_y, max_z))] in global coordinates, max is inclusive.
+        Replaces all bounding boxes defined before.
+    """
+    bounding_boxes = root.find('BoundingBoxes')
+    if bounding_boxes is None:
+        bounding_boxes = ET.SubElement(root, 'BoundingBoxes')
+    for child in list(bounding_boxes):
+        bounding_boxes.remove(child)
+    for name, box_min, box_max in boxes:
+        definition = ET.SubElement(bounding_boxes, 'BoundingBoxDefinition', name=name)
+        add_text_element(definition, 'min', ' '.join(str(int(v)) for v in box_min))
+        add_text_element(definition, 'max', ' '.join(str(int(v)) for v in box_max))
+
+
+def set_pairwise_results(root: ET.Element, results: List[dict]):
+    """ results: [dict(setup_a, setup_b, shift=(x, y, z), correlation)] """
+    stitching_results = root.find('StitchingResults')
+    if stitching_results is None:
+        stitching_results = ET.SubElement(root, 'StitchingResults')
+    for child in list(stitching_results):
+        stitching_results.remove(child)
+
+    for result in results:
+        pairwise = ET.SubElement(stitching_results, 'PairwiseResult',
+                                 view_setups_a=str(result['setup_a']), view_setups_b=str(result['setup_b']),
+                                 timepoints_a='0', timepoints_b='0')
+        add_text_element(pairwise, 'shift', affine_to_string(translation_affine(*result['shift'])))
+        add_text_element(pairwise, 'correlation', repr(float(result['correlation'])))
+        add_text_element(pairwise, 'hash', '0.0')
+
+
+def get_pairwise_results(root: ET.Element) -> List[dict]:
+    """ Reads pairwise shifts written by set_pairwise_results or by BigStitcher.
+        Groups of views are represented by their first view.
+    """
+    results = []
+    stitching_results = root.find('StitchingResults')
+    if stitching_results is None:
+        return results
+
+    def first_id(value: str) -> int:
+        return int(value.replace(';', ',').split(',')[0])
+
+    for pairwise in stitching_results.findall('PairwiseResult'):
+        setup_a = pairwise.get('view_setups_a', pairwise.get('view_setup_a'))
+        setup_b = pairwise.get('view_setups_b', pairwise.get('view_setup_b'))
+        shift = string_to_affine(pairwise.find('shift').text)[:3, 3]
+        results.append(dict(setup_a=first_id(setup_a), setup_b=first_id(setup_b),
+                            shift=tuple(float(v) for v in shift),
+                            correlation=float(pairwise.find('correlation').text)))
+    return results
@@ -0,0 +1,127 @@
+import os
+import os.path as osp
+import posixpath as px
+import shutil
+from typing import List, Tuple
+
+import numpy as np
+import tifffile as tif
+
+from bigstitcher_xml import read_xml, write_xml, set_bounding_boxes
+from native_fusion import get_tile_placements, get_mosaic_extent
+from generate_bigstitcher_macro import FuseMacro
+from fiji_scheduler import run_fiji_jobs
+from run_report import timed
+
+
+BLOCKS_XML_NAME = 'dataset_blocks.xml'
+BLOCK_FUSED_IMG_NAME = 'fused_tp_0_ch_0.tif'
+
+
+def get_fusion_blocks(origin: Tuple[int, int], size: Tuple[int, int], block_size: int, overlap: int) -> List[dict]:
+    """ Splits the mosaic extent into block_size x block_size cores in row-major order.
+        Every block is fused with overlap px around its core (clipped to the mosaic), only the core is kept.
+        Coordinates are global, box_max is inclusive as in BigStitcher bounding boxes.
+    """
+    if block_size % 16 != 0:
+        raise ValueError('Block size must be a multiple of 16, got ' + str(block_size))
+    (min_x, min_y), (width, height) = origin, size
+    blocks = []
+    for by in range(0, height, block_size):
+        for bx in range(0, width, block_size):
+            core_width = min(block_size, width - bx)
+            core_height = min(block_size, height - by)
+            box_min = (min_x + max(0, bx - overlap), min_y + max(0, by - overlap))
+            box_max = (min_x + min(width, bx + core_width + overlap) - 1, min_y + min(height, by + core_height + overlap) - 1)
+            blocks.append(dict(name='block_y{y}_x{x}'.format(y=by // block_size, x=bx // block_size),
+                               core=(min_x + bx, min_y + by, core_width, core_height),
+                               box_min=box_min, box_max=box_max))
+    return blocks
+
+
+def estimate_block_fusion_memory_mb(placements: List[dict], block: dict, bytes_per_pixel: int = 2,
+                                    jvm_overhead_mb: int = 1024, safety_factor: float = 1.3) -> int:
+    """ Heap needed to fuse one block with [Precompute Image]: tiles that touch the block,
+        float blending buffer and the output image of the block
+    """
+    (x0, y0), (x1, y1) = block['box_min'], block['box_max']
+    tiles_bytes = 0
+    for placement in placements:
+        tx, ty = placement['offset']
+        tw, th = placement['size']
+        if tx <= x1 and tx + tw > x0 and ty <= y1 and ty + th > y0:
+            tiles_bytes += tw * th * bytes_per_pixel
+    block_bytes = (x1 - x0 + 1) * (y1 - y0 + 1) * (4 + bytes_per_pixel)
+    return int((tiles_bytes + block_bytes) / 1024 ** 2 * safety_factor) + jvm_overhead_mb
+
+
+def read_block_core(block_path: str, block: dict, block_size: int, dtype) -> np.ndarray:
+    """ Core of a fused block padded with zeros to block_size x block_size, one tile of the output """
+    core_x, core_y, core_width, core_height = block['core']
+    x0, y0 = core_x - block['box_min'][0], core_y - block['box_min'][1]
+    img = tif.imread(block_path)
+    if img.ndim > 2:
+        img = img.reshape(img.shape[-2:])
+    core = img[y0:y0 + core_height, x0:x0 + core_width]
+    tile = np.zeros((block_size, block_size), dtype=dtype)
+    tile[:core.shape[0], :core.shape[1]] = core
+    return tile
+
+
+def assemble_blocks(blocks: List[dict], block_paths: List[str], out_path: str, size: Tuple[int, int], block_size: int,
+                    compression: str = 'zlib'):
+    """ Streams cores of row-major blocks into a tiled BigTIFF, one block is held in memory at a time """
+    with tif.TiffFile(block_paths[0]) as f:
+        dtype = f.pages[0].dtype
+
+    def block_cores():
+        for block, path in zip(blocks, block_paths):
+            yield read_block_core(path, block, block_size, dtype)
+
+    width, height = size
+    tif.imwrite(out_path, block_cores(), shape=(height, width), dtype=dtype, tile=(block_size, block_size),
+                compression=compression, bigtiff=True, photometric='minisblack')
+
+
+def fuse_channel_in_blocks(imagej_path: str, xml_path: str, channel_dir: str, out_path: str, block_size: int = 4096,
+                           overlap: int = 32, max_jobs: int = None, work_dir: str = None):
+    """ Every block is a bounding box in a copy of the channel dataset xml and is fused by its own Fiji job,
+        so heap of a job and memory of assembly are proportional to the block size, not to the mosaic.
+    """
+    if work_dir is None:
+        work_dir = px.join(osp.dirname(out_path), 'blocks')
+    placements = get_tile_placements(xml_path, channel_dir)
+    origin, size = get_mosaic_extent(placements)
+    blocks = get_fusion_blocks(origin, size, block_size, overlap)
+
+    root = read_xml(xml_path)
+    set_bounding_boxes(root, [(block['name'], block['box_min'] + (0,), block['box_max'] + (0,)) for block in blocks])
+    write_xml(root, px.join(channel_dir, BLOCKS_XML_NAME))
+
+    # outputs of an interrupted run may come from another registration
+    if osp.exists(work_dir):
+        shutil.rmtree(work_dir)
+    macro = FuseMacro()
+    macro.img_dir = channel_dir
+    macro.xml_file_name = BLOCKS_XML_NAME
+    jobs = []
+    block_paths = []
+    for block in blocks:
+        block_dir = px.join(work_dir, block['name'])
+        os.makedirs(block_dir, exist_ok=True)
+        macro.out_dir = block_dir
+        macro.macro_dir = block_dir
+        macro.bounding_box = block['name']
+        block_paths.append(px.join(block_dir, BLOCK_FUSED_IMG_NAME))
+        jobs.append(dict(name=osp.basename(osp.normpath(channel_dir)) + '_' + block['name'],
+                         macro_path=macro.generate(),
+                         log_path=px.join(block_dir, 'fusion.log'),
+                         expected_outputs=[block_paths[-1]]))
+    mem_per_job_mb = max(estimate_block_fusion_memory_mb(placements, block) for block in blocks)
+    print('Fusing', channel_dir, 'in', len(blocks), 'blocks of', block_size, 'px with', overlap, 'px overlap')
+    run_fiji_jobs(imagej_path, jobs, mem_per_job_mb, max_jobs)
+
+    with timed('block_assembly', num_blocks=len(blocks)):
+        assemble_blocks(blocks, block_paths, out_path, size, block_size)
+    shutil.rmtree(work_dir)
+    return out_path
@@ -0,0 +1,313 @@
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import os.path as osp
+import posixpath as px
+import queue
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+
+
+WORKER_SCRIPT_PATH = px.join(osp.dirname(osp.abspath(__file__)), 'fiji_worker.groovy')
+QUIT_COMMAND_PATTERN = re.compile(r'^.*(run\("Quit"\)|System\.exit).*$\n?', re.MULTILINE)
+
+
+def make_worker_command(imagej_path: str, mem_mb: int = None) -> List[str]:
+    command = shlex.split(imagej_path)
+    if mem_mb is not None:
+        command.append('--mem={mem}m'.format(mem=mem_mb))
+    command.extend(['--headless', '--console', '--run', WORKER_SCRIPT_PATH])
+    return command
+
+
+def get_pool_socket_path(worker_command: List[str]) -> str:
+    """ Every Fiji installation and heap size gets its own pool """
+    key = hashlib.sha1(' '.join(worker_command).encode('utf-8')).hexdigest()[:12]
+    return px.join(tempfile.gettempdir(), 'fiji_pool_{uid}_{key}.sock'.format(uid=os.getuid(), key=key))
+
+
+def strip_quit_commands(macro: str) -> str:
+    """ Generated macros quit Fiji at the end, a worker has to stay alive """
+    return QUIT_COMMAND_PATTERN.sub('', macro)
+
+
+def prepare_worker_macro(macro_path: str) -> str:
+    worker_macro_path = macro_path + '.worker.ijm'
+    with open(macro_path, 'r') as f:
+        macro = f.read()
+    with open(worker_macro_path, 'w') as f:
+        f.write(strip_quit_commands(macro))
+    return worker_macro_path
+
+
+class FijiWorker:
+    """ One Fiji process that runs macros sent to its stdin, see fiji_worker.groovy """
+    def __init__(self, command: List[str], startup_log_path: str = None):
+        self.command = command
+        self.startup_log_path = startup_log_path
+        self.process = None
+
+    def start(self):
+        stderr = open(self.startup_log_path, 'a') if self.startup_log_path is not None else subprocess.DEVNULL
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+                                        universal_newlines=True, bufsize=1)
+        # JVM and plugin discovery happen once here, Fiji prints its own messages before the worker is ready
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError('Fiji worker exited during startup: ' + ' '.join(self.command))
+            if line.strip() == 'FIJI_WORKER_READY':
+                return
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, job: dict) -> str:
+        """ Returns ok, aborted, error or died """
+        if not self.is_alive():
+            self.start()
+        worker_job = dict(macro_path=prepare_worker_macro(job['macro_path']), log_path=job['log_path'],
+                          expected_outputs=job.get('expected_outputs', []))
+        try:
+            self.process.stdin.write('RUN\t' + json.dumps(worker_job) + '\n')
+            self.process.stdin.flush()
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    return 'died'
+                if line.startswith('FIJI_WORKER_DONE'):
+                    return line.rstrip('\n').split('\t')[1]
+        except (BrokenPipeError, OSError):
+            return 'died'
+
+    def close(self):
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.write('QUIT\n')
+            self.process.stdin.flush()
+            self.process.wait(timeout=30)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class FijiPoolServer:
+    """ Keeps num_workers Fiji processes alive and runs jobs sent through a unix socket.
+        Every connection sends newline separated json requests and gets one json reply per request:
+        {"command": "run", "job": {name, macro_path, log_path, expected_outputs}} -> {"status": ok|aborted|error|died}
+        {"command": "status"} -> {"workers", "busy", "queued"}
+        {"command": "shutdown"} -> {"status": "ok"}
+        Shuts down after idle_timeout seconds without jobs.
+    """
+    def __init__(self, socket_path: str, worker_command: List[str], num_workers: int, idle_timeout: float = 600,
+                 log_dir: str = None):
+        self.socket_path = socket_path
+        self.worker_command = worker_command
+        self.num_workers = num_workers
+        self.idle_timeout = idle_timeout
+        self.log_dir = log_dir if log_dir is not None else tempfile.gettempdir()
+        self.jobs = queue.Queue()
+        self.busy = 0
+        self.last_activity = time.monotonic()
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.workers = []
+
+    def start_workers(self):
+        startup_log_path = px.join(self.log_dir, osp.basename(self.socket_path) + '.log')
+        self.workers = [FijiWorker(self.worker_command, startup_log_path) for _ in range(self.num_workers)]
+        # cold starts of all workers overlap
+        threads = [threading.Thread(target=worker.start) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for worker in self.workers:
+            threading.Thread(target=self.work, args=(worker,), daemon=True).start()
+
+    def work(self, worker: FijiWorker):
+        while not self.stopping.is_set():
+            try:
+                job, reply = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self.busy += 1
+            try:
+                status = worker.run(job)
+            except Exception as e:
+                status = 'error: ' + str(e)
+            with self._lock:
+                self.busy -= 1
+                self.last_activity = time.monotonic()
+            reply.put(status)
+
+    def handle_connection(self, connection: socket.socket):
+        with connection, connection.makefile('rw') as stream:
+            for line in stream:
+                request = json.loads(line)
+                command = request.get('command')
+                if command == 'run':
+                    with self._lock:
+                        self.last_activity = time.monotonic()
+                    reply = queue.Queue(maxsize=1)
+                    self.jobs.put((request['job'], reply))
+                    response = dict(status=reply.get())
+                elif command == 'status':
+                    with self._lock:
+                        response = dict(workers=len(self.workers), busy=self.busy, queued=self.jobs.qsize(),
+                                        worker_command=self.worker_command)
+                elif command == 'shutdown':
+                    self.stopping.set()
+                    response = dict(status='ok')
+                else:
+                    response = dict(error='Unknown command ' + str(command))
+                stream.write(json.dumps(response) + '\n')
+                stream.flush()
+
+    def is_idle(self) -> bool:
+        with self._lock:
+            return self.busy == 0 and self.jobs.empty() and time.monotonic() - self.last_activity > self.idle_timeout
+
+    def serve_forever(self):
+        # pools started at the same time by several stitching runs: only the first one serves
+        lock_path = self.socket_path + '.lock'
+        lock_file = open(lock_path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            print('Fiji pool is already running on', self.socket_path, flush=True)
+            return
+        if osp.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        try:
+            self.start_workers()
+            server.listen()
+            server.settimeout(1)
+            print('Fiji pool with', self.num_workers, 'workers is listening on', self.socket_path, flush=True)
+            while not self.stopping.is_set() and not self.is_idle():
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+        finally:
+            server.close()
+            if osp.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.stopping.set()
+            while not self.jobs.empty():
+                job, reply = self.jobs.get()
+                reply.put('died')
+            for worker in self.workers:
+                worker.close()
+            # removed while the lock is held, so a pool starting now creates a new lock file
+            if osp.exists(lock_path):
+                os.remove(lock_path)
+            lock_file.close()
+            print('Fiji pool stopped', flush=True)
+
+
+class FijiPoolClient:
+    """ Sends jobs to a running FijiPoolServer, one connection per request so it can be used from many threads """
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+
+    def request(self, request: dict) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.socket_path)
+            with connection.makefile('rw') as stream:
+                stream.write(json.dumps(request) + '\n')
+                stream.flush()
+                line = stream.readline()
+        if not line:
+            raise RuntimeError('Fiji pool closed the connection ' + self.socket_path)
+        return json.loads(line)
+
+    def run_job(self, job: dict) -> str:
+        return self.request(dict(command='run', job=job))['status']
+
+    def status(self) -> dict:
+        return self.request(dict(command='status'))
+
+    def shutdown(self):
+        self.request(dict(command='shutdown'))
+
+    def is_running(self) -> bool:
+        try:
+            self.status()
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+
+def ensure_pool_running(worker_command: List[str], num_workers: int, idle_timeout: float = 600,
+                        startup_timeout: float = 600, socket_path: str = None) -> FijiPoolClient:
+    """ Connects to the pool started with the same worker command, starts it in the background if it is not running.
+        The pool outlives this process and stops by itself after idle_timeout seconds without jobs.
+    """
+    if socket_path is None:
+        socket_path = get_pool_socket_path(worker_command)
+    client = FijiPoolClient(socket_path)
+    if client.is_running():
+        return client
+
+    log_path = socket_path + '.log'
+    command = [sys.executable, osp.abspath(__file__), 'serve', '--socket_path', socket_path,
+               '--worker_command', ' '.join(shlex.quote(arg) for arg in worker_command),
+               '--num_workers', str(num_workers), '--idle_timeout', str(idle_timeout)]
+    with open(log_path, 'a') as log:
+        subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    print('Starting Fiji pool with', num_workers, 'workers, log:', log_path)
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if client.is_running():
+            return client
+        time.sleep(0.5)
+    raise RuntimeError('Fiji pool did not start in ' + str(startup_timeout) + ' s, see ' + log_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pool of long-lived headless Fiji processes that run macros')
+    parser.add_argument('action', choices=['serve', 'status', 'shutdown'])
+    parser.add_argument('--socket_path', type=str, default=None,
+                        help='unix socket of the pool, by default derived from the worker command')
+    parser.add_argument('--imagej_path', type=str, default=None, help='path to imagej executable')
+    parser.add_argument('--mem', type=int, default=None, help='heap of every Fiji worker in MB')
+    parser.add_argument('--worker_command', type=str, default=None,
+                        help='command that starts a worker instead of Fiji, e.g. python benchmarks/fiji_worker_stub.py')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--idle_timeout', type=float, default=600, help='stop after this many seconds without jobs')
+    args = parser.parse_args()
+
+    if args.worker_command is not None:
+        command = shlex.split(args.worker_command)
+    elif args.imagej_path is not None:
+        command = make_worker_command(args.imagej_path, args.mem)
+    else:
+        command = None
+    socket_path = args.socket_path
+    if socket_path is None:
+        if command is None:
+            parser.error('either --socket_path, --imagej_path or --worker_command is required')
+        socket_path = get_pool_socket_path(command)
+
+    if args.action == 'serve':
+        FijiPoolServer(socket_path, command, args.num_workers, args.idle_timeout).serve_forever()
+    elif args.action == 'status':
+        print(json.dumps(FijiPoolClient(socket_path).status(), indent=4))
+    else:
+        FijiPoolClient(socket_path).shutdown()
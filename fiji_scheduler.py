@@ -0,0 +1,188 @@
+import os
+import os.path as osp
+import re
+import shlex
+import subprocess
+import threading
+import time
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+from run_report import get_active_report, parse_fiji_step_timings
+from fiji_pool import ensure_pool_running
+from stage_slots import stage_slot
+
+
+# generated macros end with System.exit(0), so failures inside plugins are only visible in the log
+FIJI_ERROR_PATTERN = re.compile(r'^.*OutOfMemoryError.*$|^Macro Error.*$', re.MULTILINE)
+# headless Fiji logs harmless stack traces at startup (updater, plugins), they explain failures only if outputs are missing
+FIJI_EXCEPTION_PATTERN = re.compile(r'^Exception in thread.*$|^[\w.$]+(?:Exception|Error)(?:: .*)?$(?=\n\s+at )', re.MULTILINE)
+
+_fiji_pool = dict(config=None, client=None, lock=threading.Lock())
+
+
+def get_available_memory_mb() -> int:
+    """ MemAvailable from /proc/meminfo, free physical memory on other systems """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 1024 ** 2
+
+
+def get_mosaic_size(info_for_bigstitcher: dict) -> tuple:
+    """ Approximate (width, height) of the fused image in pixels """
+    nx = info_for_bigstitcher['num_tiles_x']
+    ny = info_for_bigstitcher['num_tiles_y']
+    width = info_for_bigstitcher['tile_width'] * (nx - (nx - 1) * info_for_bigstitcher['overlap_x'] / 100)
+    height = info_for_bigstitcher['tile_height'] * (ny - (ny - 1) * info_for_bigstitcher['overlap_y'] / 100)
+    return int(width), int(height)
+
+
+def estimate_fusion_memory_mb(info_for_bigstitcher: dict, bytes_per_pixel: int = 2, jvm_overhead_mb: int = 1024,
+                              safety_factor: float = 1.3) -> int:
+    """ Heap needed to fuse one channel with [Precompute Image]: all tiles loaded as ArrayImg,
+        float blending buffer and the output image of the whole mosaic
+    """
+    tile_pixels = info_for_bigstitcher['tile_width'] * info_for_bigstitcher['tile_height']
+    tiles_bytes = info_for_bigstitcher['num_tiles'] * tile_pixels * bytes_per_pixel
+    width, height = get_mosaic_size(info_for_bigstitcher)
+    mosaic_bytes = width * height * (4 + bytes_per_pixel)
+    return int((tiles_bytes + mosaic_bytes) / 1024 ** 2 * safety_factor) + jvm_overhead_mb
+
+
+def get_max_concurrency(mem_per_job_mb: int, num_jobs: int, max_workers: int = None, reserve_mb: int = 2048) -> int:
+    available = get_available_memory_mb() - reserve_mb
+    concurrency = max(1, available // mem_per_job_mb)
+    if max_workers is not None:
+        concurrency = min(concurrency, max_workers)
+    return int(min(concurrency, max(num_jobs, 1)))
+
+
+def make_fiji_command(imagej_path: str, macro_path: str, mem_mb: int = None) -> List[str]:
+    command = shlex.split(imagej_path)
+    if mem_mb is not None:
+        command.append('--mem={mem}m'.format(mem=mem_mb))
+    command.extend(['--headless', '--console', '-macro', macro_path])
+    return command
+
+
+def set_fiji_pool(worker_command: List[str] = None, num_workers: int = 1, idle_timeout: float = 600):
+    """ Fiji jobs are sent to a pool of long-lived Fiji processes started with worker_command,
+        the pool is started with the first job. None runs every job in a new Fiji process.
+    """
+    with _fiji_pool['lock']:
+        _fiji_pool['client'] = None
+        _fiji_pool['config'] = None
+        if worker_command is not None:
+            _fiji_pool['config'] = dict(worker_command=worker_command, num_workers=num_workers, idle_timeout=idle_timeout)
+
+
+def get_fiji_pool():
+    with _fiji_pool['lock']:
+        if _fiji_pool['config'] is not None and _fiji_pool['client'] is None:
+            try:
+                _fiji_pool['client'] = ensure_pool_running(**_fiji_pool['config'])
+            except RuntimeError as e:
+                print(e, '\nEvery Fiji job will start its own Fiji process')
+                _fiji_pool['config'] = None
+        return _fiji_pool['client']
+
+
+def run_in_fiji_pool(pool, job: dict) -> int:
+    """ Returns 0 if the pool worker finished the macro, 1 if the macro failed,
+        None if the pool can not be reached or its worker died, then the job is run in its own Fiji process
+    """
+    try:
+        status = pool.run_job(job)
+    except (OSError, RuntimeError) as e:
+        print('Fiji pool is not available, starting Fiji for', job['name'], e)
+        return None
+    if status == 'ok':
+        return 0
+    print('Fiji pool worker returned', status, 'for', job['name'])
+    return 1 if status in ('aborted', 'error') else None
+
+
+def find_fiji_error(log_text: str, pattern: re.Pattern = FIJI_ERROR_PATTERN) -> str:
+    """ First line of an out of memory or macro error in Fiji output, None if there is none """
+    match = pattern.search(log_text)
+    return match.group(0).strip() if match is not None else None
+
+
+def run_fiji_job(imagej_path: str, job: dict, mem_mb: int = None) -> bool:
+    """ job: dict(name, macro_path, log_path, expected_outputs)
+        Job succeeded if Fiji exited with 0, its log has no out of memory or macro errors
+        and all expected outputs were written by this run,
+        outputs of earlier runs are deleted before the job starts.
+        With a Fiji pool the job runs in a worker with the heap size of the pool, mem_mb is ignored.
+    """
+    for path in job.get('expected_outputs', []):
+        if osp.exists(path):
+            os.remove(path)
+    pool = get_fiji_pool()
+    command = make_fiji_command(imagej_path, job['macro_path'], mem_mb)
+    with stage_slot('fiji'), open(job['log_path'], 'a') as log:
+        returncode = None
+        if pool is not None:
+            log.write('Running in Fiji pool ' + pool.socket_path + '\n')
+            log.flush()
+            # the pool worker appends console output of the job to the same log
+            log_offset = log.tell()
+            job_start = time.time()
+            returncode = run_in_fiji_pool(pool, job)
+        if returncode is None:
+            log.write(' '.join(command) + '\n')
+            log.flush()
+            log_offset = log.tell()
+            job_start = time.time()
+            returncode = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+    wall_seconds = time.time() - job_start
+    # the log is appended to by retries, only output of this run is parsed
+    with open(job['log_path'], 'r', errors='replace') as log:
+        log.seek(log_offset)
+        log_text = log.read()
+    report = get_active_report()
+    if report is not None:
+        step_seconds = parse_fiji_step_timings(log_text, job_start)
+        report.add_fiji_job(job['name'], job['log_path'], wall_seconds, returncode, step_seconds, mem_mb)
+    if returncode != 0:
+        print('Job', job['name'], 'exited with code', returncode, 'see', job['log_path'])
+        return False
+    error = find_fiji_error(log_text)
+    if error is not None:
+        print('Job', job['name'], 'failed with', error, 'see', job['log_path'])
+        return False
+    missing = [path for path in job.get('expected_outputs', []) if not osp.exists(path)]
+    if missing:
+        exception = find_fiji_error(log_text, FIJI_EXCEPTION_PATTERN)
+        print('Job', job['name'], 'did not produce', missing, 'after ' + exception if exception is not None else '',
+              'see', job['log_path'])
+        return False
+    return True
+
+
+def run_fiji_jobs(imagej_path: str, jobs: List[dict], mem_per_job_mb: int = None, max_workers: int = None):
+    """ Runs as many jobs at once as fit into available memory, failed jobs are retried
+        with half the concurrency. Raises RuntimeError if jobs still fail when run one at a time.
+    """
+    if mem_per_job_mb is None:
+        concurrency = min(max_workers or len(jobs), len(jobs))
+    else:
+        concurrency = get_max_concurrency(mem_per_job_mb, len(jobs), max_workers)
+        if mem_per_job_mb > get_available_memory_mb():
+            print('Estimated memory per Fiji job', mem_per_job_mb, 'MB is more than available', get_available_memory_mb(), 'MB')
+    remaining = list(jobs)
+    while remaining:
+        print('Running', len(remaining), 'Fiji jobs,', concurrency, 'at a time,', mem_per_job_mb, 'MB heap each')
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            succeeded = list(executor.map(lambda job: run_fiji_job(imagej_path, job, mem_per_job_mb), remaining))
+        failed = [job for job, ok in zip(remaining, succeeded) if not ok]
+        if failed and concurrency == 1:
+            raise RuntimeError('Fiji jobs failed: ' + ', '.join(job['name'] for job in failed) +
+                               '. Logs: ' + ', '.join(job['log_path'] for job in failed))
+        remaining = failed
+        concurrency = max(1, concurrency // 2)
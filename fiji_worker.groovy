@@ -0,0 +1,47 @@
+// Long-lived Fiji worker, started by fiji_pool.py with
+// ImageJ --headless --console --run fiji_worker.groovy
+// Reads jobs from stdin, one per line: RUN<tab>{"macro_path": ..., "log_path": ...}
+// Console output of every job is appended to its log file,
+// FIJI_WORKER_DONE<tab>ok|aborted|error is printed to stdout when a job is finished.
+import ij.IJ
+import groovy.json.JsonSlurper
+
+def stdout = System.out
+def stderr = System.err
+def reader = new BufferedReader(new InputStreamReader(System.in))
+def json = new JsonSlurper()
+
+stdout.println("FIJI_WORKER_READY")
+stdout.flush()
+
+String line
+while ((line = reader.readLine()) != null) {
+    def parts = line.split("\t", 2)
+    if (parts[0] == "QUIT") {
+        break
+    }
+    if (parts[0] != "RUN") {
+        continue
+    }
+    def job = json.parseText(parts[1])
+    def log = new PrintStream(new FileOutputStream(job.log_path as String, true), true)
+    def status = "ok"
+    System.setOut(log)
+    System.setErr(log)
+    try {
+        def result = IJ.runMacroFile(job.macro_path as String)
+        if (result == "[aborted]") {
+            status = "aborted"
+        }
+    } catch (Throwable t) {
+        t.printStackTrace(log)
+        status = "error"
+    } finally {
+        System.setOut(stdout)
+        System.setErr(stderr)
+        log.close()
+    }
+    stdout.println("FIJI_WORKER_DONE\t" + status)
+    stdout.flush()
+}
+System.exit(0)
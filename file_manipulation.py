@@ -3,13 +3,29 @@ import posixpath as px
 import os.path as osp
 import shutil
 from typing import List, Dict, Set, Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-import numpy as np
 import tifffile as tif
 
 
-from image_paths_arrangement import get_image_paths_arranged_in_dict, alpha_num_order
-from best_z_plane_selection_with_cytokit_info import get_info_about_best_focal_plane_per_tile, select_best_z_planes_in_this_channel
+from stage_manifest import StageManifest, make_fingerprint
+from ome_tiff_assembly import write_pyramidal_ome_tiff
+from projection import project_planes, finalize_projection, read_dtype_from_header
+from intensity_normalization import compute_channel_intensity_ranges, get_tile_projection_options, needs_decoding
+from image_paths_arrangement import DatasetIndex, build_dataset_index, alpha_num_order
+from best_z_plane_selection_with_cytokit_info import get_info_about_best_focal_plane_per_tile, select_best_z_planes_in_this_channel, \
+    get_focus_scores_per_tile
+from focus_scoring import score_focus_per_tile, get_best_focal_plane_per_tile_from_scores
+from tile_grid import get_snake_grid_positions, get_grid_translations
+from tile_pipeline import run_tile_pipeline, get_default_pipeline_options
+from bdv_hdf5 import BdvHdf5Writer
+from tile_compression import write_tile, get_encode_workers
+from bigstitcher_xml import create_dataset, get_setup_id, write_xml
+from run_report import timed, report_value
+
+
+TILE_FORMATS = ('tiff', 'hdf5')
+BDV_DIR_NAME = 'bdv'
 
 
 def convert(img, target_type_min, target_type_max, target_type):
@@ -22,15 +38,103 @@ def convert(img, target_type_min, target_type_max, target_type):
     return new_img
 
 
-def project_stack(path_list: List[str]):
-    return convert(np.mean(np.stack(list(map(tif.imread, path_list)), axis=0), axis=0), 0, 65535, np.uint16)
+def get_default_projection_options() -> dict:
+    return dict(method='mean', normalize='none', output_dtype='source', percentiles=[0.1, 99.9],
+                sample_step=4, max_sample_tiles=100, compression='none')
+
+
+def project_stack(path_list: List[str], method: str = 'mean', weights: List[float] = None, normalize: str = 'none',
+                  output_dtype: str = 'source', intensity_range: tuple = None):
+    img = project_planes(path_list, method, weights)
+    return finalize_projection(img, read_dtype_from_header(path_list[0]), normalize, output_dtype, intensity_range)
+
+
+def remove_if_exists(path: str):
+    # destination can be a hard link to raw data, it must never be overwritten in place
+    if osp.lexists(path):
+        os.remove(path)
+
+
+def reflink(src: str, dst: str):
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_or_copy(src: str, dst: str):
+    """ Hard link, then reflink, then plain copy, whichever works first """
+    remove_if_exists(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        reflink(src, dst)
+        return
+    except (OSError, ImportError):
+        remove_if_exists(dst)
+    shutil.copyfile(src, dst)
+
+
+def project_and_save(src: List[str], dst: str, weights: List[float] = None, projection_options: dict = None):
+    if projection_options is None:
+        projection_options = get_default_projection_options()
+    options = get_tile_projection_options(projection_options, dst)
+
+    if not needs_decoding(src, options):
+        # nothing to project or rescale, pixels do not need to be decoded
+        link_or_copy(src[0], dst)
+        return
+
+    img = project_stack(src, options['method'], weights, options['normalize'], options.get('output_dtype', 'source'),
+                        options.get('intensity_range'))
+    remove_if_exists(dst)
+    write_tile(dst, img, options.get('compression', 'none'), options.get('encode_workers', 1))
 
 
-def copy_to_destination(best_z_plane_paths: List[tuple]):
-    for src, dst in best_z_plane_paths:
-        img = project_stack(src)
-        tif.imwrite(dst, img)
-        #shutil.copy(src[0], dst)
+def copy_to_destination(best_z_plane_paths: List[tuple], projection_options: dict = None, on_tile_done=None):
+    for src, dst, weights in best_z_plane_paths:
+        project_and_save(src, dst, weights, projection_options)
+        if on_tile_done is not None:
+            on_tile_done(src, dst, weights)
+
+
+def copy_to_destination_in_parallel(best_z_plane_paths: List[tuple], num_workers: int,
+                                    parallel_mode: str = 'threads', max_tiles_in_flight: int = None,
+                                    projection_options: dict = None, on_tile_done=None):
+    """ Projects tiles concurrently. At most max_tiles_in_flight tiles are submitted at any time,
+        which limits the number of z-stacks held in memory.
+    """
+    if max_tiles_in_flight is None:
+        max_tiles_in_flight = 2 * num_workers
+    max_tiles_in_flight = max(max_tiles_in_flight, num_workers)
+
+    if parallel_mode == 'threads':
+        executor_class = ThreadPoolExecutor
+    elif parallel_mode == 'processes':
+        executor_class = ProcessPoolExecutor
+    else:
+        raise ValueError('Unknown parallel mode: ' + str(parallel_mode))
+
+    def collect(futures):
+        for future in futures:
+            future.result()
+            if on_tile_done is not None:
+                on_tile_done(*tasks.pop(future))
+
+    with executor_class(max_workers=num_workers) as executor:
+        in_flight = set()
+        tasks = dict()
+        for src, dst, weights in best_z_plane_paths:
+            if len(in_flight) >= max_tiles_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(project_and_save, src, dst, weights, projection_options)
+            tasks[future] = (src, dst, weights)
+            in_flight.add(future)
+        collect(in_flight)
 
 
 def make_dir_if_not_exists(dir_path: str):
@@ -54,19 +158,21 @@ def get_channel_names_per_cycle(submission: dict):
     return channel_names_per_cycle
 
 
-def create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, best_z_plane_per_tile):
+def create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, best_z_plane_per_tile, focus_scores_per_tile=None,
+                                  dataset_index: DatasetIndex = None):
+    if dataset_index is None:
+        dataset_index = build_dataset_index(img_dirs)
     channels_to_ignore = ['Empty', 'Blank', 'DAPI']
 
     channel_dirs = dict()
     channel_image_paths = dict()
 
     channel_id = 1
-    for i, dir_path in enumerate(img_dirs, start=1): # cycle level
+    for i in range(1, len(img_dirs) + 1):  # cycle level
         this_cycle_channel_names = channel_names_per_cycle[i] # cycle level
-        arranged_listing = get_image_paths_arranged_in_dict(dir_path)  # channel level
+        channels = dataset_index.get_channels(cycle=i)  # channel level, sorted by channel id
 
-        for j, channel in enumerate(arranged_listing):
-            this_channel_paths = arranged_listing[channel]
+        for j, channel in enumerate(channels):
             this_channel_name = this_cycle_channel_names[j]
 
             if this_channel_name in channels_to_ignore:
@@ -77,7 +183,9 @@ def create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, be
             print(this_channel_name)
             new_channel_id = 'CH' + format(channel_id, '03d')
             this_channel_out_dir = px.join(out_dir, new_channel_id)
-            best_z_plane_paths = select_best_z_planes_in_this_channel(this_channel_paths, this_channel_out_dir, best_z_plane_per_tile)
+            tiles, zplanes, paths = dataset_index.get_zplane_table(cycle=i, channel=channel)
+            best_z_plane_paths = select_best_z_planes_in_this_channel(tiles, zplanes, paths, this_channel_out_dir,
+                                                                      best_z_plane_per_tile, focus_scores_per_tile)
             #print(this_channel_name, new_channel_id, best_z_plane_paths)
             channel_dirs[channel_id] = this_channel_out_dir
             channel_image_paths[channel_id] = best_z_plane_paths
@@ -87,22 +195,216 @@ def create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, be
     return channel_dirs, channel_image_paths
 
 
-def copy_best_z_planes_to_channel_dirs(img_dirs, out_dir, submission, cytokit_json_path):
-    best_z_plane_per_tile = get_info_about_best_focal_plane_per_tile(cytokit_json_path)
+def make_tile_fingerprint(src: List[str], dst: str, weights: List[float], projection_options: dict) -> dict:
+    options = get_tile_projection_options(projection_options, dst)
+    # encoding threads do not change the written tile
+    options.pop('encode_workers', None)
+    return make_fingerprint(src, dict(projection_options=options, weights=weights))
+
+
+def remove_up_to_date_tiles(best_z_plane_paths: List[tuple], manifest: StageManifest, projection_options: dict) -> List[tuple]:
+    tiles_to_process = []
+    for src, dst, weights in best_z_plane_paths:
+        fingerprint = make_tile_fingerprint(src, dst, weights, projection_options)
+        if not manifest.is_up_to_date('projection', dst, fingerprint):
+            tiles_to_process.append((src, dst, weights))
+    return tiles_to_process
+
+
+def get_best_focal_planes_from_images(dataset_index: DatasetIndex, submission: dict, num_workers: int = 1,
+                                      focus_options: dict = None, cache_dir: str = None):
+    """ Scores z-planes of the best focus reference channel, used when there is no cytokit data.json """
+    reference_cycle = submission.get('bestFocusReferenceCycle', 1)
+    reference_channel = submission['bestFocusReferenceChannel']
+    reference_paths = dataset_index.get_tile_paths(reference_cycle, reference_channel)
+    focus_scores_per_tile = score_focus_per_tile(reference_paths, num_workers, focus_options, cache_dir)
+    tile_positions = get_snake_grid_positions(submission['numTiles'], submission['regionWidth'], submission['regionHeight'])
+    best_z_plane_per_tile = get_best_focal_plane_per_tile_from_scores(focus_scores_per_tile, tile_positions)
+    return best_z_plane_per_tile, focus_scores_per_tile
+
+
+def copy_best_z_planes_to_channel_dirs(img_dirs, out_dir, submission, cytokit_json_path,
+                                       num_workers: int = 1, parallel_mode: str = 'threads', max_tiles_in_flight: int = None,
+                                       projection_options: dict = None, manifest: StageManifest = None,
+                                       focus_options: dict = None, pipeline_options: dict = None, tile_format: str = 'tiff'):
+    """ With tile_format hdf5 only the reference channel is written as tiff files,
+        all channels are written to one BigDataViewer hdf5 file in out_dir/bdv
+    """
+    if tile_format not in TILE_FORMATS:
+        raise ValueError('Unknown tile format: ' + str(tile_format))
+    if projection_options is None:
+        projection_options = get_default_projection_options()
+    if pipeline_options is None:
+        pipeline_options = get_default_pipeline_options(num_workers)
+    tiles_written_at_once = pipeline_options['write_workers'] if parallel_mode == 'pipeline' else num_workers
+    projection_options = dict(projection_options, encode_workers=get_encode_workers(tiles_written_at_once))
+    # listing is cached in out_dir and rebuilt only when an input directory changes
+    with timed('listing'):
+        dataset_index = build_dataset_index(img_dirs, num_workers, cache_dir=out_dir)
+    with timed('best_z_selection', source='cytokit' if cytokit_json_path is not None else 'focus_scoring'):
+        if cytokit_json_path is not None:
+            best_z_plane_per_tile = get_info_about_best_focal_plane_per_tile(cytokit_json_path)
+            focus_scores_per_tile = None
+            if projection_options['method'] == 'weighted':
+                focus_scores_per_tile = get_focus_scores_per_tile(cytokit_json_path)
+        else:
+            best_z_plane_per_tile, focus_scores_per_tile = get_best_focal_planes_from_images(dataset_index, submission, num_workers,
+                                                                                             focus_options, out_dir)
+            if projection_options['method'] != 'weighted':
+                focus_scores_per_tile = None
     channel_names_per_cycle = get_channel_names_per_cycle(submission)
-    channel_dirs, channel_image_paths = create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, best_z_plane_per_tile)
+    channel_dirs, channel_image_paths = create_paths_for_channel_dirs(img_dirs, out_dir, channel_names_per_cycle, best_z_plane_per_tile,
+                                                                      focus_scores_per_tile, dataset_index)
     for ch_id, dir_path in channel_dirs.items():
         make_dir_if_not_exists(dir_path)
-    for channel in channel_image_paths:
-        copy_to_destination(channel_image_paths[channel])
 
+    if projection_options['normalize'] in ('channel', 'percentile'):
+        projection_options = dict(projection_options)
+        with timed('intensity_ranges'):
+            projection_options['intensity_ranges'] = compute_channel_intensity_ranges(channel_image_paths, projection_options,
+                                                                                      num_workers)
+
+    all_channel_image_paths = dict(channel_image_paths)
+    if tile_format == 'hdf5':
+        # reference channel is registered from tiff files before fusion
+        channel_image_paths = {channel: paths for channel, paths in channel_image_paths.items() if channel == 1}
+
+    on_tile_done = None
+    if manifest is not None:
+        num_tiles = sum(len(paths) for paths in channel_image_paths.values())
+        for channel in channel_image_paths:
+            channel_image_paths[channel] = remove_up_to_date_tiles(channel_image_paths[channel], manifest, projection_options)
+        num_tiles_to_process = sum(len(paths) for paths in channel_image_paths.values())
+        print('Tiles up to date:', num_tiles - num_tiles_to_process, 'of', num_tiles)
+
+        def on_tile_done(src, dst, weights):
+            manifest.record('projection', dst, make_tile_fingerprint(src, dst, weights, projection_options))
+
+    num_tiles_to_process = sum(len(paths) for paths in channel_image_paths.values())
+    with timed('projection', tiles=num_tiles_to_process, parallel_mode=parallel_mode, num_workers=num_workers):
+        try:
+            if parallel_mode == 'pipeline':
+                all_paths = [paths for channel in channel_image_paths for paths in channel_image_paths[channel]]
+                report_value('projection_pipeline',
+                             run_tile_pipeline(all_paths, projection_options, pipeline_options, link_or_copy, on_tile_done))
+            elif num_workers > 1:
+                # flatten to (channel, tile) pairs so workers are not idle at channel boundaries
+                all_paths = [paths for channel in channel_image_paths for paths in channel_image_paths[channel]]
+                copy_to_destination_in_parallel(all_paths, num_workers, parallel_mode, max_tiles_in_flight, projection_options,
+                                                on_tile_done)
+            else:
+                for channel in channel_image_paths:
+                    copy_to_destination(channel_image_paths[channel], projection_options, on_tile_done)
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+    if tile_format == 'hdf5':
+        with timed('hdf5_write'):
+            write_channels_to_bdv_hdf5(all_channel_image_paths, out_dir, submission, num_workers, max_tiles_in_flight,
+                                       projection_options, manifest)
     return channel_dirs
 
 
-def assemble_channels_in_one_file(channel_stitched_dirs: List[str], output_path: str, ome_meta: str):
-    img_name = 'fused_tp_0_ch_0.tif'
-    with tif.TiffWriter(output_path, bigtiff=True) as TW:
-        for dir_path in channel_stitched_dirs:
-            img_path = osp.join(dir_path, img_name)
-            TW.save(tif.imread(img_path), photometric='minisblack', description=ome_meta)
+def get_bdv_dataset_paths(out_dir: str):
+    """ (hdf5 path, xml path) of the BigDataViewer dataset with all channels """
+    bdv_dir = px.join(out_dir, BDV_DIR_NAME)
+    return px.join(bdv_dir, 'dataset.h5'), px.join(bdv_dir, 'dataset.xml')
+
+
+def write_bdv_dataset_xml(xml_path: str, h5_path: str, channel_image_paths: Dict[int, List[tuple]], tile_size: tuple,
+                          submission: dict):
+    channel_ids = sorted(channel_image_paths)
+    channel_names_per_channel_id = get_channel_names_per_channel_id(submission)
+    channel_names = [channel_names_per_channel_id.get(channel_id, str(channel_id)) for channel_id in channel_ids]
+    tile_paths_per_channel = [[dst for src, dst, weights in channel_image_paths[channel_id]] for channel_id in channel_ids]
+
+    num_tiles = len(tile_paths_per_channel[0])
+    positions = get_snake_grid_positions(num_tiles, submission['regionWidth'], submission['regionHeight'])
+    grid_translations = get_grid_translations(positions, tile_size[0], tile_size[1],
+                                              submission['tileOverlapX'], submission['tileOverlapY'])
+    voxel_size = (submission['xyResolution'], submission['xyResolution'], submission['zPitch'])
+    root = create_dataset(tile_paths_per_channel, tile_size, voxel_size, grid_translations, 'um', channel_names,
+                          h5_path=osp.relpath(h5_path, osp.dirname(xml_path)))
+    write_xml(root, xml_path)
+
+
+def write_channels_to_bdv_hdf5(channel_image_paths: Dict[int, List[tuple]], out_dir: str, submission: dict,
+                               num_workers: int = 1, max_tiles_in_flight: int = None, projection_options: dict = None,
+                               manifest: StageManifest = None) -> str:
+    """ Projects tiles of all channels into one chunked multi-resolution hdf5 file that BigStitcher loads lazily.
+        Setup id of a tile is channel index * num_tiles + tile index, channels are in the order of channel ids.
+        Returns path to dataset.xml.
+    """
+    if projection_options is None:
+        projection_options = get_default_projection_options()
+    h5_path, xml_path = get_bdv_dataset_paths(out_dir)
+    make_dir_if_not_exists(px.dirname(h5_path))
+    channel_ids = sorted(channel_image_paths)
+    jobs = [(c, tile, task) for c, channel_id in enumerate(channel_ids)
+            for tile, task in enumerate(channel_image_paths[channel_id])]
+
+    src_paths = [path for c, tile, (src, dst, weights) in jobs for path in src]
+    fingerprint = make_fingerprint(src_paths, dict(projection_options=projection_options,
+                                                   weights=[weights for c, tile, (src, dst, weights) in jobs]))
+    if manifest is not None and manifest.is_up_to_date('projection', h5_path, fingerprint) and osp.exists(xml_path):
+        print('HDF5 dataset is up to date, skipping', h5_path)
+        return xml_path
+
+    num_tiles = len(channel_image_paths[channel_ids[0]])
+    first_tile_path = jobs[0][2][0][0]
+    with tif.TiffFile(first_tile_path) as f:
+        height, width = f.pages[0].shape[-2:]
+
+    def load(job):
+        c, tile, (src, dst, weights) = job
+        if channel_ids[c] == 1 and osp.exists(dst):
+            # reference channel was already projected into tiff files
+            return tif.imread(dst)
+        options = get_tile_projection_options(projection_options, dst)
+        return project_stack(src, options['method'], weights, options['normalize'], options.get('output_dtype', 'source'),
+                             options.get('intensity_range'))
+
+    if max_tiles_in_flight is None:
+        max_tiles_in_flight = 2 * num_workers
+    tmp_h5_path = h5_path + '.tmp'
+    print('Writing', len(jobs), 'tiles to', h5_path)
+    with BdvHdf5Writer(tmp_h5_path, (width, height)) as writer, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for i in range(0, len(jobs), max_tiles_in_flight):
+            batch = jobs[i:i + max_tiles_in_flight]
+            for (c, tile, task), img in zip(batch, executor.map(load, batch)):
+                writer.write_setup(get_setup_id(c, tile, num_tiles), img)
+    os.replace(tmp_h5_path, h5_path)
 
+    write_bdv_dataset_xml(xml_path, h5_path, channel_image_paths, (width, height), submission)
+    if manifest is not None:
+        manifest.record('projection', h5_path, fingerprint)
+        manifest.save()
+    return xml_path
+
+
+def get_channel_names_per_channel_id(submission: dict) -> Dict[int, str]:
+    """ Names of channels that are copied to channel dirs, same selection as in create_paths_for_channel_dirs """
+    channels_to_ignore = ['Empty', 'Blank', 'DAPI']
+    channel_names_per_cycle = get_channel_names_per_cycle(submission)
+
+    channel_names = dict()
+    channel_id = 1
+    for cycle in sorted(channel_names_per_cycle):
+        for channel_name in channel_names_per_cycle[cycle]:
+            if channel_name in channels_to_ignore:
+                if channel_name == 'DAPI' and channel_id == 1:
+                    pass
+                else:
+                    continue
+            channel_names[channel_id] = channel_name
+            channel_id += 1
+    return channel_names
+
+
+def assemble_channels_in_one_file(channel_stitched_dirs: List[str], output_path: str, channel_names: List[str],
+                                  pixel_size_um: float = None, num_workers: int = 1):
+    img_name = 'fused_tp_0_ch_0.tif'
+    channel_img_paths = [osp.join(dir_path, img_name) for dir_path in channel_stitched_dirs]
+    write_pyramidal_ome_tiff(channel_img_paths, output_path, channel_names, pixel_size_um, num_workers,
+                             tmp_dir=osp.dirname(osp.abspath(output_path)))
@@ -0,0 +1,142 @@
+import os
+import os.path as osp
+import posixpath as px
+import json
+from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tif
+
+from stage_manifest import make_fingerprint
+from best_z_plane_selection_with_cytokit_info import arrange_best_z_planes_per_tile
+
+
+FOCUS_METRICS = ('laplacian_variance', 'gradient_energy')
+
+
+def get_default_focus_options() -> dict:
+    return dict(metric='laplacian_variance', crop_fraction=0.5, downsample=2)
+
+
+def read_plane_for_scoring(path: str, crop_fraction: float, downsample: int) -> np.ndarray:
+    """ Centre crop of the plane, uncompressed files are memory mapped so only the crop is read """
+    try:
+        img = tif.memmap(path, mode='r')
+    except ValueError:
+        img = tif.imread(path)
+    img = img.reshape(img.shape[-2:])
+
+    height, width = img.shape
+    crop_h = max(int(height * crop_fraction) // downsample * downsample, downsample)
+    crop_w = max(int(width * crop_fraction) // downsample * downsample, downsample)
+    y = (height - crop_h) // 2
+    x = (width - crop_w) // 2
+    crop = np.asarray(img[y:y + crop_h, x:x + crop_w], dtype=np.float32)
+    if downsample > 1:
+        crop = crop.reshape(crop_h // downsample, downsample, crop_w // downsample, downsample).mean(axis=(1, 3))
+    return crop
+
+
+def laplacian_variance(img: np.ndarray) -> float:
+    laplacian = img[1:-1, :-2] + img[1:-1, 2:] + img[:-2, 1:-1] + img[2:, 1:-1] - 4 * img[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def gradient_energy(img: np.ndarray) -> float:
+    """ Mean squared gradient normalized by squared mean intensity, so it does not depend on brightness """
+    gx = np.diff(img, axis=1)
+    gy = np.diff(img, axis=0)
+    mean = float(img.mean())
+    if mean == 0:
+        return 0.0
+    return float((np.mean(gx * gx) + np.mean(gy * gy)) / mean ** 2)
+
+
+def score_tile(zplane_paths: Dict[int, str], focus_options: dict) -> Dict[int, float]:
+    metric = laplacian_variance if focus_options['metric'] == 'laplacian_variance' else gradient_energy
+    scores = dict()
+    for zplane, path in zplane_paths.items():
+        plane = read_plane_for_scoring(path, focus_options['crop_fraction'], focus_options['downsample'])
+        scores[zplane] = metric(plane)
+    return scores
+
+
+class FocusScoreCache:
+    """ Scores of every tile stored in json together with the fingerprint of its z-planes,
+        so scores are recomputed only for changed tiles or different focus options
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_path = px.join(cache_dir, 'focus_scores.json')
+        self.records = dict()
+        if osp.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    self.records = json.load(f)
+            except (json.JSONDecodeError, OSError):
+                print('Could not read focus score cache, all tiles will be scored', self.cache_path)
+
+    def get(self, tile: int, fingerprint: dict):
+        record = self.records.get(str(tile))
+        if record is None or record['fingerprint'] != fingerprint:
+            return None
+        return {int(z): score for z, score in record['scores'].items()}
+
+    def put(self, tile: int, fingerprint: dict, scores: Dict[int, float]):
+        self.records[str(tile)] = dict(fingerprint=fingerprint, scores=scores)
+
+    def save(self):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.records, f)
+        os.replace(tmp_path, self.cache_path)
+
+
+def score_focus_per_tile(tile_paths: Dict[int, Dict[int, str]], num_workers: int = 1, focus_options: dict = None,
+                         cache_dir: str = None) -> Dict[int, Dict[int, float]]:
+    """ tile_paths: {tile: {zplane: path}} of the reference channel, returns {tile: {zplane: score}} """
+    if focus_options is None:
+        focus_options = get_default_focus_options()
+    if focus_options['metric'] not in FOCUS_METRICS:
+        raise ValueError('Unknown focus metric ' + str(focus_options['metric']) + ', use one of ' + str(FOCUS_METRICS))
+
+    cache = FocusScoreCache(cache_dir) if cache_dir is not None else None
+    focus_scores_per_tile = dict()
+    tiles_to_score = []
+    fingerprints = dict()
+    for tile, zplane_paths in tile_paths.items():
+        if cache is not None:
+            fingerprints[tile] = make_fingerprint(zplane_paths.values(), focus_options)
+            scores = cache.get(tile, fingerprints[tile])
+            if scores is not None:
+                focus_scores_per_tile[tile] = scores
+                continue
+        tiles_to_score.append(tile)
+    print('Scoring focus of', len(tiles_to_score), 'tiles,', len(focus_scores_per_tile), 'taken from cache')
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        scores_per_tile = executor.map(lambda tile: score_tile(tile_paths[tile], focus_options), tiles_to_score)
+        for tile, scores in zip(tiles_to_score, scores_per_tile):
+            focus_scores_per_tile[tile] = scores
+            if cache is not None:
+                cache.put(tile, fingerprints[tile], scores)
+
+    if cache is not None and tiles_to_score:
+        cache.save()
+    return {tile: focus_scores_per_tile[tile] for tile in sorted(focus_scores_per_tile)}
+
+
+def get_best_focal_plane_per_tile_from_scores(focus_scores_per_tile: Dict[int, Dict[int, float]],
+                                              tile_positions: List[Tuple[int, int]]) -> Dict[int, List[int]]:
+    """ Same output as get_info_about_best_focal_plane_per_tile, tile_positions are (row, col) of zero based tiles """
+    best_z_planes = []
+    tile_ids = []
+    num_zplanes_per_tile = []
+    positions = []
+    for tile, scores in focus_scores_per_tile.items():
+        zplanes = sorted(scores)
+        best_z_planes.append(zplanes.index(max(zplanes, key=lambda z: scores[z])))
+        tile_ids.append(tile - 1)
+        num_zplanes_per_tile.append(len(zplanes))
+        positions.append(tile_positions[tile - 1])
+    return arrange_best_z_planes_per_tile(best_z_planes, positions, tile_ids, num_zplanes_per_tile)
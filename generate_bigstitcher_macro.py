@@ -1,7 +1,100 @@
 import os
 import os.path as osp
 import posixpath as px
-from datetime import datetime
+import re
+import string
+import hashlib
+import threading
+from functools import lru_cache
+from typing import Tuple
+
+
+# identified by the name of the command called in each block of the template
+MACRO_STEPS = ('define', 'pairwise', 'filter', 'optimize', 'fuse')
+MACRO_STEP_COMMANDS = {'define': 'run("BigStitcher"',
+                       'pairwise': 'run("Calculate pairwise shifts',
+                       'filter': 'run("Filter pairwise shifts',
+                       'optimize': 'run("Optimize globally and apply shifts',
+                       'fuse': 'run("Fuse dataset',
+                       'quit': 'run("Quit")'}
+
+TEMPLATE_DIR = osp.dirname(osp.abspath(__file__))
+# every placeholder a template has to contain, templates with other placeholders are rejected
+TEMPLATE_PLACEHOLDERS = {'bigstitcher_macro_template.ijm': {'img_dir', 'out_dir', 'path_to_xml_file', 'pattern', 'num_tiles',
+                                                            'num_tiles_x', 'num_tiles_y', 'overlap_x', 'overlap_y', 'overlap_z',
+                                                            'pixel_distance_x', 'pixel_distance_y', 'pixel_distance_z',
+                                                            'downsample_x', 'downsample_y'},
+                         'fuse_only.ijm': {'path_to_xml_file', 'out_dir', 'bounding_box'}}
+
+
+def split_macro_into_steps(macro: str) -> dict:
+    """ Blocks of the template are separated by empty lines """
+    blocks = [block.strip('\n') for block in re.split(r'\n\s*\n', macro) if block.strip()]
+    steps = dict()
+    for block in blocks:
+        for step, command in MACRO_STEP_COMMANDS.items():
+            if command in block:
+                steps[step] = block
+                break
+        else:
+            raise ValueError('Unknown block in macro template:\n' + block)
+    return steps
+
+
+def add_step_timing(macro: str) -> str:
+    """ Prints STEP_TIMING lines with epoch milliseconds before and after every step,
+        they are parsed from Fiji console output into the run report
+    """
+    steps = split_macro_into_steps(macro)
+    blocks = []
+    for step, block in steps.items():
+        if step != 'quit':
+            block = ('print("STEP_TIMING {s} start " + d2s(getTime(), 0));\n'.format(s=step) + block +
+                     '\nprint("STEP_TIMING {s} end " + d2s(getTime(), 0));'.format(s=step))
+        blocks.append(block)
+    return '\n\n'.join(blocks) + '\n'
+
+
+def get_placeholders(template: str) -> set:
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+@lru_cache(maxsize=None)
+def load_template(file_name: str) -> str:
+    """ Template shipped next to this module, read once per process and checked against TEMPLATE_PLACEHOLDERS """
+    path = px.join(TEMPLATE_DIR, file_name)
+    if not osp.exists(path):
+        raise FileNotFoundError('Macro template is missing: ' + path)
+    with open(path, 'r') as f:
+        template = f.read()
+    placeholders = get_placeholders(template)
+    expected = TEMPLATE_PLACEHOLDERS[file_name]
+    if placeholders != expected:
+        raise ValueError('Macro template ' + path + ' does not match the generator, missing placeholders: ' +
+                         str(sorted(expected - placeholders)) + ', unknown placeholders: ' + str(sorted(placeholders - expected)))
+    return template
+
+
+@lru_cache(maxsize=None)
+def get_macro_template(file_name: str, steps: Tuple[str] = None) -> str:
+    """ Template with selected steps and step timing, cached for every combination of steps """
+    template = load_template(file_name)
+    if steps is not None and list(steps) != list(MACRO_STEPS):
+        blocks = split_macro_into_steps(template)
+        template = '\n\n'.join([blocks[step] for step in MACRO_STEPS if step in steps] + [blocks['quit']]) + '\n'
+    return add_step_timing(template)
+
+
+def write_macro_file(macro_dir: str, prefix: str, macro: str) -> str:
+    """ File name contains hash of the macro, so jobs with different macros never write to the same file,
+        and the file is replaced atomically, so a job never reads a partially written macro
+    """
+    macro_path = px.join(macro_dir, '{p}_{h}.ijm'.format(p=prefix, h=hashlib.sha1(macro.encode('utf-8')).hexdigest()[:10]))
+    tmp_path = '{m}.{pid}.{tid}.tmp'.format(m=macro_path, pid=os.getpid(), tid=threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        f.write(macro)
+    os.replace(tmp_path, macro_path)
+    return macro_path
 
 
 class BigStitcherMacro:
@@ -27,7 +120,15 @@ class BigStitcherMacro:
         self.pixel_distance_y = 1
         self.pixel_distance_z = 1
 
-        self.__location = osp.dirname(os.path.abspath(__file__))
+        # pairwise shifts are computed on images downsampled by this factor: 1, 2, 4 or 8
+        self.downsample_x = 1
+        self.downsample_y = 1
+
+        # subset of MACRO_STEPS to run, quit is always added at the end
+        self.steps = list(MACRO_STEPS)
+
+        # where the macro file is written, out_dir if not set
+        self.macro_dir = None
 
 
     def generate(self):
@@ -38,10 +139,7 @@ class BigStitcherMacro:
 
 
     def read_macro_template(self):
-        macro_template_file = px.join(self.__location, 'bigstitcher_macro_template.ijm')
-        with open(macro_template_file, 'r') as f:
-            macro_file = f.read()
-        return macro_file
+        return get_macro_template('bigstitcher_macro_template.ijm', tuple(self.steps))
 
 
     def replace_values(self, macro_template):
@@ -57,18 +155,16 @@ class BigStitcherMacro:
                                                 overlap_z=self.overlap_z,
                                                 pixel_distance_x=self.pixel_distance_x,
                                                 pixel_distance_y=self.pixel_distance_y,
-                                                pixel_distance_z=self.pixel_distance_z
+                                                pixel_distance_z=self.pixel_distance_z,
+                                                downsample_x=self.downsample_x,
+                                                downsample_y=self.downsample_y
                                                 )
         return formatted_macro
 
 
     def write_to_temp_macro_file(self, formatted_macro):
-        # current_date_time_list = list(datetime.timetuple(datetime.now()))[:7]
-        # current_date_time_str = ''.join((str(val) for val in current_date_time_list))
-        macro_file_path = px.join(self.__location, 'bigstitcher_macro.ijm')
-        with open(macro_file_path, 'w') as f:
-            f.write(formatted_macro)
-        return macro_file_path
+        macro_dir = self.macro_dir if self.macro_dir is not None else self.out_dir
+        return write_macro_file(macro_dir, 'bigstitcher_macro', formatted_macro)
 
     def make_range(self, number):
         return ','.join([str(n) for n in range(1, number+1)])
@@ -79,30 +175,30 @@ class FuseMacro:
         self.img_dir = '.'
         self.xml_file_name = 'dataset.xml'
         self.out_dir = '.'
-        self.__location = osp.dirname(os.path.abspath(__file__))
+        # All Views or name of a bounding box defined in the xml
+        self.bounding_box = 'All Views'
+        # where the macro file is written, img_dir if not set
+        self.macro_dir = None
 
     def generate(self):
         macro_template = self.read_macro_template()
         formatted_macro = self.replace_values(macro_template)
-        macro_file_path = self.write_to_macro_file_in_channel_dir(self.img_dir, formatted_macro)
+        macro_dir = self.macro_dir if self.macro_dir is not None else self.img_dir
+        macro_file_path = self.write_to_macro_file_in_channel_dir(macro_dir, formatted_macro)
+        return macro_file_path
 
 
     def read_macro_template(self):
-        macro_template_file = px.join(self.__location, 'fuse_only.ijm')
-        with open(macro_template_file, 'r') as f:
-            macro_file = f.read()
-        return macro_file
+        return get_macro_template('fuse_only.ijm')
 
 
     def replace_values(self, macro_template: str):
         formatted_macro = macro_template.format(img_dir=self.img_dir,
                                                 path_to_xml_file=px.join(self.img_dir, self.xml_file_name),
-                                                out_dir=self.out_dir)
+                                                out_dir=self.out_dir,
+                                                bounding_box=self.bounding_box)
         return formatted_macro
 
 
     def write_to_macro_file_in_channel_dir(self, img_dir: str, formatted_macro: str):
-        macro_file_path = px.join(img_dir, 'fuse_only_macro.ijm')
-        with open(macro_file_path, 'w') as f:
-            f.write(formatted_macro)
-        return macro_file_path
+        return write_macro_file(img_dir, 'fuse_only_macro', formatted_macro)
@@ -0,0 +1,122 @@
+from typing import List, Dict, Tuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+from scipy.sparse.csgraph import connected_components
+
+from bigstitcher_xml import read_xml, write_xml, get_pairwise_results, get_view_setup_attributes, \
+    get_view_registrations, prepend_view_transform, remove_view_transforms, translation_affine
+
+
+def build_link_matrix(num_tiles: int, links: List[Tuple[int, int]], weights: np.ndarray, prior_weight: float):
+    """ One row per link: pos_b - pos_a = shift, and one weak row per tile: pos = 0,
+        which keeps unconnected tiles and groups of tiles at their grid position
+    """
+    num_links = len(links)
+    sqrt_w = np.sqrt(weights)
+    rows = np.repeat(np.arange(num_links), 2)
+    cols = np.array(links, dtype=np.int64).ravel()
+    vals = np.empty(2 * num_links)
+    vals[0::2] = -sqrt_w
+    vals[1::2] = sqrt_w
+    link_matrix = sparse.csr_matrix((vals, (rows, cols)), shape=(num_links, num_tiles))
+    prior_matrix = sparse.identity(num_tiles, format='csr') * prior_weight
+    return sparse.vstack([link_matrix, prior_matrix], format='csr')
+
+
+def solve_positions(num_tiles: int, links: List[Tuple[int, int]], shifts: np.ndarray, weights: np.ndarray,
+                    prior_weight: float = 1e-3) -> np.ndarray:
+    """ Least squares corrections (x, y) of every tile """
+    A = build_link_matrix(num_tiles, links, weights, prior_weight)
+    sqrt_w = np.sqrt(weights)
+    solution = np.zeros((num_tiles, 2))
+    for axis in range(0, 2):
+        b = np.concatenate([shifts[:, axis] * sqrt_w, np.zeros(num_tiles)])
+        solution[:, axis] = lsqr(A, b, atol=1e-10, btol=1e-10)[0]
+    return solution
+
+
+def get_link_errors(solution: np.ndarray, links: List[Tuple[int, int]], shifts: np.ndarray) -> np.ndarray:
+    links = np.array(links, dtype=np.int64)
+    predicted = solution[links[:, 1]] - solution[links[:, 0]]
+    return np.linalg.norm(predicted - shifts, axis=1)
+
+
+def anchor_groups(solution: np.ndarray, links: List[Tuple[int, int]], fixed_tile: int = 0) -> np.ndarray:
+    """ Group of tiles connected to fixed_tile is moved so fixed_tile keeps its grid position,
+        other groups are centred on their grid positions
+    """
+    num_tiles = solution.shape[0]
+    if links:
+        links = np.array(links, dtype=np.int64)
+        graph = sparse.csr_matrix((np.ones(len(links)), (links[:, 0], links[:, 1])), shape=(num_tiles, num_tiles))
+        num_groups, labels = connected_components(graph, directed=False)
+    else:
+        num_groups, labels = num_tiles, np.arange(num_tiles)
+
+    anchored = solution.copy()
+    for group in range(0, num_groups):
+        in_group = labels == group
+        if in_group[fixed_tile]:
+            anchored[in_group] -= solution[fixed_tile]
+        else:
+            anchored[in_group] -= solution[in_group].mean(axis=0)
+    return anchored
+
+
+def optimize_tile_positions(num_tiles: int, results: List[dict], relative_threshold: float = 2.5,
+                            absolute_threshold: float = 3.5, max_iterations: int = 1000) -> Dict[int, Tuple[float, float]]:
+    """ Solves for tile corrections and iteratively drops the worst link while its error is
+        above absolute_threshold pixels and above relative_threshold times the mean link error,
+        same criteria as BigStitcher global optimization
+    """
+    links = [(r['setup_a'], r['setup_b']) for r in results]
+    shifts = np.array([r['shift'][:2] for r in results], dtype=np.float64).reshape(-1, 2)
+    weights = np.array([max(r['correlation'], 1e-3) for r in results], dtype=np.float64)
+
+    solution = np.zeros((num_tiles, 2))
+    for i in range(0, max_iterations):
+        if not links:
+            break
+        solution = solve_positions(num_tiles, links, shifts, weights)
+        errors = get_link_errors(solution, links, shifts)
+        worst = int(np.argmax(errors))
+        mean_error = errors.mean()
+        if errors[worst] <= absolute_threshold or errors[worst] <= relative_threshold * mean_error:
+            break
+        print('Removing link', links[worst], 'with error', round(float(errors[worst]), 2), 'px')
+        del links[worst]
+        shifts = np.delete(shifts, worst, axis=0)
+        weights = np.delete(weights, worst)
+
+    solution = anchor_groups(solution, links)
+    return {tile: (float(solution[tile, 0]), float(solution[tile, 1])) for tile in range(0, num_tiles)}
+
+
+def optimize_globally(xml_path: str, relative_threshold: float = 2.5, absolute_threshold: float = 3.5,
+                      transform_name: str = 'Stitching Transform'):
+    """ Reads pairwise shifts from dataset.xml, solves for tile positions and writes them back as
+        one translation per view. Shifts are expected to be corrections of view b relative to view a,
+        on top of the transforms already stored in the xml.
+    """
+    root = read_xml(xml_path)
+    setup_attributes = get_view_setup_attributes(root)
+    tile_of_setup = {setup: attributes['tile'] for setup, attributes in setup_attributes.items()}
+    num_tiles = max(tile_of_setup.values()) + 1
+
+    results = []
+    for result in get_pairwise_results(root):
+        result = dict(result)
+        result['setup_a'] = tile_of_setup[result['setup_a']]
+        result['setup_b'] = tile_of_setup[result['setup_b']]
+        results.append(result)
+
+    corrections = optimize_tile_positions(num_tiles, results, relative_threshold, absolute_threshold)
+
+    remove_view_transforms(root, transform_name)
+    for setup, registration in get_view_registrations(root).items():
+        x, y = corrections[tile_of_setup[setup]]
+        prepend_view_transform(registration, transform_name, translation_affine(x, y))
+    write_xml(root, xml_path)
+    return corrections
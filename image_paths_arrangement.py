@@ -1,8 +1,16 @@
 import os
 import os.path as osp
 import posixpath as px
-from typing import List, Dict, Set, Union
+from typing import List, Dict, Tuple
 import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# region_tile_zplane_channel, e.g. 1_00001_Z002_CH3.tif
+IMG_NAME_PATTERN = re.compile(r'^(\d+)_(\d+)_Z(\d+)_CH(\d+)\.tiff?$')
 
 
 def alpha_num_order(string: str) -> str:
@@ -13,26 +21,6 @@ def alpha_num_order(string: str) -> str:
                     else x for x in re.split(r'(\d+)', string)])
 
 
-def add_to_dict(dictionary: dict, key: Union[int, str], value: Union[dict, set, list]) -> dict:
-    """ Will add key-value pair to dictionary, otherwise will update key-value pair """
-    if key in dictionary:
-        key_present = True
-        child_value_type = type(dictionary[key])
-    else:
-        key_present = False
-        child_value_type = type(value)
-
-    if key_present:
-
-        if child_value_type is list:
-            dictionary[key].extend(value)
-        else:
-            dictionary[key].update(value)
-    else:
-        dictionary[key] = value
-    return dictionary
-
-
 def get_img_listing(in_dir: str) -> List[str]:
     allowed_extensions = ('.tif', '.tiff')
     listing = os.listdir(in_dir)
@@ -40,43 +28,131 @@ def get_img_listing(in_dir: str) -> List[str]:
     return img_listing
 
 
-def extract_digits_from_string(string: str):
-    digits = [int(x) for x in re.split(r'(\d+)', string) if x.isdigit()]  # '1_00001_Z02_CH3' -> ['1', '00001', '02', '3']
-    return digits
-
-
-def create_arrangement_skeleton_by_channel_tile_zplane(listing: List[str]) -> Dict[int, Dict[int, Set[int]]]:
-    tile_arrangement = dict()
-    for file_name in listing:
-        digits = extract_digits_from_string(file_name)
-        tile = digits[1]
-        zplane = digits[2]
-        channel = digits[3]
-        tile_arrangement = add_to_dict(tile_arrangement, channel, {})
-        tile_arrangement[channel] = add_to_dict(tile_arrangement[channel], tile, {zplane})
-
-    return tile_arrangement
-
-
-def arrange_listing(img_dir: str, listing: List[str]) -> Dict[int, Dict[int, Dict[int, str]]]:
-    pattern = "1_{tile:05d}_Z{zplane:03d}_CH{channel:d}.tif"
-
-    tile_arrangement = create_arrangement_skeleton_by_channel_tile_zplane(listing)
-
-    arranged_listing = dict()
-    for channel in tile_arrangement:
-        for tile in tile_arrangement[channel]:
-            for zplane in tile_arrangement[channel][tile]:
-                file_name = pattern.format(tile=tile, zplane=zplane, channel=channel)
-                file_path = px.join(img_dir, file_name)
-                arranged_listing = add_to_dict(arranged_listing, channel, {})
-                arranged_listing[channel] = add_to_dict(arranged_listing[channel], tile, {zplane: file_path})
-
-    return arranged_listing
-
-
-def get_image_paths_arranged_in_dict(img_dir: str):
-    img_listing = get_img_listing(img_dir)
-    arranged_listing = arrange_listing(img_dir, img_listing)
-
-    return arranged_listing
+def scan_img_dir(img_dir: str) -> Dict[str, np.ndarray]:
+    """ One os.scandir pass, every file name is parsed once """
+    region, tile, zplane, channel, file_names = [], [], [], [], []
+    with os.scandir(img_dir) as entries:
+        for entry in entries:
+            match = IMG_NAME_PATTERN.match(entry.name)
+            if match is None:
+                continue
+            r, t, z, c = match.groups()
+            region.append(int(r))
+            tile.append(int(t))
+            zplane.append(int(z))
+            channel.append(int(c))
+            file_names.append(entry.name)
+    return dict(region=np.array(region, dtype=np.int32), tile=np.array(tile, dtype=np.int32),
+                zplane=np.array(zplane, dtype=np.int32), channel=np.array(channel, dtype=np.int32),
+                file_name=np.array(file_names, dtype=str))
+
+
+def get_cache_path(cache_dir: str, img_dir: str) -> str:
+    dir_hash = hashlib.sha1(osp.abspath(img_dir).encode()).hexdigest()[:16]
+    return px.join(cache_dir, 'listing_index_' + dir_hash + '.npz')
+
+
+def scan_img_dir_with_cache(img_dir: str, cache_dir: str = None, save_cache: bool = True) -> Dict[str, np.ndarray]:
+    """ Cached listing is valid while modification time of img_dir is unchanged, with save_cache=False it is only read """
+    if cache_dir is None:
+        return scan_img_dir(img_dir)
+    dir_mtime = os.stat(img_dir).st_mtime_ns
+    cache_path = get_cache_path(cache_dir, img_dir)
+    if osp.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if int(cache['dir_mtime']) == dir_mtime:
+                    return {key: cache[key] for key in cache.files if key != 'dir_mtime'}
+        except (OSError, ValueError, KeyError):
+            pass
+    columns = scan_img_dir(img_dir)
+    if not save_cache:
+        return columns
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, dir_mtime=np.int64(dir_mtime), **columns)
+    os.replace(tmp_path, cache_path)
+    return columns
+
+
+class DatasetIndex:
+    """ Table of all images: one row per file with cycle, region, tile, z-plane, channel columns.
+        Cycles start from 1 and follow the order of img_dirs.
+    """
+    def __init__(self, img_dirs: List[str], columns: Dict[str, np.ndarray]):
+        self.img_dirs = list(img_dirs)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['file_name'])
+
+    def get_path(self, row: int) -> str:
+        return px.join(self.img_dirs[self.columns['cycle'][row] - 1], str(self.columns['file_name'][row]))
+
+    def select(self, **conditions) -> np.ndarray:
+        """ Row numbers where every column equals the given value, e.g. select(cycle=1, channel=2) """
+        mask = np.ones(len(self), dtype=bool)
+        for column, value in conditions.items():
+            mask &= self.columns[column] == value
+        return np.flatnonzero(mask)
+
+    def get_unique(self, column: str, rows: np.ndarray = None) -> List[int]:
+        values = self.columns[column] if rows is None else self.columns[column][rows]
+        return [int(v) for v in np.unique(values)]
+
+    def get_paths(self, rows: np.ndarray) -> np.ndarray:
+        dir_prefixes = np.array([px.join(img_dir, '') for img_dir in self.img_dirs])
+        return np.char.add(dir_prefixes[self.columns['cycle'][rows] - 1], self.columns['file_name'][rows])
+
+    def select_cycle(self, cycle: int, region: int = None) -> np.ndarray:
+        """ Rows of one cycle, region is required only if the cycle has several regions """
+        rows = self.select(cycle=cycle)
+        if region is None:
+            regions = self.get_unique('region', rows)
+            if len(regions) > 1:
+                raise ValueError('Cycle ' + str(cycle) + ' has several regions ' + str(regions) + ', select one of them')
+            return rows
+        return rows[self.columns['region'][rows] == region]
+
+    def get_channels(self, cycle: int, region: int = None) -> List[int]:
+        return self.get_unique('channel', self.select_cycle(cycle, region))
+
+    def get_zplane_table(self, cycle: int, channel: int, region: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Sorted tile ids, sorted z-plane ids and tile x z-plane array of paths of one channel,
+            paths of missing z-planes are empty strings
+        """
+        rows = self.select_cycle(cycle, region)
+        rows = rows[self.columns['channel'][rows] == channel]
+        tiles, tile_index = np.unique(self.columns['tile'][rows], return_inverse=True)
+        zplanes, zplane_index = np.unique(self.columns['zplane'][rows], return_inverse=True)
+        row_paths = self.get_paths(rows)
+        paths = np.full((len(tiles), len(zplanes)), '', dtype=row_paths.dtype)
+        paths[tile_index, zplane_index] = row_paths
+        return tiles, zplanes, paths
+
+    def get_tile_paths(self, cycle: int, channel: int, region: int = None) -> Dict[int, Dict[int, str]]:
+        """ {tile: {zplane: path}} of one channel """
+        tiles, zplanes, paths = self.get_zplane_table(cycle, channel, region)
+        present = paths != ''
+        zplane_ids = zplanes.tolist()
+        return {tile: {z: path for z, path, p in zip(zplane_ids, tile_paths, tile_present) if p}
+                for tile, tile_paths, tile_present in zip(tiles.tolist(), paths.tolist(), present.tolist())}
+
+    def get_arranged_listing(self, cycle: int, region: int = None) -> Dict[int, Dict[int, Dict[int, str]]]:
+        """ {channel: {tile: {zplane: path}}} sorted by channel, tile and z-plane """
+        return {channel: self.get_tile_paths(cycle, channel, region) for channel in self.get_channels(cycle, region)}
+
+
+def build_dataset_index(img_dirs: List[str], num_workers: int = 1, cache_dir: str = None, save_cache: bool = True) -> DatasetIndex:
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        listings = list(executor.map(lambda img_dir: scan_img_dir_with_cache(img_dir, cache_dir, save_cache), img_dirs))
+
+    columns = dict()
+    for key in listings[0]:
+        columns[key] = np.concatenate([listing[key] for listing in listings])
+    columns['cycle'] = np.concatenate([np.full(len(listing['file_name']), cycle, dtype=np.int32)
+                                       for cycle, listing in enumerate(listings, start=1)])
+    return DatasetIndex(img_dirs, columns)
+
+
+def get_image_paths_arranged_in_dict(img_dir: str, region: int = None):
+    return build_dataset_index([img_dir]).get_arranged_listing(1, region)
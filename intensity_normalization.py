@@ -0,0 +1,107 @@
+import os.path as osp
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tif
+
+from projection import project_planes, read_dtype_from_header
+
+
+def get_tile_projection_options(projection_options: dict, dst: str) -> dict:
+    """ Projection options of one tile, with the intensity range of its channel dir instead of ranges of all channels """
+    options = {key: value for key, value in projection_options.items() if key != 'intensity_ranges'}
+    intensity_ranges = projection_options.get('intensity_ranges')
+    if intensity_ranges is not None:
+        options['intensity_range'] = intensity_ranges[osp.dirname(dst)]
+    return options
+
+
+def needs_decoding(src: List[str], projection_options: dict) -> bool:
+    """ Tile with one selected plane that is not normalized, converted or compressed can be linked or copied """
+    return (len(src) > 1 or projection_options['normalize'] != 'none' or
+            projection_options.get('output_dtype', 'source') != 'source' or projection_options.get('compression', 'none') != 'none')
+
+
+def read_sampled_plane(path: str, sample_step: int) -> np.ndarray:
+    """ Every sample_step-th pixel in y and x, uncompressed files are memory mapped so not all rows are read """
+    try:
+        img = tif.memmap(path, mode='r')
+    except ValueError:
+        img = tif.imread(path)
+    img = img.reshape(img.shape[-2:])
+    return np.ascontiguousarray(img[::sample_step, ::sample_step])
+
+
+def get_projected_samples(src: List[str], weights: List[float], method: str, sample_step: int) -> np.ndarray:
+    """ Projection is computed pixel by pixel, so projection of sampled planes equals samples of the projection """
+    return project_planes(src, method, weights, read_plane=lambda path: read_sampled_plane(path, sample_step)).ravel()
+
+
+class ChannelIntensityStats:
+    """ Streaming min, max and histogram of projected intensities of one channel.
+        Histogram has one bin per integer value of 8 and 16 bit images, other images only have min and max.
+    """
+    def __init__(self, dtype: np.dtype):
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = None
+        if np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2:
+            info = np.iinfo(dtype)
+            self.offset = int(info.min)
+            self.histogram = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+
+    def add(self, samples: np.ndarray):
+        if samples.size == 0:
+            return
+        self.min = min(self.min, float(samples.min()))
+        self.max = max(self.max, float(samples.max()))
+        if self.histogram is not None:
+            bins = np.rint(samples).astype(np.int64) - self.offset
+            np.clip(bins, 0, self.histogram.size - 1, out=bins)
+            self.histogram += np.bincount(bins, minlength=self.histogram.size)
+
+    def get_range(self, mode: str, percentiles: List[float] = (0.1, 99.9)) -> List[float]:
+        """ Percentiles need the histogram, images that are not 8 or 16 bit fall back to min and max with a warning """
+        if mode == 'percentile' and self.histogram is None:
+            print('Warning: percentiles are computed only for 8 and 16 bit images, using min and max of the channel instead')
+        if mode == 'percentile' and self.histogram is not None and self.histogram.sum() > 0:
+            cdf = np.cumsum(self.histogram) / self.histogram.sum()
+            low = int(np.searchsorted(cdf, percentiles[0] / 100)) + self.offset
+            high = int(np.searchsorted(cdf, percentiles[1] / 100)) + self.offset
+            return [float(low), float(high)]
+        return [self.min, self.max]
+
+
+def select_sample_tiles(tasks: List[tuple], max_sample_tiles: int) -> List[tuple]:
+    if max_sample_tiles is None or len(tasks) <= max_sample_tiles:
+        return tasks
+    indices = np.linspace(0, len(tasks) - 1, max_sample_tiles).round().astype(int)
+    return [tasks[i] for i in np.unique(indices)]
+
+
+def compute_channel_intensity_ranges(channel_image_paths: Dict[int, List[tuple]], projection_options: dict,
+                                     num_workers: int = 1) -> Dict[str, List[float]]:
+    """ One pass over sampled pixels of evenly spaced tiles of every channel.
+        Returns {channel_out_dir: [low, high]}, tiles are later rescaled with the range of their channel.
+    """
+    mode = projection_options['normalize']
+    sample_step = projection_options.get('sample_step', 4)
+    max_sample_tiles = projection_options.get('max_sample_tiles', 100)
+    percentiles = projection_options.get('percentiles', [0.1, 99.9])
+
+    intensity_ranges = dict()
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        for channel, tasks in channel_image_paths.items():
+            if not tasks:
+                continue
+            stats = ChannelIntensityStats(read_dtype_from_header(tasks[0][0][0]))
+            sample_tasks = select_sample_tiles(tasks, max_sample_tiles)
+            samples_per_tile = executor.map(
+                lambda task: get_projected_samples(task[0], task[2], projection_options['method'], sample_step), sample_tasks)
+            for samples in samples_per_tile:
+                stats.add(samples)
+            channel_dir = osp.dirname(tasks[0][1])
+            intensity_ranges[channel_dir] = stats.get_range(mode, percentiles)
+            print('Intensity range of', channel_dir, intensity_ranges[channel_dir], 'from', len(sample_tasks), 'tiles')
+    return intensity_ranges
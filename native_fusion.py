@@ -0,0 +1,124 @@
+import os.path as osp
+import posixpath as px
+from functools import lru_cache
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tif
+
+from bigstitcher_xml import read_xml, get_view_transforms, get_view_setup_sizes, get_view_setup_attributes, get_file_mappings
+
+
+def get_tile_placements(xml_path: str, img_dir: str, channel: int = 0) -> List[dict]:
+    """ Integer (x, y) offset, size and path of every tile of a channel.
+        Tile file names are taken from the xml and looked up in img_dir,
+        so the reference registration can be applied to other channels.
+    """
+    root = read_xml(xml_path)
+    transforms = get_view_transforms(root)
+    sizes = get_view_setup_sizes(root)
+    attributes = get_view_setup_attributes(root)
+    file_mappings = get_file_mappings(root)
+
+    placements = []
+    for setup, model in transforms.items():
+        if attributes[setup]['channel'] != channel:
+            continue
+        if not np.allclose(model[:2, :2], np.eye(2), atol=1e-3):
+            raise ValueError('Only translations are supported in xy, view setup ' + str(setup) + ' has\n' + str(model))
+        path = px.join(img_dir, osp.basename(file_mappings[setup]))
+        placements.append(dict(path=path,
+                               offset=(int(round(model[0, 3])), int(round(model[1, 3]))),
+                               size=sizes[setup][:2]))
+    return placements
+
+
+def get_mosaic_extent(placements: List[dict]) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """ ((min_x, min_y), (width, height)) """
+    min_x = min(p['offset'][0] for p in placements)
+    min_y = min(p['offset'][1] for p in placements)
+    max_x = max(p['offset'][0] + p['size'][0] for p in placements)
+    max_y = max(p['offset'][1] + p['size'][1] for p in placements)
+    return (min_x, min_y), (max_x - min_x, max_y - min_y)
+
+
+def get_blending_weights(length: int, blend_range: int) -> np.ndarray:
+    """ Linear ramp from tile border to blend_range px inside the tile """
+    distance = np.minimum(np.arange(length), np.arange(length)[::-1]) + 1
+    return np.minimum(distance, blend_range).astype(np.float32) / blend_range
+
+
+def make_tile_reader(max_cached_tiles: int):
+    @lru_cache(maxsize=max_cached_tiles)
+    def read_tile(path: str) -> np.ndarray:
+        try:
+            return tif.memmap(path, mode='r')
+        except ValueError:
+            # compressed or not contiguous
+            return tif.imread(path)
+    return read_tile
+
+
+def fuse_block(placements: List[dict], origin: Tuple[int, int], block_x: int, block_y: int, block_width: int,
+               block_height: int, read_tile, blend_range: int, dtype) -> np.ndarray:
+    x0 = origin[0] + block_x
+    y0 = origin[1] + block_y
+    x1 = x0 + block_width
+    y1 = y0 + block_height
+    fused = np.zeros((block_height, block_width), dtype=np.float32)
+    weight_sum = np.zeros((block_height, block_width), dtype=np.float32)
+
+    for placement in placements:
+        tx, ty = placement['offset']
+        tw, th = placement['size']
+        ix0, ix1 = max(x0, tx), min(x1, tx + tw)
+        iy0, iy1 = max(y0, ty), min(y1, ty + th)
+        if ix0 >= ix1 or iy0 >= iy1:
+            continue
+        tile = read_tile(placement['path'])
+        region = tile[iy0 - ty:iy1 - ty, ix0 - tx:ix1 - tx]
+        weights = np.outer(get_blending_weights(th, blend_range)[iy0 - ty:iy1 - ty],
+                           get_blending_weights(tw, blend_range)[ix0 - tx:ix1 - tx])
+        out = (slice(iy0 - y0, iy1 - y0), slice(ix0 - x0, ix1 - x0))
+        fused[out] += region * weights
+        weight_sum[out] += weights
+
+    np.divide(fused, weight_sum, out=fused, where=weight_sum > 0)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.rint(fused, out=fused)
+        np.clip(fused, info.min, info.max, out=fused)
+    return fused.astype(dtype)
+
+
+def fuse_channel(xml_path: str, img_dir: str, out_path: str, num_workers: int = 1, block_size: int = 1024,
+                 blend_range: int = 40, compression: str = 'zlib', max_cached_tiles: int = 64):
+    """ Fuses tiles block by block and streams blocks into a tiled BigTIFF.
+        Every block is one tiff tile, so at most 2 x num_workers blocks are held in memory.
+    """
+    if block_size % 16 != 0:
+        raise ValueError('Block size must be a multiple of 16, got ' + str(block_size))
+
+    placements = get_tile_placements(xml_path, img_dir)
+    origin, (width, height) = get_mosaic_extent(placements)
+    with tif.TiffFile(placements[0]['path']) as f:
+        dtype = f.pages[0].dtype
+    read_tile = make_tile_reader(max_cached_tiles)
+
+    block_coordinates = [(bx, by) for by in range(0, height, block_size) for bx in range(0, width, block_size)]
+
+    def fuse(coordinates):
+        bx, by = coordinates
+        return fuse_block(placements, origin, bx, by, block_size, block_size, read_tile, blend_range, dtype)
+
+    def fused_blocks():
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            chunk_size = 2 * num_workers
+            for i in range(0, len(block_coordinates), chunk_size):
+                yield from executor.map(fuse, block_coordinates[i:i + chunk_size])
+
+    tif.imwrite(out_path, fused_blocks(), shape=(height, width), dtype=dtype, tile=(block_size, block_size),
+                compression=compression, bigtiff=True, photometric='minisblack')
+    read_tile.cache_clear()
+    return out_path
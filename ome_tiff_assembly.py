@@ -0,0 +1,130 @@
+import os.path as osp
+import posixpath as px
+import tempfile
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tif
+
+
+def open_as_memmap(img_path: str, tmp_dir: str) -> np.ndarray:
+    """ Memory maps uncompressed images, other images are decoded tile by tile or strip by strip
+        into a temporary memory mapped file, so the whole image is never held in memory
+    """
+    try:
+        img = tif.memmap(img_path, mode='r')
+        if img.ndim == 2:
+            return img
+    except ValueError:
+        pass
+
+    with tif.TiffFile(img_path) as f:
+        page = f.pages[0]
+        height, width = page.shape[-2:]
+        tmp_path = px.join(tmp_dir, osp.basename(osp.dirname(img_path)) + '_level_0.raw')
+        out = np.memmap(tmp_path, dtype=page.dtype, mode='w+', shape=(height, width))
+
+        def copy_segment(decoded):
+            data, (s, d, y, x, c), shape = decoded
+            if data is None:
+                return
+            h = min(shape[1], height - y)
+            w = min(shape[2], width - x)
+            out[y:y + h, x:x + w] = data[0, :h, :w, 0]
+
+        for _ in page.segments(func=copy_segment):
+            pass
+    out.flush()
+    return out
+
+
+def downsample_2x(src: np.ndarray, tmp_path: str, block_size: int) -> np.ndarray:
+    """ 2x2 mean, computed in blocks of block_size rows of the output """
+    height, width = src.shape[0] // 2, src.shape[1] // 2
+    dst = np.memmap(tmp_path, dtype=src.dtype, mode='w+', shape=(height, width))
+    for y in range(0, height, block_size):
+        y1 = min(y + block_size, height)
+        for x in range(0, width, block_size):
+            x1 = min(x + block_size, width)
+            block = src[2 * y:2 * y1, 2 * x:2 * x1].astype(np.float32)
+            block = block.reshape(y1 - y, 2, x1 - x, 2).mean(axis=(1, 3))
+            if np.issubdtype(src.dtype, np.integer):
+                np.rint(block, out=block)
+            dst[y:y1, x:x1] = block.astype(src.dtype)
+    dst.flush()
+    return dst
+
+
+def get_num_levels(shape: tuple, tile_size: int) -> int:
+    """ Levels are added until the smaller side fits into one tile """
+    num_levels = 1
+    size = min(shape)
+    while size > tile_size:
+        size //= 2
+        num_levels += 1
+    return num_levels
+
+
+def build_pyramid(img_path: str, num_levels: int, tmp_dir: str, block_size: int) -> List[np.ndarray]:
+    levels = [open_as_memmap(img_path, tmp_dir)]
+    name = osp.basename(osp.dirname(img_path))
+    for level in range(1, num_levels):
+        tmp_path = px.join(tmp_dir, name + '_level_' + str(level) + '.raw')
+        levels.append(downsample_2x(levels[-1], tmp_path, block_size))
+    return levels
+
+
+def iterate_tiles(channel_imgs: List[np.ndarray], tile_size: int):
+    """ Tiles of every channel in the order expected by tifffile, edge tiles are padded """
+    for img in channel_imgs:
+        height, width = img.shape
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                tile = np.asarray(img[y:y + tile_size, x:x + tile_size])
+                if tile.shape != (tile_size, tile_size):
+                    padded = np.zeros((tile_size, tile_size), dtype=img.dtype)
+                    padded[:tile.shape[0], :tile.shape[1]] = tile
+                    tile = padded
+                yield tile
+
+
+def read_image_shape(img_path: str) -> tuple:
+    with tif.TiffFile(img_path) as f:
+        return f.pages[0].shape[-2:], f.pages[0].dtype
+
+
+def write_pyramidal_ome_tiff(channel_img_paths: List[str], output_path: str, channel_names: List[str],
+                             pixel_size_um: float = None, num_workers: int = 1, tile_size: int = 512,
+                             block_size: int = 4096, compression: str = 'zlib', tmp_dir: str = None):
+    """ Channels are read through memory maps, sub-resolution levels are computed in parallel
+        across channels into temporary memory mapped files and written as tiled, compressed SubIFDs.
+        Memory use depends on block_size and tile_size, not on the mosaic size.
+    """
+    shapes = [read_image_shape(path) for path in channel_img_paths]
+    if len(set(shapes)) != 1:
+        raise ValueError('Fused channels differ in shape or dtype: ' + str(dict(zip(channel_img_paths, shapes))))
+    (height, width), dtype = shapes[0]
+    num_channels = len(channel_img_paths)
+    num_levels = get_num_levels((height, width), tile_size)
+
+    metadata = {'axes': 'CYX', 'Channel': {'Name': list(channel_names)}}
+    if pixel_size_um is not None:
+        metadata.update({'PhysicalSizeX': pixel_size_um, 'PhysicalSizeXUnit': 'µm',
+                         'PhysicalSizeY': pixel_size_um, 'PhysicalSizeYUnit': 'µm'})
+    options = dict(dtype=dtype, tile=(tile_size, tile_size), compression=compression,
+                   photometric='minisblack', maxworkers=num_workers)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pyramids = list(executor.map(lambda path: build_pyramid(path, num_levels, tmp, block_size), channel_img_paths))
+
+        with tif.TiffWriter(output_path, bigtiff=True, ome=True) as writer:
+            writer.write(iterate_tiles([p[0] for p in pyramids], tile_size), shape=(num_channels, height, width),
+                         subifds=num_levels - 1, metadata=metadata, **options)
+            for level in range(1, num_levels):
+                level_imgs = [p[level] for p in pyramids]
+                writer.write(iterate_tiles(level_imgs, tile_size), shape=(num_channels,) + level_imgs[0].shape,
+                             subfiletype=1, metadata=None, **options)
+        del pyramids
+    return output_path
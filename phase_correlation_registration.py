@@ -0,0 +1,237 @@
+import posixpath as px
+from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile as tif
+from scipy import fft as sp_fft
+
+from tile_grid import get_snake_grid_positions, get_grid_translations, get_adjacent_tile_pairs
+from bigstitcher_xml import create_dataset, set_pairwise_results, write_xml, get_view_registrations, \
+    prepend_view_transform, translation_affine
+from global_optimization import optimize_tile_positions
+from run_report import timed
+
+
+def get_tile_file_names(num_tiles: int, pattern: str = '1_{tile:05d}_Z001.tif') -> List[str]:
+    return [pattern.format(tile=tile) for tile in range(1, num_tiles + 1)]
+
+
+def read_tile_size(tile_path: str) -> Tuple[int, int]:
+    """ (width, height) from tiff header """
+    with tif.TiffFile(tile_path) as f:
+        shape = f.pages[0].shape
+    return shape[-1], shape[-2]
+
+
+def phase_correlation_peaks(a: np.ndarray, b: np.ndarray, num_peaks: int = 5) -> List[Tuple[int, int]]:
+    """ Candidate shifts t such that a(p) = b(p - t), modulo the image size """
+    fa = sp_fft.rfft2(a.astype(np.float32))
+    fb = sp_fft.rfft2(b.astype(np.float32))
+    fa *= np.conj(fb)
+    fa /= np.abs(fa) + 1e-12
+    pcm = sp_fft.irfft2(fa, s=a.shape)
+    num_peaks = min(num_peaks, pcm.size)
+    peak_ids = np.argpartition(pcm.ravel(), -num_peaks)[-num_peaks:]
+    return [tuple(int(v) for v in np.unravel_index(i, pcm.shape)) for i in peak_ids]
+
+
+def get_overlap_correlation(a: np.ndarray, b: np.ndarray, dy: int, dx: int, min_overlap: int) -> float:
+    h, w = a.shape
+    ay0, ay1 = max(0, dy), min(h, h + dy)
+    ax0, ax1 = max(0, dx), min(w, w + dx)
+    if (ay1 - ay0) * (ax1 - ax0) < min_overlap:
+        return -1.0
+    a_roi = a[ay0:ay1, ax0:ax1].astype(np.float32).ravel()
+    b_roi = b[ay0 - dy:ay1 - dy, ax0 - dx:ax1 - dx].astype(np.float32).ravel()
+    a_roi -= a_roi.mean()
+    b_roi -= b_roi.mean()
+    denominator = np.sqrt(np.dot(a_roi, a_roi) * np.dot(b_roi, b_roi))
+    if denominator == 0:
+        return 0.0
+    return float(np.dot(a_roi, b_roi) / denominator)
+
+
+def downsample_image(img: np.ndarray, factor: int) -> np.ndarray:
+    """ Mean of factor x factor blocks, incomplete blocks at the border are dropped """
+    if factor == 1:
+        return img
+    h = img.shape[0] // factor * factor
+    w = img.shape[1] // factor * factor
+    return img[:h, :w].astype(np.float32).reshape(h // factor, factor, w // factor, factor).mean(axis=(1, 3))
+
+
+def refine_shift(a: np.ndarray, b: np.ndarray, dy: int, dx: int, min_overlap: int, max_steps: int,
+                 window: int = 256) -> Tuple[int, int, float]:
+    """ Moves (dy, dx) to the neighbouring shift with higher cross correlation until it is a local maximum.
+        Correlation is computed in a window of at most window x window px in the centre of the overlap,
+        the correlation of the final shift is computed over the whole overlap.
+    """
+    h, w = a.shape
+    margin = max_steps + 1
+    ay0, ay1 = max(0, dy) + margin, min(h, h + dy) - margin
+    ax0, ax1 = max(0, dx) + margin, min(w, w + dx) - margin
+    if ay1 - ay0 < 8 or ax1 - ax0 < 8:
+        return dy, dx, get_overlap_correlation(a, b, dy, dx, min_overlap)
+    hy = min(window, ay1 - ay0) // 2
+    hx = min(window, ax1 - ax0) // 2
+    cy = (ay0 + ay1) // 2
+    cx = (ax0 + ax1) // 2
+    a_win = a[cy - hy:cy + hy, cx - hx:cx + hx].astype(np.float32).ravel()
+    a_win -= a_win.mean()
+    a_norm = np.dot(a_win, a_win)
+
+    def correlation(shift):
+        sy, sx = shift
+        b_win = b[cy - hy - sy:cy + hy - sy, cx - hx - sx:cx + hx - sx].astype(np.float32).ravel()
+        b_win -= b_win.mean()
+        denominator = np.sqrt(a_norm * np.dot(b_win, b_win))
+        return float(np.dot(a_win, b_win) / denominator) if denominator > 0 else 0.0
+
+    start = (dy, dx)
+    correlations = {start: correlation(start)}
+    for _ in range(max_steps):
+        candidates = [(dy + i, dx + j) for i in (-1, 0, 1) for j in (-1, 0, 1)
+                      if abs(dy + i - start[0]) <= max_steps and abs(dx + j - start[1]) <= max_steps]
+        for candidate in candidates:
+            if candidate not in correlations:
+                correlations[candidate] = correlation(candidate)
+        best = max(candidates, key=correlations.get)
+        if best == (dy, dx):
+            break
+        dy, dx = best
+    return dy, dx, get_overlap_correlation(a, b, dy, dx, min_overlap)
+
+
+def register_pair(a: np.ndarray, b: np.ndarray, num_peaks: int = 5, min_overlap_fraction: float = 0.25,
+                  downsample: int = 1, refine: bool = True) -> Tuple[int, int, float]:
+    """ Shift (dy, dx) of b relative to a and cross correlation of the overlapping pixels.
+        Every phase correlation peak is ambiguous up to the image size, so all variants are checked.
+        With downsample > 1 the shift is found on downsampled images, scaled up
+        and refined at full resolution by hill climbing on cross correlation.
+    """
+    if downsample > 1:
+        dy, dx, r = register_pair(downsample_image(a, downsample), downsample_image(b, downsample), num_peaks,
+                                  min_overlap_fraction)
+        dy *= downsample
+        dx *= downsample
+        if not refine:
+            return dy, dx, r
+        return refine_shift(a, b, dy, dx, int(a.size * min_overlap_fraction), max_steps=2 * downsample)
+
+    h, w = a.shape
+    min_overlap = int(a.size * min_overlap_fraction)
+    best = (0, 0, -1.0)
+    for py, px_ in phase_correlation_peaks(a, b, num_peaks):
+        for dy in {py, py - h}:
+            for dx in {px_, px_ - w}:
+                r = get_overlap_correlation(a, b, dy, dx, min_overlap)
+                if r > best[2]:
+                    best = (dy, dx, r)
+    return best
+
+
+def get_overlap_strips(img_a: np.ndarray, img_b: np.ndarray, direction: str, overlap_px: int):
+    if direction == 'horizontal':
+        return img_a[:, -overlap_px:], img_b[:, :overlap_px]
+    else:
+        return img_a[-overlap_px:, :], img_b[:overlap_px, :]
+
+
+def register_adjacent_pair(img_a: np.ndarray, img_b: np.ndarray, direction: str, grid_delta: Tuple[float, float],
+                           downsample: int = 1, refine: bool = True) -> Tuple[Tuple[float, float], float]:
+    """ Correction of b position relative to its expected grid position, in pixels (x, y) """
+    height, width = img_a.shape
+    if direction == 'horizontal':
+        strip_offset = int(round(grid_delta[0]))
+        overlap_px = width - strip_offset
+        expected = (strip_offset - grid_delta[0], 0.0 - grid_delta[1])
+    else:
+        strip_offset = int(round(grid_delta[1]))
+        overlap_px = height - strip_offset
+        expected = (0.0 - grid_delta[0], strip_offset - grid_delta[1])
+    if overlap_px < 2 * downsample:
+        return (0.0, 0.0), 0.0
+    a_strip, b_strip = get_overlap_strips(img_a, img_b, direction, overlap_px)
+    dy, dx, r = register_pair(a_strip, b_strip, downsample=downsample, refine=refine)
+    return (expected[0] + dx, expected[1] + dy), r
+
+
+def compute_pairwise_shifts(tile_paths: List[str], positions: List[Tuple[int, int]],
+                            grid_translations: List[Tuple[float, float]], num_workers: int = 1,
+                            read_tile=tif.imread, downsample: int = 1, refine: bool = True) -> List[dict]:
+    """ Tiles are loaded one grid row at a time, pairs of each batch of two rows are registered in parallel """
+    pairs = get_adjacent_tile_pairs(positions)
+    pairs_per_row = dict()
+    for a, b, direction in pairs:
+        pairs_per_row.setdefault(positions[a][0], []).append((a, b, direction))
+
+    tiles_per_row = dict()
+    for tile, (row, col) in enumerate(positions):
+        tiles_per_row.setdefault(row, []).append(tile)
+
+    def register(pair):
+        a, b, direction = pair
+        grid_delta = (grid_translations[b][0] - grid_translations[a][0],
+                      grid_translations[b][1] - grid_translations[a][1])
+        shift, r = register_adjacent_pair(loaded[a], loaded[b], direction, grid_delta, downsample, refine)
+        return dict(setup_a=a, setup_b=b, shift=(shift[0], shift[1], 0.0), correlation=r)
+
+    results = []
+    loaded = dict()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for row in sorted(tiles_per_row):
+            for tile in tiles_per_row[row] + tiles_per_row.get(row + 1, []):
+                if tile not in loaded:
+                    loaded[tile] = read_tile(tile_paths[tile])
+            results.extend(executor.map(register, pairs_per_row.get(row, [])))
+            for tile in tiles_per_row[row]:
+                del loaded[tile]
+    return results
+
+
+def filter_pairwise_results(results: List[dict], min_r: float = 0.7, max_r: float = 1.0) -> List[dict]:
+    return [r for r in results if min_r <= r['correlation'] <= max_r]
+
+
+def apply_tile_corrections(root, corrections: Dict[int, Tuple[float, float]], num_tiles: int,
+                           transform_name: str = 'Stitching Transform'):
+    """ Same correction for every channel of a tile """
+    registrations = get_view_registrations(root)
+    for setup, registration in registrations.items():
+        x, y = corrections[setup % num_tiles]
+        prepend_view_transform(registration, transform_name, translation_affine(x, y))
+
+
+def register_with_phase_correlation(img_dir: str, info_for_bigstitcher: dict, xml_file_name: str = 'dataset.xml',
+                                    num_workers: int = 1, min_r: float = 0.7) -> str:
+    """ Writes BigStitcher dataset.xml with registered tiles of img_dir, tile positions and
+        overlaps are taken from the submission file. Shifts are computed on tiles downsampled
+        by info_for_bigstitcher['registration_downsample'] and refined at full resolution.
+    """
+    num_tiles = info_for_bigstitcher['num_tiles']
+    tile_file_names = get_tile_file_names(num_tiles)
+    tile_paths = [px.join(img_dir, file_name) for file_name in tile_file_names]
+    tile_width, tile_height = read_tile_size(tile_paths[0])
+
+    positions = get_snake_grid_positions(num_tiles, info_for_bigstitcher['num_tiles_x'], info_for_bigstitcher['num_tiles_y'])
+    grid_translations = get_grid_translations(positions, tile_width, tile_height,
+                                              info_for_bigstitcher['overlap_x'], info_for_bigstitcher['overlap_y'])
+
+    downsample = info_for_bigstitcher.get('registration_downsample', 1)
+    with timed('pairwise_shifts', downsample=downsample):
+        results = compute_pairwise_shifts(tile_paths, positions, grid_translations, num_workers, downsample=downsample)
+    filtered_results = filter_pairwise_results(results, min_r)
+    print('Pairwise links passing correlation threshold:', len(filtered_results), 'of', len(results))
+    with timed('global_optimization', links=len(filtered_results)):
+        corrections = optimize_tile_positions(num_tiles, filtered_results)
+
+    voxel_size = (info_for_bigstitcher['pixel_distance_x'], info_for_bigstitcher['pixel_distance_y'],
+                  info_for_bigstitcher['pixel_distance_z'])
+    root = create_dataset([tile_file_names], (tile_width, tile_height), voxel_size, grid_translations)
+    set_pairwise_results(root, filtered_results)
+    apply_tile_corrections(root, corrections, num_tiles)
+
+    xml_path = px.join(img_dir, xml_file_name)
+    write_xml(root, xml_path)
+    return xml_path
@@ -0,0 +1,160 @@
+from typing import List
+
+import numpy as np
+import tifffile as tif
+
+
+PROJECTION_METHODS = ('mean', 'max', 'weighted')
+# none: keep intensities, tile: every tile to its own min/max,
+# channel: every channel to its min/max, percentile: every channel to its low/high percentiles
+NORMALIZATION_MODES = ('none', 'tile', 'channel', 'percentile')
+OUTPUT_DTYPES = ('source', 'uint16', 'float32')
+
+
+def get_sum_dtype(dtype: np.dtype, num_planes: int) -> np.dtype:
+    """ Smallest accumulator that can hold sum of num_planes planes without overflow """
+    if np.issubdtype(dtype, np.integer):
+        max_sum = int(np.iinfo(dtype).max) * num_planes
+        if np.issubdtype(dtype, np.unsignedinteger):
+            return np.dtype(np.uint32) if max_sum <= np.iinfo(np.uint32).max else np.dtype(np.uint64)
+        return np.dtype(np.int32) if max_sum <= np.iinfo(np.int32).max else np.dtype(np.int64)
+    return np.dtype(np.float32)
+
+
+def normalize_weights(weights: List[float], num_planes: int) -> np.ndarray:
+    weights = np.asarray(weights, dtype=np.float32)
+    if weights.size != num_planes:
+        raise ValueError('Number of weights ' + str(weights.size) + ' does not match number of z-planes ' + str(num_planes))
+    weights = np.clip(weights, 0, None)
+    total = weights.sum()
+    if total == 0:
+        return np.full(num_planes, 1.0 / num_planes, dtype=np.float32)
+    return weights / total
+
+
+def mean_projection(path_list: List[str], read_plane=tif.imread) -> np.ndarray:
+    first_plane = read_plane(path_list[0])
+    num_planes = len(path_list)
+    if num_planes == 1:
+        return first_plane.astype(np.float32)
+
+    acc = first_plane.astype(get_sum_dtype(first_plane.dtype, num_planes))
+    del first_plane
+    for path in path_list[1:]:
+        np.add(acc, read_plane(path), out=acc, casting='unsafe')
+
+    if acc.dtype == np.float32:
+        np.divide(acc, num_planes, out=acc)
+        return acc
+    result = acc.astype(np.float32)
+    del acc
+    np.divide(result, num_planes, out=result)
+    return result
+
+
+def max_projection(path_list: List[str], read_plane=tif.imread) -> np.ndarray:
+    acc = read_plane(path_list[0])
+    for path in path_list[1:]:
+        np.maximum(acc, read_plane(path), out=acc)
+    return acc.astype(np.float32, copy=False)
+
+
+def weighted_projection(path_list: List[str], weights: List[float], read_plane=tif.imread) -> np.ndarray:
+    weights = normalize_weights(weights, len(path_list))
+    plane = read_plane(path_list[0])
+    acc = plane.astype(np.float32)
+    np.multiply(acc, weights[0], out=acc)
+    buffer = np.empty_like(acc)
+    for i, path in enumerate(path_list[1:], start=1):
+        np.multiply(read_plane(path), weights[i], out=buffer, casting='unsafe')
+        np.add(acc, buffer, out=acc)
+    return acc
+
+
+def project_planes(path_list: List[str], method: str = 'mean', weights: List[float] = None, read_plane=tif.imread) -> np.ndarray:
+    """ Reads z-planes one at a time and accumulates them into a single preallocated buffer.
+        Returns float32 projection, except for max projection of float64 images.
+        read_plane(path) can return planes that were already read, e.g. by a prefetching pipeline.
+    """
+    if method == 'mean':
+        return mean_projection(path_list, read_plane)
+    elif method == 'max':
+        return max_projection(path_list, read_plane)
+    elif method == 'weighted':
+        if weights is None:
+            return mean_projection(path_list, read_plane)
+        return weighted_projection(path_list, weights, read_plane)
+    else:
+        raise ValueError('Unknown projection method: ' + str(method))
+
+
+def rescale_inplace(img: np.ndarray, target_type_min, target_type_max, target_type) -> np.ndarray:
+    """ Same transform as file_manipulation.convert, but without float64 temporaries """
+    if not np.issubdtype(img.dtype, np.floating):
+        img = img.astype(np.float32)
+    imin = img.min()
+    imax = img.max()
+    if imax == imin:
+        return np.full(img.shape, target_type_min, dtype=target_type)
+
+    a = (target_type_max - target_type_min) / (float(imax) - float(imin))
+    b = target_type_max - a * float(imax)
+    np.multiply(img, a, out=img, casting='unsafe')
+    np.add(img, b, out=img, casting='unsafe')
+    np.clip(img, target_type_min, target_type_max, out=img)
+    return img.astype(target_type)
+
+
+def rescale_with_range_inplace(img: np.ndarray, low: float, high: float, target_type_max, target_type) -> np.ndarray:
+    """ Fixed linear map of [low, high] to [0, target_type_max], values outside are clipped.
+        No reductions over the image, so it is cheaper than rescale_inplace.
+    """
+    if not np.issubdtype(img.dtype, np.floating):
+        img = img.astype(np.float32)
+    scale = target_type_max / (high - low) if high > low else 0.0
+    np.subtract(img, low, out=img, casting='unsafe')
+    np.multiply(img, scale, out=img, casting='unsafe')
+    np.clip(img, 0, target_type_max, out=img)
+    return img.astype(target_type, copy=False)
+
+
+def get_output_dtype(source_dtype: np.dtype, normalize: str = 'none', output_dtype: str = 'source') -> np.dtype:
+    if output_dtype == 'float32':
+        return np.dtype(np.float32)
+    if output_dtype == 'uint16' or normalize != 'none':
+        return np.dtype(np.uint16)
+    return np.dtype(source_dtype)
+
+
+def finalize_projection(img: np.ndarray, source_dtype: np.dtype, normalize: str = 'none', output_dtype: str = 'source',
+                        intensity_range: tuple = None) -> np.ndarray:
+    """ Normalizes and casts float32 projection. Normalized float32 output is in [0, 1] """
+    dtype = get_output_dtype(source_dtype, normalize, output_dtype)
+    target_max = 1.0 if dtype == np.float32 else 65535
+    if normalize == 'none':
+        return cast_to_dtype(img, dtype)
+    elif normalize == 'tile':
+        return rescale_inplace(img, 0, target_max, dtype)
+    elif normalize in ('channel', 'percentile'):
+        if intensity_range is None:
+            raise ValueError('Intensity range of the channel is required for normalization mode ' + normalize)
+        return rescale_with_range_inplace(img, intensity_range[0], intensity_range[1], target_max, dtype)
+    else:
+        raise ValueError('Unknown normalization mode: ' + str(normalize))
+
+
+def read_dtype_from_header(path: str) -> np.dtype:
+    with tif.TiffFile(path) as f:
+        return f.pages[0].dtype
+
+
+def cast_to_dtype(img: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """ Casts projection back to dtype of the source planes without rescaling """
+    dtype = np.dtype(dtype)
+    if img.dtype == dtype:
+        return img
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.rint(img, out=img)
+        np.clip(img, info.min, info.max, out=img)
+    return img.astype(dtype)
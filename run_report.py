@@ -0,0 +1,216 @@
+import os
+import os.path as osp
+import posixpath as px
+import re
+import json
+import time
+import threading
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# printed by macros before and after every BigStitcher step, see add_step_timing in generate_bigstitcher_macro
+STEP_TIMING_PATTERN = re.compile(r'^STEP_TIMING (\w+) (start|end) (\d+)\s*$', re.MULTILINE)
+IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+_active_report = None
+
+
+def read_proc_io() -> dict:
+    """ Bytes read and written by this process from /proc/self/io, rchar and wchar include page cache hits.
+        Empty on systems without procfs.
+    """
+    counters = dict()
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in IO_FIELDS:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def get_peak_rss_mb(who: str = 'self') -> float:
+    """ Peak resident set size of this process (self) or of the largest finished child process (children), e.g. Fiji """
+    if resource is None:
+        return None
+    rusage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux
+    return round(rusage.ru_maxrss / 1024, 1)
+
+
+def parse_fiji_step_timings(log_text: str, job_start: float = None) -> dict:
+    """ Seconds spent in every BigStitcher step from STEP_TIMING lines of Fiji console output.
+        If job_start (unix time) is given, time from launching Fiji to the first step is reported as startup.
+    """
+    starts = dict()
+    timings = dict()
+    first_start = None
+    for step, event, ms in STEP_TIMING_PATTERN.findall(log_text):
+        ms = int(ms)
+        if event == 'start':
+            starts[step] = ms
+            if first_start is None:
+                first_start = ms
+        elif step in starts:
+            timings[step] = round((ms - starts.pop(step)) / 1000, 3)
+    if job_start is not None and first_start is not None:
+        timings['startup'] = round(first_start / 1000 - job_start, 3)
+    return timings
+
+
+def get_io_delta(before: dict, after: dict) -> dict:
+    return {key: after[key] - before[key] for key in after if key in before}
+
+
+class RunReport:
+    """ Collects timings of pipeline stages and Fiji jobs of one run and writes them to a json file.
+        Stages can be nested and entered from several threads, cpu time and io counters are per process,
+        so stages running at the same time share them.
+    """
+    def __init__(self, report_path: str, profile_path: str = None, parameters: dict = None):
+        self.report_path = report_path
+        self.profile_path = profile_path
+        self.parameters = parameters if parameters is not None else {}
+        self.stages = []
+        self.fiji_jobs = []
+        self.extra = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiler = None
+        self._started = None
+        self._start = None
+        self._io_start = None
+
+    def start(self):
+        self._started = datetime.now()
+        self._start = time.perf_counter()
+        self._io_start = read_proc_io()
+        if self.profile_path is not None:
+            # profiles python code of the main thread, worker threads and Fiji only show up as waiting
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    @contextmanager
+    def stage(self, name: str, **attributes):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        io_before = read_proc_io()
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            wall_seconds = time.perf_counter() - start
+            stack.pop()
+            record = dict(name=name, parent=parent, status=status,
+                          start_offset_seconds=round(start - self._start, 3) if self._start is not None else None,
+                          wall_seconds=round(wall_seconds, 3),
+                          cpu_seconds=round(time.process_time() - cpu_before, 3),
+                          io=get_io_delta(io_before, read_proc_io()),
+                          peak_rss_mb=get_peak_rss_mb('self'))
+            record.update(attributes)
+            with self._lock:
+                self.stages.append(record)
+
+    def add_fiji_job(self, name: str, log_path: str, wall_seconds: float, returncode: int, step_seconds: dict, mem_mb: int = None):
+        with self._lock:
+            self.fiji_jobs.append(dict(name=name, log_path=log_path, wall_seconds=round(wall_seconds, 3), returncode=returncode,
+                                       heap_mb=mem_mb, step_seconds=step_seconds))
+
+    def add(self, key: str, value):
+        """ Any other json serializable results, e.g. throughput of pipeline stages """
+        with self._lock:
+            self.extra[key] = value
+
+    def to_dict(self) -> dict:
+        wall_seconds = time.perf_counter() - self._start if self._start is not None else None
+        return dict(started=self._started.isoformat() if self._started is not None else None,
+                    finished=datetime.now().isoformat(),
+                    wall_seconds=round(wall_seconds, 3) if wall_seconds is not None else None,
+                    parameters=self.parameters,
+                    peak_rss_mb=get_peak_rss_mb('self'),
+                    peak_fiji_rss_mb=get_peak_rss_mb('children'),
+                    io=get_io_delta(self._io_start or {}, read_proc_io()),
+                    stages=self.stages,
+                    fiji_jobs=self.fiji_jobs,
+                    profile_path=self.profile_path,
+                    **self.extra)
+
+    def finish(self) -> dict:
+        report_dir = osp.dirname(self.report_path)
+        if report_dir and not osp.exists(report_dir):
+            os.makedirs(report_dir)
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            self._profiler = None
+        report = self.to_dict()
+        with open(self.report_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print_stage_summary(report)
+        print('Run report saved to', self.report_path)
+        return report
+
+
+def print_stage_summary(report: dict):
+    print('\nstage', 'wall, s', 'cpu, s', 'read, MB', 'written, MB', 'peak RSS, MB', sep='\t')
+    for stage in report['stages']:
+        if stage['parent'] is not None:
+            continue
+        io = stage['io']
+        print(stage['name'], stage['wall_seconds'], stage['cpu_seconds'],
+              round(io.get('rchar', 0) / 1024 ** 2, 1), round(io.get('wchar', 0) / 1024 ** 2, 1), stage['peak_rss_mb'], sep='\t')
+    for job in report['fiji_jobs']:
+        steps = ', '.join('{s} {t} s'.format(s=step, t=seconds) for step, seconds in job['step_seconds'].items())
+        print('Fiji', job['name'], job['wall_seconds'], 's:', steps)
+
+
+def make_report_paths(out_dir: str, profile: bool = False) -> tuple:
+    """ (report path, profile path or None) in out_dir/reports, named by start time in microseconds and pid,
+        so every run keeps its report, also runs of batch.py that start in the same second
+    """
+    name = 'run_report_' + datetime.now().strftime('%Y%m%d_%H%M%S_%f') + '_' + str(os.getpid())
+    report_dir = px.join(out_dir, 'reports')
+    return px.join(report_dir, name + '.json'), px.join(report_dir, name + '.prof') if profile else None
+
+
+def set_active_report(report: RunReport = None):
+    """ Report that timed() and Fiji jobs write to, None disables reporting """
+    global _active_report
+    _active_report = report
+
+
+def get_active_report() -> RunReport:
+    return _active_report
+
+
+@contextmanager
+def timed(name: str, **attributes):
+    """ Records the enclosed block as a stage of the active report, does nothing if there is no active report """
+    report = _active_report
+    if report is None:
+        yield
+        return
+    with report.stage(name, **attributes):
+        yield
+
+
+def report_value(key: str, value):
+    if _active_report is not None:
+        _active_report.add(key, value)
@@ -0,0 +1,73 @@
+import os
+import os.path as osp
+import posixpath as px
+import json
+import threading
+from typing import List, Iterable
+
+
+STAGES = ('projection', 'registration', 'fusion', 'assembly')
+
+
+def get_file_fingerprint(path: str) -> list:
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def make_fingerprint(input_paths: Iterable[str], parameters: dict = None) -> dict:
+    """ Inputs are identified by path, size and modification time, pixels are never read """
+    return dict(inputs=[get_file_fingerprint(path) for path in input_paths],
+                parameters=parameters if parameters is not None else {})
+
+
+class StageManifest:
+    """ Records for every stage which output file was produced from which inputs,
+        so re-runs can skip outputs that are already up to date.
+        Stored as json: {stage: {output_path: {fingerprint: ..., output: [path, size, mtime]}}}
+    """
+    def __init__(self, manifest_dir: str, force_stages: List[str] = None):
+        self.manifest_path = px.join(manifest_dir, 'stitching_manifest.json')
+        self.force_stages = set(force_stages) if force_stages is not None else set()
+        if 'all' in self.force_stages:
+            self.force_stages = set(STAGES)
+        self.save_every = 100
+        self._unsaved_records = 0
+        self._lock = threading.Lock()
+        self.records = self.load()
+
+    def load(self) -> dict:
+        if not osp.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            print('Could not read manifest, all stages will be recomputed', self.manifest_path)
+            return {}
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.manifest_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.records, f, indent=1)
+            os.replace(tmp_path, self.manifest_path)
+            self._unsaved_records = 0
+
+    def is_up_to_date(self, stage: str, output_path: str, fingerprint: dict) -> bool:
+        if stage in self.force_stages:
+            return False
+        if not osp.exists(output_path):
+            return False
+        record = self.records.get(stage, {}).get(output_path)
+        if record is None:
+            return False
+        return record['fingerprint'] == fingerprint and record['output'] == get_file_fingerprint(output_path)
+
+    def record(self, stage: str, output_path: str, fingerprint: dict):
+        with self._lock:
+            stage_records = self.records.setdefault(stage, {})
+            stage_records[output_path] = dict(fingerprint=fingerprint, output=get_file_fingerprint(output_path))
+            self._unsaved_records += 1
+            need_to_save = self._unsaved_records >= self.save_every
+        if need_to_save:
+            self.save()
@@ -0,0 +1,29 @@
+from contextlib import contextmanager
+
+
+# cpu: projection, python registration and fusion, assembly; fiji: every running Fiji job
+SLOT_KINDS = ('cpu', 'fiji')
+
+_slots = None
+
+
+def set_stage_slots(slots: dict = None):
+    """ {kind: semaphore} shared by regions stitched at the same time in different processes,
+        None lets every stage start immediately
+    """
+    global _slots
+    _slots = slots
+
+
+@contextmanager
+def stage_slot(kind: str):
+    """ Waits until a slot of this kind is free, does nothing if there are no shared slots """
+    semaphore = _slots.get(kind) if _slots is not None else None
+    if semaphore is None:
+        yield
+        return
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
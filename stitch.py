@@ -3,15 +3,34 @@ import os
 import posixpath as px
 import os.path as osp
 from datetime import datetime
-import subprocess
 import json
 from typing import List
 import shutil
-import dask
 
 
 from generate_bigstitcher_macro import BigStitcherMacro, FuseMacro
-from file_manipulation import copy_best_z_planes_to_channel_dirs
+from file_manipulation import copy_best_z_planes_to_channel_dirs, assemble_channels_in_one_file, get_channel_names_per_channel_id, \
+    get_default_projection_options, get_bdv_dataset_paths, remove_if_exists, TILE_FORMATS
+from projection import NORMALIZATION_MODES, OUTPUT_DTYPES
+from image_paths_arrangement import get_img_listing
+from stage_manifest import StageManifest, STAGES, make_fingerprint
+from phase_correlation_registration import register_with_phase_correlation
+from global_optimization import optimize_globally
+from native_fusion import fuse_channel
+from block_fusion import fuse_channel_in_blocks
+from bigstitcher_xml import read_xml, write_xml, create_multichannel_dataset, copy_reference_registrations
+from focus_scoring import FOCUS_METRICS, get_default_focus_options
+from tile_compression import TILE_COMPRESSIONS, check_tile_compression
+from stitching_plan import make_plan, print_plan
+from tile_pipeline import PIPELINE_STAGES, get_default_pipeline_options
+from fiji_scheduler import run_fiji_job, run_fiji_jobs, estimate_fusion_memory_mb, set_fiji_pool
+from fiji_pool import make_worker_command
+from stage_slots import stage_slot
+from run_report import RunReport, make_report_paths, set_active_report, timed
+
+
+FUSED_IMG_NAME = 'fused_tp_0_ch_0.tif'
+OME_TIFF_NAME = 'stitched_image.ome.tif'
 
 
 def make_dir_if_not_exists(dir_path: str):
@@ -34,7 +53,7 @@ def get_values_from_submission_file(submission: dict) -> dict:
                                 tile_width=submission['tileWidth'],
                                 tile_height=submission['tileHeight'],
                                 overlap_x=submission['tileOverlapX'],
-                                overlap_y=submission['tileOverlapX'],
+                                overlap_y=submission['tileOverlapY'],
                                 overlap_z=1,  # does not matter because we have only one z-plane
                                 pixel_distance_x=submission['xyResolution'],
                                 pixel_distance_y=submission['xyResolution'],
@@ -44,8 +63,11 @@ def get_values_from_submission_file(submission: dict) -> dict:
     return info_for_bigstitcher
 
 
-def generate_bigstitcher_macro_for_first_channel(first_channel_dir: str, out_dir: str, info_for_bigstitcher: dict) -> str:
+def generate_bigstitcher_macro_for_first_channel(first_channel_dir: str, out_dir: str, info_for_bigstitcher: dict,
+                                                  steps: List[str] = None) -> str:
     macro = BigStitcherMacro()
+    if steps is not None:
+        macro.steps = steps
     macro.img_dir = first_channel_dir
     macro.out_dir = out_dir
     macro.num_tiles = info_for_bigstitcher['num_tiles']
@@ -57,18 +79,23 @@ def generate_bigstitcher_macro_for_first_channel(first_channel_dir: str, out_dir
     macro.pixel_distance_x = info_for_bigstitcher['pixel_distance_x']
     macro.pixel_distance_y = info_for_bigstitcher['pixel_distance_y']
     macro.pixel_distance_z = info_for_bigstitcher['pixel_distance_z']
+    macro.downsample_x = info_for_bigstitcher.get('registration_downsample', 1)
+    macro.downsample_y = info_for_bigstitcher.get('registration_downsample', 1)
     macro_path = macro.generate()
 
     return macro_path
 
 
-def run_bigstitcher(imagej_path: str, bigstitcher_macro_path: str):
-    command = imagej_path + " --headless --console -macro " + bigstitcher_macro_path
-    subprocess.run(command, shell=True)
+def run_bigstitcher(imagej_path: str, bigstitcher_macro_path: str, mem_mb: int = None, expected_outputs: List[str] = None):
+    job = dict(name=osp.basename(bigstitcher_macro_path), macro_path=bigstitcher_macro_path,
+               log_path=bigstitcher_macro_path + '.log', expected_outputs=expected_outputs or [])
+    if not run_fiji_job(imagej_path, job, mem_mb):
+        raise RuntimeError('Fiji failed to run ' + bigstitcher_macro_path + ', see ' + job['log_path'])
 
 
-def run_bigstitcher_for_first_channel(imagej_path: str, bigstitcher_macro_path_first_channel: str):
-    run_bigstitcher(imagej_path, bigstitcher_macro_path_first_channel)
+def run_bigstitcher_for_first_channel(imagej_path: str, bigstitcher_macro_path_first_channel: str, mem_mb: int = None,
+                                      expected_outputs: List[str] = None):
+    run_bigstitcher(imagej_path, bigstitcher_macro_path_first_channel, mem_mb, expected_outputs)
 
 
 def copy_dataset_xml_to_other_channel_dirs(first_channel_dir: str, other_channel_dirs: List[str]):
@@ -78,22 +105,86 @@ def copy_dataset_xml_to_other_channel_dirs(first_channel_dir: str, other_channel
         shutil.copy(dataset_xml_path, dst_path)
 
 
-def copy_fuse_macro_to_other_channel_dirs(other_channel_dirs: List[str], other_channel_stitched_dirs: List[str]):
+def copy_fuse_macro_to_other_channel_dirs(other_channel_dirs: List[str], other_channel_stitched_dirs: List[str]) -> List[str]:
+    """ Returns paths of the generated macros """
     macro = FuseMacro()
+    macro_paths = []
     for i, dir_path in enumerate(other_channel_dirs):
         macro.img_dir = dir_path
         macro.xml_file_name = 'dataset.xml'
         macro.out_dir = other_channel_stitched_dirs[i]
-        macro.generate()
+        macro_paths.append(macro.generate())
+    return macro_paths
 
 
-def run_bigstitcher_for_other_channels(imagej_path: str, other_channel_dirs: List[str]):
-    task = []
-    for dir_path in other_channel_dirs:
-        macro_path = px.join(dir_path, 'fuse_only_macro.ijm')
-        task.append(dask.delayed(run_bigstitcher)(imagej_path, macro_path))
+def run_bigstitcher_for_other_channels(imagej_path: str, other_channel_dirs: List[str], other_channel_stitched_dirs: List[str],
+                                       macro_paths: List[str], mem_per_job_mb: int = None, max_jobs: int = None):
+    jobs = []
+    for i, dir_path in enumerate(other_channel_dirs):
+        stitched_dir_path = other_channel_stitched_dirs[i]
+        jobs.append(dict(name=osp.basename(osp.normpath(dir_path)),
+                         macro_path=macro_paths[i],
+                         log_path=px.join(stitched_dir_path, 'fusion.log'),
+                         expected_outputs=[px.join(stitched_dir_path, FUSED_IMG_NAME)]))
+    run_fiji_jobs(imagej_path, jobs, mem_per_job_mb, max_jobs)
+
+
+def fuse_channels_in_one_session(imagej_path: str, dataset_xml_path: str, channel_dirs: List[str],
+                                 channel_stitched_dirs: List[str], work_dir: str, mem_mb: int = None):
+    """ Applies reference registration to all channels in one multi-channel dataset
+        and fuses them with one ImageJ process
+    """
+    fused_dir = px.join(work_dir, 'fused')
+    make_dir_if_not_exists(fused_dir)
+    multichannel_xml_path = px.join(work_dir, 'dataset.xml')
+    root = create_multichannel_dataset(read_xml(dataset_xml_path), channel_dirs, work_dir)
+    write_xml(root, multichannel_xml_path)
+
+    macro = FuseMacro()
+    macro.img_dir = work_dir
+    macro.xml_file_name = 'dataset.xml'
+    macro.out_dir = fused_dir
+    macro_path = macro.generate()
+    # BigStitcher names fused images by channel id in the dataset
+    fused_img_paths = [px.join(fused_dir, 'fused_tp_0_ch_{c}.tif'.format(c=c)) for c in range(0, len(channel_dirs))]
+    run_bigstitcher(imagej_path, macro_path, mem_mb, fused_img_paths)
+
+    for c, stitched_dir_path in enumerate(channel_stitched_dirs):
+        shutil.move(fused_img_paths[c], px.join(stitched_dir_path, FUSED_IMG_NAME))
+
+
+def fuse_channels_from_bdv_hdf5(imagej_path: str, dataset_xml_path: str, bdv_xml_path: str, channel_stitched_dirs: List[str],
+                                stitching_manifest: StageManifest, work_dir: str, mem_mb: int = None):
+    """ Applies reference registration to the hdf5 dataset with all channels and fuses them with one ImageJ process.
+        channel_stitched_dirs are in the order of channels in the hdf5 dataset.
+    """
+    h5_path = px.join(px.dirname(bdv_xml_path), 'dataset.h5')
+    fused_paths = [px.join(stitched_dir_path, FUSED_IMG_NAME) for stitched_dir_path in channel_stitched_dirs]
+    fusion_fingerprint = make_fingerprint([h5_path, dataset_xml_path], dict(fusion_backend='bigstitcher', tile_format='hdf5'))
+    if all(stitching_manifest.is_up_to_date('fusion', path, fusion_fingerprint) for path in fused_paths):
+        print('Fused channels are up to date, skipping')
+        return
+    remove_stale_outputs(fused_paths)
+
+    registered_xml_name = 'dataset_registered.xml'
+    root = read_xml(bdv_xml_path)
+    copy_reference_registrations(root, read_xml(dataset_xml_path))
+    write_xml(root, px.join(px.dirname(bdv_xml_path), registered_xml_name))
+
+    fused_dir = px.join(work_dir, 'fused')
+    make_dir_if_not_exists(fused_dir)
+    macro = FuseMacro()
+    macro.img_dir = px.dirname(bdv_xml_path)
+    macro.xml_file_name = registered_xml_name
+    macro.out_dir = fused_dir
+    macro_path = macro.generate()
+    fused_img_paths = [px.join(fused_dir, 'fused_tp_0_ch_{c}.tif'.format(c=c)) for c in range(0, len(channel_stitched_dirs))]
+    run_bigstitcher(imagej_path, macro_path, mem_mb, fused_img_paths)
 
-    dask.compute(*task, scheduler='processes')
+    for fused_img_path, fused_path in zip(fused_img_paths, fused_paths):
+        shutil.move(fused_img_path, fused_path)
+        record_if_exists(stitching_manifest, 'fusion', fused_path, fusion_fingerprint)
+    stitching_manifest.save()
 
 
 def make_channel_stitched_dirs(channel_dirs: dict, out_dir: str):
@@ -106,24 +197,254 @@ def make_channel_stitched_dirs(channel_dirs: dict, out_dir: str):
     return channel_stitched_dirs
 
 
-def main(imagej_path: str, img_dirs: List[str], out_dir: str, best_focus_dir: str, cytokit_json_path: str, submission_file_path: str):
+def get_tile_paths_in_dir(dir_path: str) -> List[str]:
+    return [px.join(dir_path, file_name) for file_name in sorted(get_img_listing(dir_path))]
+
+
+def remove_stale_outputs(output_paths: List[str]):
+    """ Outputs of a stage that is recomputed are removed before it runs, so record_if_exists never records an old file """
+    for path in output_paths:
+        remove_if_exists(path)
+
+
+def record_if_exists(manifest: StageManifest, stage: str, output_path: str, fingerprint: dict):
+    if px.exists(output_path):
+        manifest.record(stage, output_path, fingerprint)
+    else:
+        print('Expected output was not produced:', output_path)
+
+
+def register_reference_channel(imagej_path: str, first_channel_dir: str, first_channel_stitched_dir: str, info_for_bigstitcher: dict,
+                               stitching_manifest: StageManifest, registration_backend: str, global_optimizer: str,
+                               fusion_backend: str, num_workers: int, fuse_reference: bool = True,
+                               fusion_mode: str = 'per_channel') -> bool:
+    """ Writes registered dataset.xml in the reference channel dir.
+        Returns True if reference channel was fused during registration.
+    """
+    dataset_xml_path = px.join(first_channel_dir, 'dataset.xml')
+    registration_parameters = dict(info_for_bigstitcher, registration_backend=registration_backend, global_optimizer=global_optimizer)
+    registration_fingerprint = make_fingerprint(get_tile_paths_in_dir(first_channel_dir), registration_parameters)
+
+    if stitching_manifest.is_up_to_date('registration', dataset_xml_path, registration_fingerprint):
+        print('\nRegistration is up to date, skipping')
+        return False
+
+    # fused reference channel depends on the registration, it is fused again during registration or with other channels
+    remove_stale_outputs([dataset_xml_path, px.join(first_channel_stitched_dir, FUSED_IMG_NAME)])
+    if registration_backend == 'python':
+        register_with_phase_correlation(first_channel_dir, info_for_bigstitcher, num_workers=num_workers)
+        steps = []
+    elif global_optimizer == 'python':
+        steps = ['define', 'pairwise', 'filter']
+    elif fusion_backend == 'python' or not fuse_reference:
+        steps = ['define', 'pairwise', 'filter', 'optimize']
+    else:
+        steps = ['define', 'pairwise', 'filter', 'optimize', 'fuse']
+
+    if steps:
+        bigstitcher_macro_path = generate_bigstitcher_macro_for_first_channel(first_channel_dir, first_channel_stitched_dir,
+                                                                              info_for_bigstitcher, steps)
+        expected_outputs = [dataset_xml_path]
+        if 'fuse' in steps:
+            expected_outputs.append(px.join(first_channel_stitched_dir, FUSED_IMG_NAME))
+        run_bigstitcher_for_first_channel(imagej_path, bigstitcher_macro_path, estimate_fusion_memory_mb(info_for_bigstitcher),
+                                          expected_outputs)
+    if global_optimizer == 'python' and registration_backend != 'python':
+        print('\nOptimizing tile positions')
+        with timed('global_optimization'):
+            optimize_globally(dataset_xml_path)
+
+    record_if_exists(stitching_manifest, 'registration', dataset_xml_path, registration_fingerprint)
+    reference_is_fused = 'fuse' in steps
+    if reference_is_fused:
+        fusion_fingerprint = make_fusion_fingerprint(first_channel_dir, dataset_xml_path, fusion_backend, fusion_mode)
+        record_if_exists(stitching_manifest, 'fusion', px.join(first_channel_stitched_dir, FUSED_IMG_NAME), fusion_fingerprint)
+    stitching_manifest.save()
+    return reference_is_fused
+
+
+def make_fusion_fingerprint(channel_dir: str, dataset_xml_path: str, fusion_backend: str, fusion_mode: str = 'per_channel',
+                            fusion_block_size: int = 0, fusion_block_overlap: int = 32, tile_format: str = 'tiff') -> dict:
+    """ Fused images are recomputed when they were fused with other fusion options """
+    parameters = dict(fusion_backend=fusion_backend, fusion_mode=fusion_mode, fusion_block_size=fusion_block_size,
+                      tile_format=tile_format)
+    if fusion_block_size > 0:
+        parameters['fusion_block_overlap'] = fusion_block_overlap
+    return make_fingerprint(get_tile_paths_in_dir(channel_dir) + [dataset_xml_path], parameters)
+
+
+def fuse_channels(imagej_path: str, dataset_xml_path: str, channel_dirs: List[str], channel_stitched_dirs: List[str],
+                  stitching_manifest: StageManifest, fusion_backend: str, num_workers: int,
+                  fusion_mode: str = 'per_channel', work_dir: str = None, info_for_bigstitcher: dict = None,
+                  max_fiji_jobs: int = None, fusion_block_size: int = 0, fusion_block_overlap: int = 32):
+    first_channel_dir = px.dirname(dataset_xml_path)
+    channels_to_fuse = []
+    fusion_fingerprints = []
+    for dir_path, stitched_dir_path in zip(channel_dirs, channel_stitched_dirs):
+        fusion_fingerprint = make_fusion_fingerprint(dir_path, dataset_xml_path, fusion_backend, fusion_mode, fusion_block_size,
+                                                     fusion_block_overlap)
+        if not stitching_manifest.is_up_to_date('fusion', px.join(stitched_dir_path, FUSED_IMG_NAME), fusion_fingerprint):
+            channels_to_fuse.append((dir_path, stitched_dir_path))
+            fusion_fingerprints.append(fusion_fingerprint)
+    print('Channels up to date:', len(channel_dirs) - len(channels_to_fuse), 'of', len(channel_dirs))
+    if not channels_to_fuse:
+        return
+
+    mem_per_job_mb = None
+    if info_for_bigstitcher is not None:
+        mem_per_job_mb = estimate_fusion_memory_mb(info_for_bigstitcher)
+    dirs_to_fuse = [dir_path for dir_path, stitched_dir_path in channels_to_fuse]
+    stitched_dirs_to_fuse = [stitched_dir_path for dir_path, stitched_dir_path in channels_to_fuse]
+    remove_stale_outputs([px.join(stitched_dir_path, FUSED_IMG_NAME) for stitched_dir_path in stitched_dirs_to_fuse])
+    if fusion_backend == 'python':
+        for i, dir_path in enumerate(dirs_to_fuse):
+            fused_img_path = px.join(stitched_dirs_to_fuse[i], FUSED_IMG_NAME)
+            with timed('fusion_channel', channel_dir=dir_path):
+                fuse_channel(dataset_xml_path, dir_path, fused_img_path, num_workers)
+            record_if_exists(stitching_manifest, 'fusion', fused_img_path, fusion_fingerprints[i])
+    elif fusion_mode == 'single_session':
+        fuse_channels_in_one_session(imagej_path, dataset_xml_path, dirs_to_fuse, stitched_dirs_to_fuse, work_dir, mem_per_job_mb)
+        for i, stitched_dir_path in enumerate(stitched_dirs_to_fuse):
+            record_if_exists(stitching_manifest, 'fusion', px.join(stitched_dir_path, FUSED_IMG_NAME), fusion_fingerprints[i])
+    elif fusion_block_size > 0:
+        copy_dataset_xml_to_other_channel_dirs(first_channel_dir, [d for d in dirs_to_fuse if d != first_channel_dir])
+        for i, dir_path in enumerate(dirs_to_fuse):
+            fused_img_path = px.join(stitched_dirs_to_fuse[i], FUSED_IMG_NAME)
+            with timed('fusion_channel', channel_dir=dir_path, block_size=fusion_block_size):
+                fuse_channel_in_blocks(imagej_path, px.join(dir_path, 'dataset.xml'), dir_path, fused_img_path,
+                                       fusion_block_size, fusion_block_overlap, max_fiji_jobs)
+            record_if_exists(stitching_manifest, 'fusion', fused_img_path, fusion_fingerprints[i])
+    else:
+        copy_dataset_xml_to_other_channel_dirs(first_channel_dir, [d for d in dirs_to_fuse if d != first_channel_dir])
+        macro_paths = copy_fuse_macro_to_other_channel_dirs(dirs_to_fuse, stitched_dirs_to_fuse)
+        run_bigstitcher_for_other_channels(imagej_path, dirs_to_fuse, stitched_dirs_to_fuse, macro_paths, mem_per_job_mb,
+                                           max_fiji_jobs)
+        for i, stitched_dir_path in enumerate(stitched_dirs_to_fuse):
+            record_if_exists(stitching_manifest, 'fusion', px.join(stitched_dir_path, FUSED_IMG_NAME), fusion_fingerprints[i])
+    stitching_manifest.save()
+
+
+def assemble_ome_tiff(channel_stitched_dirs: dict, out_dir: str, submission: dict, stitching_manifest: StageManifest,
+                      num_workers: int):
+    output_path = px.join(out_dir, OME_TIFF_NAME)
+    channel_ids = sorted(channel_stitched_dirs)
+    stitched_dirs = [channel_stitched_dirs[channel_id] for channel_id in channel_ids]
+    channel_names_per_channel_id = get_channel_names_per_channel_id(submission)
+    channel_names = [channel_names_per_channel_id[channel_id] for channel_id in channel_ids]
+
+    fused_img_paths = [px.join(dir_path, FUSED_IMG_NAME) for dir_path in stitched_dirs]
+    fingerprint = make_fingerprint(fused_img_paths, dict(channel_names=channel_names))
+    if stitching_manifest.is_up_to_date('assembly', output_path, fingerprint):
+        print('\nOME-TIFF is up to date, skipping')
+        return
+    print('\nAssembling channels into', output_path)
+    remove_stale_outputs([output_path])
+    assemble_channels_in_one_file(stitched_dirs, output_path, channel_names, submission['xyResolution'], num_workers)
+    record_if_exists(stitching_manifest, 'assembly', output_path, fingerprint)
+    stitching_manifest.save()
+
+
+def get_fiji_pool_memory_mb(info_for_bigstitcher: dict, step_mb: int = 4096) -> int:
+    """ Heap estimate rounded up, so regions of similar size share one pool """
+    mem_mb = estimate_fusion_memory_mb(info_for_bigstitcher)
+    return -(-mem_mb // step_mb) * step_mb
+
+
+def make_pipeline_options(num_workers: int, pipeline_workers: List[int] = None, pipeline_depth: List[int] = None) -> dict:
+    pipeline_options = get_default_pipeline_options(num_workers)
+    if pipeline_workers is not None:
+        for stage, n in zip(PIPELINE_STAGES, pipeline_workers):
+            pipeline_options[stage + '_workers'] = n
+    if pipeline_depth is not None:
+        pipeline_options['read_depth'], pipeline_options['project_depth'] = pipeline_depth
+    return pipeline_options
+
+
+def make_projection_options(projection_method: str = 'mean', normalize_intensity: str = 'none', output_dtype: str = 'source',
+                            tile_compression: str = 'none') -> dict:
+    projection_options = get_default_projection_options()
+    if isinstance(normalize_intensity, bool):
+        normalize_intensity = 'tile' if normalize_intensity else 'none'
+    projection_options.update(method=projection_method, normalize=normalize_intensity, output_dtype=output_dtype,
+                              compression=tile_compression)
+    return projection_options
+
+
+def validate_options(registration_backend: str, fusion_backend: str, fusion_mode: str, tile_format: str,
+                     fusion_block_size: int, tile_compression: str):
+    """ Combinations of options that can not run, checked before a run and a plan """
+    if tile_format == 'hdf5' and fusion_backend != 'bigstitcher':
+        raise ValueError('Tiles in hdf5 can only be fused with bigstitcher fusion backend')
+    if fusion_block_size > 0 and (fusion_backend != 'bigstitcher' or fusion_mode != 'per_channel' or tile_format != 'tiff'):
+        raise ValueError('Block-wise fusion needs bigstitcher fusion backend, per_channel fusion mode and tiff tiles')
+    check_tile_compression(tile_compression, read_by_fiji=registration_backend == 'bigstitcher' or
+                           (fusion_backend == 'bigstitcher' and tile_format == 'tiff'))
+
+
+def plan_stitching(img_dirs: List[str], out_dir: str, best_focus_dir: str, cytokit_json_path: str, submission_file_path: str,
+                   num_workers: int = 1, parallel_mode: str = 'threads', projection_method: str = 'mean',
+                   normalize_intensity: str = 'none', registration_backend: str = 'bigstitcher', fusion_backend: str = 'bigstitcher',
+                   fusion_mode: str = 'per_channel', max_fiji_jobs: int = None, assemble: bool = False,
+                   focus_metric: str = 'laplacian_variance', pipeline_workers: List[int] = None, pipeline_depth: List[int] = None,
+                   output_dtype: str = 'source', tile_format: str = 'tiff', fusion_block_size: int = 0,
+                   fusion_block_overlap: int = 32, tile_compression: str = 'none', **ignored) -> dict:
+    """ Prints and returns predicted I/O, sizes and memory of every stage, nothing is projected, registered or fused """
+    validate_options(registration_backend, fusion_backend, fusion_mode, tile_format, fusion_block_size, tile_compression)
+    submission = load_submission_file(submission_file_path)
+    focus_options = get_default_focus_options()
+    focus_options['metric'] = focus_metric
+    plan = make_plan(img_dirs, out_dir, best_focus_dir, cytokit_json_path, submission, get_values_from_submission_file(submission),
+                     make_projection_options(projection_method, normalize_intensity, output_dtype, tile_compression), focus_options,
+                     num_workers, parallel_mode, make_pipeline_options(num_workers, pipeline_workers, pipeline_depth),
+                     registration_backend, fusion_backend, fusion_mode, tile_format, max_fiji_jobs, fusion_block_size,
+                     fusion_block_overlap, assemble)
+    print_plan(plan)
+    return plan
+
+
+def run_stitching(imagej_path: str, img_dirs: List[str], out_dir: str, best_focus_dir: str, cytokit_json_path: str,
+                  submission_file_path: str, num_workers: int = 1, parallel_mode: str = 'threads', max_tiles_in_flight: int = None,
+                  projection_method: str = 'mean', normalize_intensity: str = 'none', force_stages: List[str] = None,
+                  registration_backend: str = 'bigstitcher', global_optimizer: str = 'bigstitcher',
+                  fusion_backend: str = 'bigstitcher', fusion_mode: str = 'per_channel', max_fiji_jobs: int = None,
+                  assemble: bool = False, focus_metric: str = 'laplacian_variance', pipeline_workers: List[int] = None,
+                  pipeline_depth: List[int] = None, output_dtype: str = 'source', registration_downsample: int = 1,
+                  tile_format: str = 'tiff', fiji_pool_workers: int = 0, fiji_pool_idle_timeout: float = 600,
+                  fusion_block_size: int = 0, fusion_block_overlap: int = 32, tile_compression: str = 'none'):
     start = datetime.now()
     print('\nStarted', start)
+    validate_options(registration_backend, fusion_backend, fusion_mode, tile_format, fusion_block_size, tile_compression)
 
     make_dir_if_not_exists(best_focus_dir)
     make_dir_if_not_exists(out_dir)
 
     print('\nCreating ImageJ macro file')
 
+    projection_manifest = StageManifest(best_focus_dir, force_stages)
+    stitching_manifest = StageManifest(out_dir, force_stages)
+
     submission = load_submission_file(submission_file_path)
     info_for_bigstitcher = get_values_from_submission_file(submission)
+    info_for_bigstitcher['registration_downsample'] = registration_downsample
+    if fiji_pool_workers > 0:
+        set_fiji_pool(make_worker_command(imagej_path, get_fiji_pool_memory_mb(info_for_bigstitcher)), fiji_pool_workers,
+                      fiji_pool_idle_timeout)
     print('\nSelecting best z-planes')
 
     print('\nStarting stitching')
     print('\nStitching reference channel')
 
-    channel_dirs = copy_best_z_planes_to_channel_dirs(img_dirs, best_focus_dir, submission, cytokit_json_path)
+    projection_options = make_projection_options(projection_method, normalize_intensity, output_dtype, tile_compression)
+    focus_options = get_default_focus_options()
+    focus_options['metric'] = focus_metric
+    with stage_slot('cpu'), timed('best_focus_tiles'):
+        channel_dirs = copy_best_z_planes_to_channel_dirs(img_dirs, best_focus_dir, submission, cytokit_json_path,
+                                                          num_workers, parallel_mode, max_tiles_in_flight, projection_options,
+                                                          projection_manifest, focus_options,
+                                                          make_pipeline_options(num_workers, pipeline_workers, pipeline_depth),
+                                                          tile_format)
     channel_stitched_dirs = make_channel_stitched_dirs(channel_dirs, out_dir)
+    all_channel_stitched_dirs = dict(channel_stitched_dirs)
 
     first_channel_dir = channel_dirs.pop(1)
     first_channel_stitched_dir = channel_stitched_dirs.pop(1)
@@ -132,17 +453,67 @@ def main(imagej_path: str, img_dirs: List[str], out_dir: str, best_focus_dir: st
     print(first_channel_dir)
     print(other_channel_dirs)
 
-    bigstitcher_macro_path = generate_bigstitcher_macro_for_first_channel(first_channel_dir, first_channel_stitched_dir, info_for_bigstitcher)
-    run_bigstitcher_for_first_channel(imagej_path, bigstitcher_macro_path)
+    dataset_xml_path = px.join(first_channel_dir, 'dataset.xml')
+    # Fiji jobs wait for their own slots
+    with stage_slot('cpu' if registration_backend == 'python' else None), \
+            timed('registration', backend=registration_backend, global_optimizer=global_optimizer):
+        reference_is_fused = register_reference_channel(imagej_path, first_channel_dir, first_channel_stitched_dir,
+                                                        info_for_bigstitcher, stitching_manifest, registration_backend,
+                                                        global_optimizer, fusion_backend, num_workers,
+                                                        fuse_reference=tile_format == 'tiff' and fusion_block_size == 0,
+                                                        fusion_mode=fusion_mode)
+    with stage_slot('cpu' if fusion_backend == 'python' else None), \
+            timed('fusion', backend=fusion_backend, mode=fusion_mode, tile_format=tile_format, block_size=fusion_block_size):
+        if tile_format == 'hdf5':
+            print('\nFusing all channels from hdf5')
+            bdv_xml_path = get_bdv_dataset_paths(best_focus_dir)[1]
+            stitched_dirs = [all_channel_stitched_dirs[channel_id] for channel_id in sorted(all_channel_stitched_dirs)]
+            fuse_channels_from_bdv_hdf5(imagej_path, dataset_xml_path, bdv_xml_path, stitched_dirs, stitching_manifest,
+                                        px.join(out_dir, 'multichannel'), estimate_fusion_memory_mb(info_for_bigstitcher))
+        else:
+            if not reference_is_fused:
+                other_channel_dirs.insert(0, first_channel_dir)
+                other_channel_stitched_dirs.insert(0, first_channel_stitched_dir)
+
+            print('\nStitching other channels')
+            fuse_channels(imagej_path, dataset_xml_path, other_channel_dirs, other_channel_stitched_dirs, stitching_manifest,
+                          fusion_backend, num_workers, fusion_mode, px.join(out_dir, 'multichannel'), info_for_bigstitcher,
+                          max_fiji_jobs, fusion_block_size, fusion_block_overlap)
+
+    if assemble:
+        with stage_slot('cpu'), timed('assembly'):
+            assemble_ome_tiff(all_channel_stitched_dirs, out_dir, submission, stitching_manifest, num_workers)
+    print('\nTime elapsed', datetime.now() - start)
 
-    print('\nStitching other channels')
-    copy_dataset_xml_to_other_channel_dirs(first_channel_dir, other_channel_dirs)
-    copy_fuse_macro_to_other_channel_dirs(other_channel_dirs, other_channel_stitched_dirs)
-    run_bigstitcher_for_other_channels(imagej_path, other_channel_dirs)
 
-    #assemble_channels_in_one_file()
-    #TODO add OME metadata
-    print('\nTime elapsed', datetime.now() - start)
+def main(imagej_path: str, img_dirs: List[str], out_dir: str, best_focus_dir: str, cytokit_json_path: str, submission_file_path: str,
+         num_workers: int = 1, parallel_mode: str = 'threads', max_tiles_in_flight: int = None,
+         projection_method: str = 'mean', normalize_intensity: str = 'none', force_stages: List[str] = None,
+         registration_backend: str = 'bigstitcher', global_optimizer: str = 'bigstitcher', fusion_backend: str = 'bigstitcher',
+         fusion_mode: str = 'per_channel', max_fiji_jobs: int = None, assemble: bool = False,
+         focus_metric: str = 'laplacian_variance', pipeline_workers: List[int] = None, pipeline_depth: List[int] = None,
+         output_dtype: str = 'source', registration_downsample: int = 1, tile_format: str = 'tiff', profile: bool = False,
+         fiji_pool_workers: int = 0, fiji_pool_idle_timeout: float = 600, fusion_block_size: int = 0,
+         fusion_block_overlap: int = 32, tile_compression: str = 'none', plan: bool = False):
+    """ Runs stitching and writes timings of all stages to out_dir/reports/run_report_<start time>_<pid>.json,
+        also when the run fails. With profile, python code is profiled with cProfile into a .prof file next to it.
+        With plan, only predicts what a run would need and writes nothing.
+    """
+    parameters = dict(locals())
+    del parameters['profile']
+    del parameters['plan']
+    if plan:
+        return plan_stitching(**parameters)
+    report_path, profile_path = make_report_paths(out_dir, profile)
+    report = RunReport(report_path, profile_path, parameters)
+    set_active_report(report)
+    report.start()
+    try:
+        run_stitching(**parameters)
+    finally:
+        report.finish()
+        set_active_report(None)
+        set_fiji_pool(None)
 
 
 if __name__ == '__main__':
@@ -152,8 +523,79 @@ if __name__ == '__main__':
     parser.add_argument('--out_dir', type=str, help='path to store stitched images')
     parser.add_argument('--best_focus_dir', type=str, help='path to store best focused z planes')
     parser.add_argument('--submission_file_path', type=str, help='path to submission file')
-    parser.add_argument('--cytokit_json_path', type=str, help='path to cytokit data.json file')
+    parser.add_argument('--cytokit_json_path', type=str, default=None,
+                        help='path to cytokit data.json file, if not set best z-planes are found by scoring focus of the images')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of workers used to project z-planes')
+    parser.add_argument('--parallel_mode', type=str, default='threads', choices=['threads', 'processes', 'pipeline'],
+                        help='use threads or processes to project z-planes in parallel, ' +
+                             'or a pipeline that reads, projects and writes tiles at the same time')
+    parser.add_argument('--pipeline_workers', type=int, nargs=3, default=None, metavar=('READ', 'PROJECT', 'WRITE'),
+                        help='pipeline mode: number of read, project and write workers, ' +
+                             'default num_workers, num_workers and num_workers // 2')
+    parser.add_argument('--pipeline_depth', type=int, nargs=2, default=None, metavar=('READ', 'PROJECT'),
+                        help='pipeline mode: max number of tiles waiting after read and after project stages, ' +
+                             'default 2 x num_workers and num_workers')
+    parser.add_argument('--max_tiles_in_flight', type=int, default=None,
+                        help='max number of tiles being projected at the same time, default 2 x num_workers')
+    parser.add_argument('--projection_method', type=str, default='mean', choices=['mean', 'max', 'weighted'],
+                        help='how to project selected z-planes, weighted uses cytokit focus scores')
+    parser.add_argument('--normalize_intensity', type=str, nargs='?', default='none', const='tile', choices=list(NORMALIZATION_MODES),
+                        help='rescale projected tiles to the full uint16 range: every tile to its own min/max (tile, ' +
+                             'same as the flag without value), every channel to its global min/max (channel) ' +
+                             'or to its 0.1 and 99.9 percentiles (percentile, 8 and 16 bit images only, ' +
+                             'other images fall back to min/max with a warning)')
+    parser.add_argument('--output_dtype', type=str, default='source', choices=list(OUTPUT_DTYPES),
+                        help='data type of projected tiles, source keeps data type of raw images, ' +
+                             'normalized tiles are uint16 or float32 in [0, 1]')
+    parser.add_argument('--force_stage', type=str, nargs='+', default=None, choices=list(STAGES) + ['all'],
+                        help='recompute these stages even if their outputs are up to date')
+    parser.add_argument('--registration_backend', type=str, default='bigstitcher', choices=['bigstitcher', 'python'],
+                        help='compute pairwise shifts with BigStitcher in Fiji or with phase correlation in python')
+    parser.add_argument('--global_optimizer', type=str, default='bigstitcher', choices=['bigstitcher', 'python'],
+                        help='optimize tile positions with BigStitcher or with sparse least squares in python, ' +
+                             'python registration backend always uses python')
+    parser.add_argument('--registration_downsample', type=int, default=1, choices=[1, 2, 4, 8],
+                        help='compute pairwise shifts on tiles downsampled in x and y by this factor, ' +
+                             'shifts are scaled back to full resolution (python backend refines them at full resolution)')
+    parser.add_argument('--tile_format', type=str, default='tiff', choices=list(TILE_FORMATS),
+                        help='hdf5 writes projected tiles of all channels into one chunked multi-resolution ' +
+                             'BigDataViewer hdf5 file, only reference channel is written as tiff files for registration')
+    parser.add_argument('--tile_compression', type=str, default='none', choices=list(TILE_COMPRESSIONS),
+                        help='lossless compression of projected tiles in best_focus_dir, encoded in parallel threads; ' +
+                             'BigStitcher reads only deflate and lzw, zstd needs python registration and fusion backends')
+    parser.add_argument('--fusion_backend', type=str, default='bigstitcher', choices=['bigstitcher', 'python'],
+                        help='fuse channels with BigStitcher or block by block in python into tiled compressed BigTIFF')
+    parser.add_argument('--fusion_mode', type=str, default='per_channel', choices=['per_channel', 'single_session'],
+                        help='BigStitcher fusion: one ImageJ process per channel or all channels in one ImageJ process')
+    parser.add_argument('--max_fiji_jobs', type=int, default=None,
+                        help='max number of concurrent Fiji fusion jobs, by default limited only by available memory')
+    parser.add_argument('--fusion_block_size', type=int, default=0,
+                        help='BigStitcher fusion: fuse every channel in blocks of this many px (multiple of 16) as separate ' +
+                             'Fiji jobs and stream them into a tiled BigTIFF, so memory does not grow with the mosaic, 0 disables')
+    parser.add_argument('--fusion_block_overlap', type=int, default=32,
+                        help='px fused around every block and cropped afterwards')
+    parser.add_argument('--assemble_ome_tiff', action='store_true',
+                        help='assemble fused channels into one pyramidal OME-TIFF')
+    parser.add_argument('--fiji_pool_workers', type=int, default=0,
+                        help='run Fiji jobs in this many long-lived Fiji processes that are shared by stitching runs ' +
+                             'and stop after --fiji_pool_idle_timeout seconds without jobs, 0 starts Fiji for every job')
+    parser.add_argument('--fiji_pool_idle_timeout', type=float, default=600,
+                        help='seconds without jobs after which the Fiji pool stops')
+    parser.add_argument('--plan', action='store_true',
+                        help='only predict bytes read and written, output sizes and peak memory of every stage ' +
+                             'from file listing, best z-planes and tiff headers, and suggest worker counts')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile python code with cProfile, the .prof file is saved next to the run report in out_dir/reports')
+    parser.add_argument('--focus_metric', type=str, default='laplacian_variance', choices=list(FOCUS_METRICS),
+                        help='focus metric used to select best z-planes when cytokit data.json is not provided')
 
     args = parser.parse_args()
 
-    main(args.imagej_path, args.img_dirs, args.out_dir, args.best_focus_dir, args.cytokit_json_path, args.submission_file_path)
+    main(args.imagej_path, args.img_dirs, args.out_dir, args.best_focus_dir, args.cytokit_json_path, args.submission_file_path,
+         args.num_workers, args.parallel_mode, args.max_tiles_in_flight, args.projection_method,
+         args.normalize_intensity, args.force_stage, args.registration_backend,
+         args.global_optimizer, args.fusion_backend, args.fusion_mode,
+         args.max_fiji_jobs, args.assemble_ome_tiff, args.focus_metric,
+         args.pipeline_workers, args.pipeline_depth, args.output_dtype, args.registration_downsample,
+         args.tile_format, args.profile, args.fiji_pool_workers, args.fiji_pool_idle_timeout, args.fusion_block_size,
+         args.fusion_block_overlap, args.tile_compression, args.plan)
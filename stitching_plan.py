@@ -0,0 +1,306 @@
+import glob
+import json
+import os
+import os.path as osp
+import posixpath as px
+from typing import List, Dict
+
+import numpy as np
+import tifffile as tif
+
+from image_paths_arrangement import DatasetIndex, build_dataset_index
+from best_z_plane_selection_with_cytokit_info import get_info_about_best_focal_plane_per_tile
+from focus_scoring import FocusScoreCache, get_default_focus_options, get_best_focal_plane_per_tile_from_scores
+from file_manipulation import create_paths_for_channel_dirs, get_channel_names_per_cycle
+from intensity_normalization import needs_decoding
+from projection import get_output_dtype
+from stage_manifest import make_fingerprint
+from tile_grid import get_snake_grid_positions, get_grid_translations
+from native_fusion import get_mosaic_extent
+from block_fusion import get_fusion_blocks, estimate_block_fusion_memory_mb
+from fiji_scheduler import estimate_fusion_memory_mb, get_mosaic_size, get_max_concurrency, get_available_memory_mb
+from tile_pipeline import get_default_pipeline_options
+
+
+MB = 1024 ** 2
+# interpreter, numpy and listing of the stitching process
+BASE_MEMORY_MB = 200
+# stages of a previous run report that correspond to planned stages
+REPORT_STAGE_NAMES = dict(focus_scoring='best_z_selection')
+
+
+def read_tile_header(path: str) -> dict:
+    """ Size, dtype and compression from the first IFD, pixels are not read """
+    with tif.TiffFile(path) as f:
+        page = f.pages[0]
+        return dict(width=page.shape[-1], height=page.shape[-2], dtype=np.dtype(page.dtype),
+                    compressed=page.compression != 1, file_bytes=osp.getsize(path))
+
+
+def plan_best_z(dataset_index: DatasetIndex, submission: dict, cytokit_json_path: str = None, focus_options: dict = None,
+                cache_dir: str = None):
+    """ Returns best z-planes per tile and {tile: number of z-planes} of tiles that still need focus scoring.
+        Tiles without cached focus scores get their middle z-plane, which has the same number of neighbours to project.
+    """
+    if cytokit_json_path is not None:
+        return get_info_about_best_focal_plane_per_tile(cytokit_json_path), dict()
+    if focus_options is None:
+        focus_options = get_default_focus_options()
+    reference_cycle = submission.get('bestFocusReferenceCycle', 1)
+    tiles, zplanes, paths = dataset_index.get_zplane_table(reference_cycle, submission['bestFocusReferenceChannel'])
+    cache = FocusScoreCache(cache_dir) if cache_dir is not None and osp.exists(cache_dir) else None
+    focus_scores_per_tile = dict()
+    tiles_to_score = dict()
+    for tile, tile_paths in zip(tiles.tolist(), paths):
+        present = tile_paths != ''
+        scores = None
+        if cache is not None:
+            scores = cache.get(tile, make_fingerprint(tile_paths[present].tolist(), focus_options))
+        if scores is None:
+            tile_zplanes = zplanes[present].tolist()
+            middle = tile_zplanes[len(tile_zplanes) // 2]
+            scores = {z: -abs(z - middle) for z in tile_zplanes}
+            tiles_to_score[tile] = len(tile_zplanes)
+        focus_scores_per_tile[tile] = scores
+    tile_positions = get_snake_grid_positions(submission['numTiles'], submission['regionWidth'], submission['regionHeight'])
+    return get_best_focal_plane_per_tile_from_scores(focus_scores_per_tile, tile_positions), tiles_to_score
+
+
+def get_grid_placements(info_for_bigstitcher: dict) -> List[dict]:
+    """ Tile placements of native_fusion at their expected grid positions """
+    positions = get_snake_grid_positions(info_for_bigstitcher['num_tiles'], info_for_bigstitcher['num_tiles_x'],
+                                         info_for_bigstitcher['num_tiles_y'])
+    translations = get_grid_translations(positions, info_for_bigstitcher['tile_width'], info_for_bigstitcher['tile_height'],
+                                         info_for_bigstitcher['overlap_x'], info_for_bigstitcher['overlap_y'])
+    size = (info_for_bigstitcher['tile_width'], info_for_bigstitcher['tile_height'])
+    return [dict(path=None, offset=(int(round(x)), int(round(y))), size=size) for x, y in translations]
+
+
+def make_stage(name: str, read_bytes: float = 0, written_bytes: float = 0, peak_memory_mb: float = 0, **details) -> dict:
+    return dict(name=name, read_bytes=int(read_bytes), written_bytes=int(written_bytes), peak_memory_mb=int(peak_memory_mb),
+                **details)
+
+
+def plan_projection(channel_image_paths: Dict[int, List[tuple]], raw: dict, projection_options: dict, num_workers: int,
+                    parallel_mode: str, pipeline_options: dict, tile_format: str) -> List[dict]:
+    plane_px = raw['width'] * raw['height']
+    plane_bytes = plane_px * raw['dtype'].itemsize
+    out_itemsize = get_output_dtype(raw['dtype'], projection_options['normalize'], projection_options['output_dtype']).itemsize
+    out_bytes = plane_px * out_itemsize
+    # tiles in a hard link or reflink cost no reads or writes
+    tiff_channels = [1] if tile_format == 'hdf5' else list(channel_image_paths)
+    tiles = [paths for channel in tiff_channels for paths in channel_image_paths[channel]]
+    decoded = [src for src, dst, weights in tiles if needs_decoding(src, projection_options)]
+    planes_per_tile = max([len(src) for src in decoded] or [1])
+    stages = []
+
+    if projection_options['normalize'] in ('channel', 'percentile'):
+        sample_step = projection_options['sample_step']
+        sampled_tiles = sum(min(len(paths), projection_options['max_sample_tiles']) for paths in channel_image_paths.values())
+        stages.append(make_stage('intensity_ranges', read_bytes=sampled_tiles * planes_per_tile * raw['file_bytes'] / sample_step,
+                                 peak_memory_mb=BASE_MEMORY_MB + num_workers * plane_bytes / sample_step ** 2 * 8 / MB))
+
+    # streaming projection holds one decoded plane, the float32 sum and the output per running tile
+    per_tile_bytes = plane_bytes + plane_px * 4 + out_bytes
+    if parallel_mode == 'pipeline':
+        if pipeline_options is None:
+            pipeline_options = get_default_pipeline_options(num_workers)
+        read_tiles = pipeline_options['read_depth'] + pipeline_options['read_workers'] + pipeline_options['project_workers']
+        projected_tiles = pipeline_options['project_depth'] + pipeline_options['write_workers']
+        projection_bytes = (read_tiles * planes_per_tile * plane_bytes + pipeline_options['project_workers'] * plane_px * 4 +
+                            projected_tiles * out_bytes)
+    else:
+        projection_bytes = num_workers * per_tile_bytes
+        if parallel_mode == 'processes':
+            projection_bytes += num_workers * BASE_MEMORY_MB * MB
+    compression = projection_options.get('compression', 'none')
+    stages.append(make_stage('projection', read_bytes=sum(len(src) for src in decoded) * raw['file_bytes'],
+                             written_bytes=len(decoded) * out_bytes, peak_memory_mb=BASE_MEMORY_MB + projection_bytes / MB,
+                             tiles=len(tiles), decoded_tiles=len(decoded), linked_tiles=len(tiles) - len(decoded),
+                             per_worker_mb=int(per_tile_bytes / MB) + 1,
+                             note='written bytes are uncompressed' if compression != 'none' else ''))
+    if tile_format == 'hdf5':
+        all_tiles = sum(len(paths) for paths in channel_image_paths.values())
+        # every tile is projected again and written with a 2x downsampled pyramid
+        stages.append(make_stage('hdf5_write', read_bytes=all_tiles * planes_per_tile * raw['file_bytes'],
+                                 written_bytes=all_tiles * out_bytes * 4 / 3, peak_memory_mb=BASE_MEMORY_MB + projection_bytes / MB,
+                                 tiles=all_tiles))
+    return stages
+
+
+def plan_fusion(info_for_bigstitcher: dict, num_channels: int, tile_bytes: int, out_itemsize: int, num_workers: int,
+                fusion_backend: str, fusion_mode: str, tile_format: str, max_fiji_jobs: int = None, fusion_block_size: int = 0,
+                fusion_block_overlap: int = 32, python_block_size: int = 1024) -> dict:
+    width, height = get_mosaic_size(info_for_bigstitcher)
+    read_bytes = num_channels * info_for_bigstitcher['num_tiles'] * tile_bytes
+    if fusion_backend == 'python':
+        # 2 x num_workers blocks: float32 sum, weights, blending product and output
+        block_bytes = python_block_size ** 2 * (3 * 4 + out_itemsize)
+        return make_stage('fusion', read_bytes=read_bytes, written_bytes=num_channels * width * height * out_itemsize,
+                          peak_memory_mb=BASE_MEMORY_MB + 2 * num_workers * block_bytes / MB, jobs=num_channels,
+                          note='written bytes are uncompressed')
+    # BigStitcher writes 16-bit fused images
+    written_bytes = num_channels * width * height * 2
+    if fusion_block_size > 0:
+        placements = get_grid_placements(info_for_bigstitcher)
+        origin, size = get_mosaic_extent(placements)
+        blocks = get_fusion_blocks(origin, size, fusion_block_size, fusion_block_overlap)
+        mem_per_job_mb = max(estimate_block_fusion_memory_mb(placements, block) for block in blocks)
+        jobs_at_once = len(blocks)
+        num_jobs = num_channels * len(blocks)
+    elif fusion_mode == 'single_session' or tile_format == 'hdf5':
+        mem_per_job_mb = estimate_fusion_memory_mb(info_for_bigstitcher)
+        jobs_at_once = num_jobs = 1
+    else:
+        mem_per_job_mb = estimate_fusion_memory_mb(info_for_bigstitcher)
+        jobs_at_once = num_jobs = num_channels
+    concurrency = get_max_concurrency(mem_per_job_mb, jobs_at_once, max_fiji_jobs)
+    return make_stage('fusion', read_bytes=read_bytes, written_bytes=written_bytes,
+                      peak_memory_mb=BASE_MEMORY_MB + concurrency * mem_per_job_mb, jobs=num_jobs,
+                      mem_per_job_mb=mem_per_job_mb, concurrent_jobs=concurrency,
+                      note='written bytes are uncompressed' + (', block assembly reads them again' if fusion_block_size > 0 else ''))
+
+
+def plan_registration(info_for_bigstitcher: dict, tile_bytes: int, num_workers: int, registration_backend: str) -> dict:
+    read_bytes = info_for_bigstitcher['num_tiles'] * tile_bytes
+    if registration_backend == 'python':
+        # two grid rows of tiles and complex FFTs of overlap strips of every running pair
+        strip_px = info_for_bigstitcher['tile_width'] * info_for_bigstitcher['tile_height'] * info_for_bigstitcher['overlap_x'] / 100
+        peak = 2 * info_for_bigstitcher['num_tiles_x'] * tile_bytes + num_workers * strip_px * 16 * 3
+        return make_stage('registration', read_bytes=read_bytes, peak_memory_mb=BASE_MEMORY_MB + peak / MB)
+    # registration job gets the heap of a fusion job, it may fuse the reference channel as well
+    mem_mb = estimate_fusion_memory_mb(info_for_bigstitcher)
+    return make_stage('registration', read_bytes=read_bytes, peak_memory_mb=BASE_MEMORY_MB + mem_mb, jobs=1, mem_per_job_mb=mem_mb)
+
+
+def find_last_report(out_dir: str) -> dict:
+    paths = sorted(glob.glob(px.join(out_dir, 'reports', 'run_report_*.json')))
+    if not paths:
+        return None
+    try:
+        with open(paths[-1], 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return None
+
+
+def predict_stage_seconds(stages: List[dict], last_report: dict, img_dirs: List[str]):
+    """ Bytes of every stage divided by the throughput of the same stage in the last run,
+        stages that run in Fiji have no python I/O and take their time from the last run of the same dataset
+    """
+    if last_report is None:
+        return
+    same_dataset = last_report.get('parameters', {}).get('img_dirs') == img_dirs
+    previous = {stage['name']: stage for stage in last_report.get('stages', [])}
+    for stage in stages:
+        previous_stage = previous.get(REPORT_STAGE_NAMES.get(stage['name'], stage['name']))
+        if previous_stage is None or not previous_stage.get('wall_seconds'):
+            continue
+        io = previous_stage.get('io', {})
+        previous_bytes = io.get('rchar', 0) + io.get('wchar', 0)
+        stage_bytes = stage['read_bytes'] + stage['written_bytes']
+        if previous_bytes > 10 * MB and stage_bytes > 0:
+            stage['seconds'] = round(stage_bytes / (previous_bytes / previous_stage['wall_seconds']), 1)
+        elif same_dataset:
+            stage['seconds'] = previous_stage['wall_seconds']
+
+
+def suggest_settings(stages: List[dict], info_for_bigstitcher: dict, fusion_block_size: int, available_mb: int,
+                     reserve_mb: int = 2048) -> dict:
+    stages = {stage['name']: stage for stage in stages}
+    per_worker_mb = stages['projection']['per_worker_mb']
+    suggestions = dict(num_workers=int(max(1, min(os.cpu_count() or 1, (available_mb - reserve_mb - BASE_MEMORY_MB) // per_worker_mb))))
+    fusion = stages['fusion']
+    if 'concurrent_jobs' in fusion:
+        suggestions['max_fiji_jobs'] = fusion['concurrent_jobs']
+    if fusion_block_size == 0 and fusion.get('mem_per_job_mb', 0) > available_mb - reserve_mb:
+        # whole mosaic does not fit into memory, largest block that does
+        placements = get_grid_placements(info_for_bigstitcher)
+        origin, size = get_mosaic_extent(placements)
+        for block_size in (8192, 4096, 2048, 1024):
+            blocks = get_fusion_blocks(origin, size, block_size, 32)
+            if max(estimate_block_fusion_memory_mb(placements, block) for block in blocks) <= available_mb - reserve_mb:
+                suggestions['fusion_block_size'] = block_size
+                break
+    return suggestions
+
+
+def make_plan(img_dirs: List[str], out_dir: str, best_focus_dir: str, cytokit_json_path: str, submission: dict,
+              info_for_bigstitcher: dict, projection_options: dict, focus_options: dict, num_workers: int = 1,
+              parallel_mode: str = 'threads', pipeline_options: dict = None, registration_backend: str = 'bigstitcher',
+              fusion_backend: str = 'bigstitcher', fusion_mode: str = 'per_channel', tile_format: str = 'tiff',
+              max_fiji_jobs: int = None, fusion_block_size: int = 0, fusion_block_overlap: int = 32,
+              assemble: bool = False) -> dict:
+    """ Predicts bytes read and written, output sizes and peak memory of every stage of a full run
+        from the listing, best z-planes, submission file and tiff headers, without reading pixels or writing files
+    """
+    # listing and focus score caches of an earlier run are used, but never written
+    cache_dir = best_focus_dir if osp.exists(best_focus_dir) else None
+    dataset_index = build_dataset_index(img_dirs, num_workers, cache_dir=cache_dir, save_cache=False)
+    best_z_plane_per_tile, tiles_to_score = plan_best_z(dataset_index, submission, cytokit_json_path, focus_options, cache_dir)
+    _, channel_image_paths = create_paths_for_channel_dirs(img_dirs, best_focus_dir, get_channel_names_per_cycle(submission),
+                                                           best_z_plane_per_tile, None, dataset_index)
+    raw = read_tile_header(channel_image_paths[1][0][0][0])
+    tile_px = raw['width'] * raw['height']
+    out_dtype = get_output_dtype(raw['dtype'], projection_options['normalize'], projection_options['output_dtype'])
+    tile_bytes = tile_px * out_dtype.itemsize
+    num_channels = len(channel_image_paths)
+    num_tiles = sum(len(paths) for paths in channel_image_paths.values())
+    info = dict(info_for_bigstitcher, tile_width=raw['width'], tile_height=raw['height'])
+
+    if focus_options is None:
+        focus_options = get_default_focus_options()
+    stages = []
+    if tiles_to_score:
+        # centre crops of uncompressed planes are memory mapped, compressed planes are decoded whole
+        crop = focus_options['crop_fraction'] ** 2 if not raw['compressed'] else 1
+        stages.append(make_stage('focus_scoring', read_bytes=sum(tiles_to_score.values()) * raw['file_bytes'] * crop,
+                                 peak_memory_mb=BASE_MEMORY_MB + num_workers * tile_px * 4 * crop / MB,
+                                 tiles=len(tiles_to_score)))
+    stages.extend(plan_projection(channel_image_paths, raw, projection_options, num_workers, parallel_mode, pipeline_options,
+                                  tile_format))
+    stages.append(plan_registration(info, tile_bytes, num_workers, registration_backend))
+    fusion_itemsize = out_dtype.itemsize if fusion_backend == 'python' else 2
+    stages.append(plan_fusion(info, num_channels, tile_bytes, fusion_itemsize, num_workers, fusion_backend, fusion_mode,
+                              tile_format, max_fiji_jobs, fusion_block_size, fusion_block_overlap))
+    width, height = get_mosaic_size(info)
+    fused_bytes = num_channels * width * height * fusion_itemsize
+    ome_tiff_bytes = 0
+    if assemble:
+        # pyramid levels add a third, levels are built in raw temp files next to the output
+        ome_tiff_bytes = fused_bytes * 4 / 3
+        stages.append(make_stage('assembly', read_bytes=fused_bytes, written_bytes=2 * ome_tiff_bytes,
+                                 peak_memory_mb=BASE_MEMORY_MB + num_workers * 4096 ** 2 * fusion_itemsize * 3 / MB))
+    predict_stage_seconds(stages, find_last_report(out_dir), img_dirs)
+
+    available_mb = get_available_memory_mb()
+    intermediate = [stage for stage in stages if stage['name'] in ('projection', 'hdf5_write')]
+    return dict(dataset=dict(cycles=len(img_dirs), channels=num_channels, tiles=num_tiles,
+                             tile_width=raw['width'], tile_height=raw['height'], dtype=str(raw['dtype']),
+                             planes_per_tile=round(np.mean([len(z) for z in best_z_plane_per_tile.values()]), 2),
+                             best_z_source='cytokit' if cytokit_json_path is not None else 'focus_scoring',
+                             mosaic_width=width, mosaic_height=height),
+                stages=stages,
+                outputs=dict(intermediate_bytes=int(sum(stage['written_bytes'] for stage in intermediate)),
+                             fused_bytes=int(fused_bytes), ome_tiff_bytes=int(ome_tiff_bytes)),
+                available_memory_mb=available_mb,
+                suggestions=suggest_settings(stages, info, fusion_block_size, available_mb))
+
+
+def print_plan(plan: dict):
+    dataset = plan['dataset']
+    print('\nPlan of a full run, nothing was read or written')
+    print(('{cycles} cycles, {channels} channels to stitch, {tiles} tiles {tile_width}x{tile_height} {dtype}, ' +
+           '{planes_per_tile} z-planes per tile from {best_z_source}, mosaic {mosaic_width}x{mosaic_height}').format(**dataset))
+    print('\n{:<18}{:>12}{:>14}{:>14}{:>10}  {}'.format('stage', 'read, MB', 'written, MB', 'peak mem, MB', 'time, s', 'details'))
+    for stage in plan['stages']:
+        details = {key: value for key, value in stage.items()
+                   if key not in ('name', 'read_bytes', 'written_bytes', 'peak_memory_mb', 'seconds') and value != ''}
+        print('{:<18}{:>12.1f}{:>14.1f}{:>14}{:>10}  {}'.format(
+            stage['name'], stage['read_bytes'] / MB, stage['written_bytes'] / MB, stage['peak_memory_mb'],
+            stage.get('seconds', '-'), ', '.join('{k}={v}'.format(k=k, v=v) for k, v in details.items())))
+    outputs = plan['outputs']
+    print('\nintermediate tiles {i:.1f} MB, fused images {f:.1f} MB, OME-TIFF {o:.1f} MB'.format(
+        i=outputs['intermediate_bytes'] / MB, f=outputs['fused_bytes'] / MB, o=outputs['ome_tiff_bytes'] / MB))
+    print('available memory', plan['available_memory_mb'], 'MB, suggested:',
+          ', '.join('--{k} {v}'.format(k=k, v=v) for k, v in plan['suggestions'].items()))
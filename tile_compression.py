@@ -0,0 +1,45 @@
+import io
+import os
+from functools import lru_cache
+
+import numpy as np
+import tifffile as tif
+
+
+# lossless codecs of projected tiles as tifffile.imwrite arguments, predictor is horizontal differencing
+TILE_COMPRESSIONS = {'none': dict(),
+                     'deflate': dict(compression='zlib', predictor=True, compressionargs=dict(level=6)),
+                     'lzw': dict(compression='lzw', predictor=True),
+                     'zstd': dict(compression='zstd', predictor=True, compressionargs=dict(level=1))}
+# codecs of TIFF files that Bio-Formats, the image loader of BigStitcher, can decode
+FIJI_READABLE_TILE_COMPRESSIONS = ('none', 'deflate', 'lzw')
+
+
+@lru_cache(maxsize=None)
+def is_codec_available(compression: str) -> bool:
+    """ lzw and zstd are encoded by imagecodecs, deflate falls back to zlib of the standard library """
+    try:
+        tif.imwrite(io.BytesIO(), np.zeros((16, 16), dtype=np.uint16), **TILE_COMPRESSIONS[compression])
+        return True
+    except (ImportError, KeyError, ValueError):
+        return False
+
+
+def check_tile_compression(compression: str, read_by_fiji: bool):
+    if compression not in TILE_COMPRESSIONS:
+        raise ValueError('Unknown tile compression ' + str(compression) + ', choose from ' + ', '.join(TILE_COMPRESSIONS))
+    if read_by_fiji and compression not in FIJI_READABLE_TILE_COMPRESSIONS:
+        raise ValueError('BigStitcher cannot read tiles compressed with ' + compression + ', use one of ' +
+                         ', '.join(FIJI_READABLE_TILE_COMPRESSIONS) + ' or python registration and fusion backends')
+    if not is_codec_available(compression):
+        raise ImportError('Tile compression ' + compression + ' requires imagecodecs, install it with pip install imagecodecs')
+
+
+def get_encode_workers(num_workers: int) -> int:
+    """ Threads that encode strips of one tile, cpus are shared with tiles projected at the same time """
+    return max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+
+def write_tile(path: str, img: np.ndarray, compression: str = 'none', encode_workers: int = 1):
+    """ Compressed tiles are written in strips that are encoded in parallel """
+    tif.imwrite(path, img, maxworkers=encode_workers, **TILE_COMPRESSIONS[compression])
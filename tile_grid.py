@@ -0,0 +1,43 @@
+from typing import List, Tuple, Dict
+
+
+def get_snake_grid_positions(num_tiles: int, num_tiles_x: int, num_tiles_y: int) -> List[Tuple[int, int]]:
+    """ Grid (row, col) of every tile, tiles are zero based and
+        arranged like BigStitcher's [Snake: Right & Down]
+    """
+    positions = []
+    for tile in range(0, num_tiles):
+        row = tile // num_tiles_x
+        col = tile % num_tiles_x
+        if row % 2 == 1:
+            col = num_tiles_x - 1 - col
+        if row >= num_tiles_y:
+            raise ValueError('Tile ' + str(tile) + ' does not fit into grid ' + str(num_tiles_y) + 'x' + str(num_tiles_x))
+        positions.append((row, col))
+    return positions
+
+
+def get_grid_translations(positions: List[Tuple[int, int]], tile_width: int, tile_height: int,
+                          overlap_x: float, overlap_y: float) -> List[Tuple[float, float]]:
+    """ Expected (x, y) offset in pixels of every tile, overlaps are in percent """
+    step_x = tile_width * (1 - overlap_x / 100)
+    step_y = tile_height * (1 - overlap_y / 100)
+    return [(col * step_x, row * step_y) for row, col in positions]
+
+
+def get_adjacent_tile_pairs(positions: List[Tuple[int, int]]) -> List[Tuple[int, int, str]]:
+    """ Pairs (a, b, direction) of neighbouring tiles, b is to the right of or below a """
+    tile_at_position = {pos: tile for tile, pos in enumerate(positions)}
+    pairs = []
+    for tile, (row, col) in enumerate(positions):
+        right = tile_at_position.get((row, col + 1))
+        if right is not None:
+            pairs.append((tile, right, 'horizontal'))
+        below = tile_at_position.get((row + 1, col))
+        if below is not None:
+            pairs.append((tile, below, 'vertical'))
+    return pairs
+
+
+def get_tile_at_position(positions: List[Tuple[int, int]]) -> Dict[Tuple[int, int], int]:
+    return {pos: tile for tile, pos in enumerate(positions)}
@@ -0,0 +1,160 @@
+import os
+import os.path as osp
+import time
+import queue
+import threading
+from typing import List
+
+import tifffile as tif
+
+from projection import project_planes, finalize_projection
+from intensity_normalization import get_tile_projection_options, needs_decoding
+from tile_compression import write_tile
+
+
+PIPELINE_STAGES = ('read', 'project', 'write')
+_DONE = object()
+
+
+def get_default_pipeline_options(num_workers: int = 1) -> dict:
+    """ Workers per stage and depth of the queue after read and project stages, in tiles """
+    return dict(read_workers=num_workers, project_workers=num_workers, write_workers=max(1, num_workers // 2),
+                read_depth=2 * num_workers, project_depth=num_workers)
+
+
+class StageStats:
+    """ Tiles, bytes and time workers spent working, thread-safe """
+    def __init__(self, name: str, num_workers: int):
+        self.name = name
+        self.num_workers = num_workers
+        self.tiles = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, num_bytes: int, seconds: float):
+        with self._lock:
+            self.tiles += 1
+            self.bytes += num_bytes
+            self.busy_seconds += seconds
+
+    def to_dict(self, wall_seconds: float) -> dict:
+        """ Stage with utilization close to 1 is the one that limits the pipeline """
+        mb = self.bytes / 1024 ** 2
+        return dict(tiles=self.tiles, mb=round(mb, 2), busy_seconds=round(self.busy_seconds, 3),
+                    mb_per_s=round(mb / wall_seconds, 2) if wall_seconds > 0 else None,
+                    tiles_per_s=round(self.tiles / wall_seconds, 2) if wall_seconds > 0 else None,
+                    utilization=round(self.busy_seconds / (wall_seconds * self.num_workers), 3) if wall_seconds > 0 else None)
+
+
+def print_pipeline_stats(stats: dict):
+    print('stage', 'workers', 'tiles', 'MB', 'MB/s', 'tiles/s', 'utilization', sep='\t')
+    for name in PIPELINE_STAGES:
+        s = stats[name]
+        print(name, s['workers'], s['tiles'], s['mb'], s['mb_per_s'], s['tiles_per_s'], s['utilization'], sep='\t')
+
+
+def run_tile_pipeline(best_z_plane_paths: List[tuple], projection_options: dict, pipeline_options: dict,
+                      link_or_copy, on_tile_done=None) -> dict:
+    """ Reads z-planes of upcoming tiles, projects and writes tiles at the same time.
+        Each stage has its own threads, bounded queues between stages limit the number of tiles in memory.
+        Tiles with one selected plane that do not need rescaling skip read and project stages
+        and are linked or copied by the write stage.
+        Returns throughput of every stage.
+    """
+    num_workers = {stage: max(1, pipeline_options[stage + '_workers']) for stage in PIPELINE_STAGES}
+    stage_stats = {stage: StageStats(stage, num_workers[stage]) for stage in PIPELINE_STAGES}
+
+    # tasks -> read -> read_queue -> project -> project_queue -> write
+    task_queue = queue.Queue(maxsize=num_workers['read'])
+    read_queue = queue.Queue(maxsize=max(1, pipeline_options['read_depth']))
+    project_queue = queue.Queue(maxsize=max(1, pipeline_options['project_depth']))
+    errors = []
+    failed = threading.Event()
+
+    def read(task):
+        src, dst, weights = task
+        if not needs_decoding(src, get_tile_projection_options(projection_options, dst)):
+            return task, None
+        start = time.perf_counter()
+        planes = {path: tif.imread(path) for path in src}
+        stage_stats['read'].add(sum(p.nbytes for p in planes.values()), time.perf_counter() - start)
+        return task, planes
+
+    def project(item):
+        task, planes = item
+        if planes is None:
+            return task, None
+        src, dst, weights = task
+        start = time.perf_counter()
+        options = get_tile_projection_options(projection_options, dst)
+        dtype = planes[src[0]].dtype
+        img = project_planes(src, options['method'], weights, read_plane=planes.pop)
+        img = finalize_projection(img, dtype, options['normalize'], options.get('output_dtype', 'source'),
+                                  options.get('intensity_range'))
+        stage_stats['project'].add(img.nbytes, time.perf_counter() - start)
+        return task, img
+
+    def write(item):
+        task, img = item
+        src, dst, weights = task
+        start = time.perf_counter()
+        if img is None:
+            link_or_copy(src[0], dst)
+        else:
+            if osp.lexists(dst):
+                os.remove(dst)
+            options = get_tile_projection_options(projection_options, dst)
+            write_tile(dst, img, options.get('compression', 'none'), options.get('encode_workers', 1))
+        stage_stats['write'].add(osp.getsize(dst), time.perf_counter() - start)
+        if on_tile_done is not None:
+            on_tile_done(src, dst, weights)
+        return None
+
+    def worker(func, in_queue, out_queue):
+        # after a failure workers keep draining their queue so upstream stages are never blocked
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            if failed.is_set():
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                errors.append(e)
+                failed.set()
+                continue
+            if out_queue is not None:
+                out_queue.put(result)
+
+    def start_stage(stage, func, in_queue, out_queue):
+        threads = [threading.Thread(target=worker, args=(func, in_queue, out_queue), daemon=True)
+                   for _ in range(num_workers[stage])]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    start = time.perf_counter()
+    read_threads = start_stage('read', read, task_queue, read_queue)
+    project_threads = start_stage('project', project, read_queue, project_queue)
+    write_threads = start_stage('write', write, project_queue, None)
+
+    for task in best_z_plane_paths:
+        if failed.is_set():
+            break
+        task_queue.put(task)
+    for threads, in_queue in ((read_threads, task_queue), (project_threads, read_queue), (write_threads, project_queue)):
+        for _ in threads:
+            in_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+    wall_seconds = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    stats = {stage: dict(workers=num_workers[stage], **stage_stats[stage].to_dict(wall_seconds)) for stage in PIPELINE_STAGES}
+    stats['wall_seconds'] = round(wall_seconds, 3)
+    print_pipeline_stats(stats)
+    return stats